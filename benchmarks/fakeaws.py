@@ -0,0 +1,322 @@
+""" In-memory stand-in of the S3, Elastic Beanstalk, Auto Scaling and EC2 APIs ebi calls.
+
+It answers calls of clients made from a boto3 session, like botocore's ``Stubber`` does,
+so that whole commands run without network. Environment operations report success
+after ``operation_seconds`` and scaled groups are healthy immediately.
+
+Each instance is one region. Several regions are faked by installing an instance per region
+sharing ``objects``, as bucket names are global.
+"""
+import urllib.parse
+import datetime
+import hashlib
+import itertools
+import threading
+import time
+
+from botocore.awsrequest import AWSResponse
+
+ACCOUNT_ID = '000000000000'
+PLATFORM_BRANCH = 'Docker running on 64bit Amazon Linux 2023'
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class FakeAWS:
+    """ State of the fake account.
+
+    :param latency: seconds each call takes, to see the effect of API chattiness.
+    :param operation_seconds: seconds environment operations (deploy, create, clone) take.
+    :param objects: S3 objects shared with instances of other regions.
+    """
+
+    def __init__(self, region='us-east-1', latency=0.0, operation_seconds=0.0, objects=None):
+        self.region = region
+        self.latency = latency
+        self.operation_seconds = operation_seconds
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.bucket = f'elasticbeanstalk-{region}-{ACCOUNT_ID}'
+        self.objects = {} if objects is None else objects
+        self.uploads = {}
+        self.versions = {}
+        self.environments = {}
+        self.groups = {}
+        self.events = []
+        self.bytes_uploaded = 0
+        self.bytes_copied = 0
+        self.platform_arn = f'arn:aws:elasticbeanstalk:{region}::platform/{PLATFORM_BRANCH}/4.0.0'
+
+    def install(self, session):
+        """ Answering calls of clients created from the boto3 :param session: from now on.
+        """
+        events = session.events
+        events.register('before-parameter-build', self._keep_params)
+        events.register('before-call', self._respond)
+
+    def _keep_params(self, params, context, **kwargs):
+        context['fake_params'] = dict(params)
+
+    def _respond(self, model, context, request_signer=None, **kwargs):
+        if request_signer is not None and request_signer.region_name != self.region:
+            # Left to the instance of the region.
+            return None
+        if self.latency:
+            time.sleep(self.latency)
+        name = model.name
+        handler = getattr(self, f'{model.service_model.service_name}_{name}', None)
+        if handler is None:
+            raise NotImplementedError(f'{model.service_model.service_name}.{name} is not faked')
+        params = context.get('fake_params', {})
+        with self.lock:
+            try:
+                parsed = handler(**params)
+                status = 200
+            except FakeError as e:
+                parsed = {'Error': {'Code': e.code, 'Message': str(e)}}
+                status = e.status
+        metadata = parsed.setdefault('ResponseMetadata', {})
+        metadata.setdefault('RequestId', f'req-{next(self.ids)}')
+        metadata['HTTPStatusCode'] = status
+        return AWSResponse('https://fake', status, {}, None), parsed
+
+    # Setting up
+
+    def add_environment(self, app_name, env_name, cname, version=None, instances=2, tier='WebServer'):
+        group = f'awseb-{env_name}-AutoScalingGroup'
+        self.environments[env_name] = {
+            'ApplicationName': app_name,
+            'EnvironmentName': env_name,
+            'EnvironmentId': f'e-{next(self.ids)}',
+            'CNAME': f'{cname}.{self.region}.elasticbeanstalk.com',
+            'VersionLabel': version,
+            'PlatformArn': self.platform_arn,
+            'Status': 'Ready',
+            'Health': 'Green',
+            'Tier': {'Name': tier, 'Type': 'Standard', 'Version': '1.0'},
+            'Group': group,
+        }
+        self.groups[group] = {'MinSize': 1, 'MaxSize': 4, 'DesiredCapacity': 0, 'Instances': []}
+        self._scale(group, instances)
+
+    def _scale(self, group_name, desired):
+        group = self.groups[group_name]
+        group['DesiredCapacity'] = desired
+        group['Instances'] = [{'InstanceId': f'i-{group_name[-8:]}{i:04d}', 'LifecycleState': 'InService',
+                               'HealthStatus': 'Healthy'} for i in range(desired)]
+
+    def _succeed(self, env_name, message):
+        request_id = f'op-{next(self.ids)}'
+        start = _now()
+        done = start + datetime.timedelta(seconds=self.operation_seconds)
+        for date, text in ((start, 'Environment operation is starting.'), (done, message)):
+            self.events.append({
+                'EventDate': date, 'Message': text, 'Severity': 'INFO', 'RequestId': request_id,
+                'ApplicationName': self.environments[env_name]['ApplicationName'], 'EnvironmentName': env_name,
+            })
+        return {'ResponseMetadata': {'RequestId': request_id}}
+
+    # S3
+
+    def s3_ListObjectsV2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken='', **kwargs):
+        keys = sorted(key for (bucket, key) in self.objects
+                      if bucket == Bucket and key.startswith(Prefix) and key > ContinuationToken)
+        res = {'Contents': [{'Key': key, 'Size': self.objects[(Bucket, key)]} for key in keys[:MaxKeys]],
+               'IsTruncated': len(keys) > MaxKeys}
+        if res['IsTruncated']:
+            res['NextContinuationToken'] = keys[MaxKeys - 1]
+        return res
+
+    def s3_PutObject(self, Bucket, Key, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        self.bytes_uploaded += len(data)
+        self.objects[(Bucket, Key)] = len(data)
+        return {'ETag': f'"{hashlib.md5(data).hexdigest()}"'}
+
+    def s3_HeadObject(self, Bucket, Key, **kwargs):
+        if (Bucket, Key) not in self.objects:
+            raise FakeError('404', 'Not Found', 404)
+        return {'ContentLength': self.objects[(Bucket, Key)]}
+
+    def _copy_source(self, source):
+        if isinstance(source, str):
+            bucket, _, key = urllib.parse.unquote(source).lstrip('/').partition('/')
+            source = {'Bucket': bucket, 'Key': key}
+        if (source['Bucket'], source['Key']) not in self.objects:
+            raise FakeError('NoSuchKey', 'The specified key does not exist.', 404)
+        return source['Bucket'], source['Key']
+
+    def s3_CopyObject(self, Bucket, Key, CopySource, **kwargs):
+        size = self.objects[self._copy_source(CopySource)]
+        if size > 5 * 1024 ** 3:
+            raise FakeError('InvalidRequest', 'The specified copy source is larger than the maximum allowable size')
+        self.bytes_copied += size
+        self.objects[(Bucket, Key)] = size
+        return {'CopyObjectResult': {'ETag': f'"copy-{next(self.ids)}"'}}
+
+    def s3_UploadPartCopy(self, Bucket, Key, UploadId, PartNumber, CopySource, CopySourceRange, **kwargs):
+        size = self.objects[self._copy_source(CopySource)]
+        first, last = (int(n) for n in CopySourceRange[len('bytes='):].split('-'))
+        if last >= size:
+            raise FakeError('InvalidArgument', 'Range specified is not valid for source object')
+        self.bytes_copied += last - first + 1
+        etag = f'"copy-{next(self.ids)}"'
+        self.uploads[UploadId]['Parts'][PartNumber] = {'PartNumber': PartNumber, 'ETag': etag,
+                                                       'Size': last - first + 1}
+        return {'CopyPartResult': {'ETag': etag}}
+
+    def s3_DeleteObjects(self, Bucket, Delete, **kwargs):
+        if len(Delete['Objects']) > 1000:
+            raise FakeError('MalformedXML', 'The XML you provided was not well-formed')
+        self.delete_calls = getattr(self, 'delete_calls', 0) + 1
+        for obj in Delete['Objects']:
+            self.objects.pop((Bucket, obj['Key']), None)
+        return {} if Delete.get('Quiet') else {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def s3_CreateMultipartUpload(self, Bucket, Key, **kwargs):
+        upload_id = f'upload-{next(self.ids)}'
+        self.uploads[upload_id] = {'Bucket': Bucket, 'Key': Key, 'Initiated': _now(), 'Parts': {}}
+        return {'Bucket': Bucket, 'Key': Key, 'UploadId': upload_id}
+
+    def s3_UploadPart(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        data = Body.read() if hasattr(Body, 'read') else Body
+        self.bytes_uploaded += len(data)
+        etag = f'"{hashlib.md5(data).hexdigest()}"'
+        self.uploads[UploadId]['Parts'][PartNumber] = {'PartNumber': PartNumber, 'ETag': etag, 'Size': len(data)}
+        return {'ETag': etag}
+
+    def s3_CompleteMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        upload = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = sum(part['Size'] for part in upload['Parts'].values())
+        return {'Bucket': Bucket, 'Key': Key}
+
+    def s3_AbortMultipartUpload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
+        return {}
+
+    def s3_ListMultipartUploads(self, Bucket, Prefix='', **kwargs):
+        return {'Uploads': [{'Key': u['Key'], 'UploadId': upload_id, 'Initiated': u['Initiated']}
+                            for upload_id, u in self.uploads.items()
+                            if u['Bucket'] == Bucket and u['Key'].startswith(Prefix)]}
+
+    def s3_ListParts(self, Bucket, Key, UploadId, **kwargs):
+        return {'Parts': list(self.uploads[UploadId]['Parts'].values())}
+
+    # Elastic Beanstalk
+
+    def elasticbeanstalk_CreateStorageLocation(self, **kwargs):
+        return {'S3Bucket': self.bucket}
+
+    def elasticbeanstalk_DescribeApplicationVersions(self, ApplicationName=None, **kwargs):
+        return {'ApplicationVersions': [v for v in self.versions.values()
+                                        if not ApplicationName or v['ApplicationName'] == ApplicationName]}
+
+    def elasticbeanstalk_CreateApplicationVersion(self, ApplicationName, VersionLabel, SourceBundle, **kwargs):
+        if (ApplicationName, VersionLabel) in self.versions:
+            raise FakeError('InvalidParameterValue', f'Application Version {VersionLabel} already exists.')
+        if SourceBundle['S3Bucket'] != self.bucket:
+            raise FakeError('InvalidParameterCombination', 'Source bundle must be in a bucket of the same region.')
+        self.versions[(ApplicationName, VersionLabel)] = {
+            'ApplicationName': ApplicationName, 'VersionLabel': VersionLabel,
+            'SourceBundle': SourceBundle, 'Status': 'UNPROCESSED', 'DateCreated': _now(),
+        }
+        return {'ApplicationVersion': self.versions[(ApplicationName, VersionLabel)]}
+
+    def elasticbeanstalk_DeleteApplicationVersion(self, ApplicationName, VersionLabel, DeleteSourceBundle=False,
+                                                  **kwargs):
+        version = self.versions.pop((ApplicationName, VersionLabel), None)
+        if version is None:
+            raise FakeError('InvalidParameterValue', f'Application Version {VersionLabel} does not exist.')
+        if DeleteSourceBundle:
+            self.objects.pop((version['SourceBundle']['S3Bucket'], version['SourceBundle']['S3Key']), None)
+        return {}
+
+    def _public_environment(self, env):
+        return {k: v for k, v in env.items() if k != 'Group' and v is not None}
+
+    def elasticbeanstalk_DescribeEnvironments(self, ApplicationName=None, EnvironmentNames=None, **kwargs):
+        return {'Environments': [self._public_environment(env) for env in self.environments.values()
+                                 if (not ApplicationName or env['ApplicationName'] == ApplicationName)
+                                 and (not EnvironmentNames or env['EnvironmentName'] in EnvironmentNames)]}
+
+    def elasticbeanstalk_DescribeEnvironmentResources(self, EnvironmentName, **kwargs):
+        env = self.environments[EnvironmentName]
+        return {'EnvironmentResources': {'EnvironmentName': EnvironmentName,
+                                         'AutoScalingGroups': [{'Name': env['Group']}], 'LoadBalancers': []}}
+
+    def elasticbeanstalk_UpdateEnvironment(self, EnvironmentName, VersionLabel=None, **kwargs):
+        if VersionLabel:
+            self.environments[EnvironmentName]['VersionLabel'] = VersionLabel
+        return self._succeed(EnvironmentName, 'Environment update completed successfully.')
+
+    def elasticbeanstalk_DescribeEvents(self, ApplicationName=None, EnvironmentName=None, RequestId=None,
+                                        StartTime=None, MaxRecords=100, NextToken=None, **kwargs):
+        now = _now()
+        events = sorted(self.events, key=lambda e: e['EventDate'], reverse=True)
+        events = [e for e in events if e['EventDate'] <= now
+                  and (not ApplicationName or e['ApplicationName'] == ApplicationName)
+                  and (not EnvironmentName or e['EnvironmentName'] == EnvironmentName)
+                  and (not RequestId or e['RequestId'] == RequestId)
+                  and (not StartTime or e['EventDate'] >= StartTime)]
+        start = int(NextToken or 0)
+        res = {'Events': events[start:start + MaxRecords]}
+        if start + MaxRecords < len(events):
+            res['NextToken'] = str(start + MaxRecords)
+        return res
+
+    def elasticbeanstalk_SwapEnvironmentCNAMEs(self, SourceEnvironmentName, DestinationEnvironmentName, **kwargs):
+        source = self.environments[SourceEnvironmentName]
+        destination = self.environments[DestinationEnvironmentName]
+        source['CNAME'], destination['CNAME'] = destination['CNAME'], source['CNAME']
+        return {}
+
+    def elasticbeanstalk_DescribePlatformVersion(self, PlatformArn, **kwargs):
+        return {'PlatformDescription': {'PlatformArn': PlatformArn, 'PlatformBranchName': PLATFORM_BRANCH}}
+
+    def elasticbeanstalk_ListPlatformVersions(self, **kwargs):
+        return {'PlatformSummaryList': [{'PlatformArn': self.platform_arn, 'PlatformVersion': '4.0.0'}]}
+
+    def elasticbeanstalk_CreateEnvironment(self, ApplicationName, EnvironmentName, CNAMEPrefix=None,
+                                           VersionLabel=None, **kwargs):
+        self.add_environment(ApplicationName, EnvironmentName, CNAMEPrefix or EnvironmentName, VersionLabel)
+        return self._succeed(EnvironmentName, f'Successfully launched environment: {EnvironmentName}')
+
+    def elasticbeanstalk_TerminateEnvironment(self, EnvironmentName, **kwargs):
+        if EnvironmentName not in self.environments:
+            raise FakeError('InvalidParameterValue', f'No Environment found for EnvironmentName = {EnvironmentName}.')
+        env = self.environments.pop(EnvironmentName)
+        self.groups.pop(env['Group'])
+        return self._public_environment(env)
+
+    def elasticbeanstalk_DescribeInstancesHealth(self, EnvironmentName, **kwargs):
+        group = self.groups[self.environments[EnvironmentName]['Group']]
+        return {'InstanceHealthList': [{'InstanceId': i['InstanceId'], 'HealthStatus': 'Ok'}
+                                       for i in group['Instances']]}
+
+    # Auto Scaling and EC2
+
+    def autoscaling_DescribeAutoScalingGroups(self, AutoScalingGroupNames=(), **kwargs):
+        return {'AutoScalingGroups': [dict(self.groups[name], AutoScalingGroupName=name)
+                                      for name in AutoScalingGroupNames if name in self.groups]}
+
+    def autoscaling_UpdateAutoScalingGroup(self, AutoScalingGroupName, MinSize=None, MaxSize=None,
+                                           DesiredCapacity=None, **kwargs):
+        group = self.groups[AutoScalingGroupName]
+        group['MinSize'] = MinSize if MinSize is not None else group['MinSize']
+        group['MaxSize'] = MaxSize if MaxSize is not None else group['MaxSize']
+        if DesiredCapacity is not None:
+            self._scale(AutoScalingGroupName, DesiredCapacity)
+        return {}
+
+    def ec2_DescribeInstanceStatus(self, InstanceIds=(), **kwargs):
+        return {'InstanceStatuses': [{'InstanceId': i, 'InstanceStatus': {'Status': 'ok'}} for i in InstanceIds]}
+
+
+class FakeError(Exception):
+
+    def __init__(self, code, message, status=400):
+        super().__init__(message)
+        self.code = code
+        self.status = status
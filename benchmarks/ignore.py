@@ -0,0 +1,115 @@
+""" Comparing the ``.ebignore`` walk of ebi with the one of ebcli on a synthetic project.
+
+The project has ``node_modules``, ``.git`` and build caches holding most of its files,
+like real ones. It checks both walks ship the same files and prints their times::
+
+    $ python benchmarks/ignore.py --files 500000
+"""
+import argparse
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import time
+
+from pathspec import PathSpec
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ebi import ignore  # noqa: E402
+
+EBIGNORE = """\
+# dependencies and caches
+node_modules/
+.git/
+build/
+__pycache__/
+*.pyc
+*.log
+!/important.log
+"""
+FILES_PER_DIR = 100
+# Ratio of files in each top level directory.
+LAYOUT = (
+    ('node_modules', 0.80),
+    ('.git/objects', 0.10),
+    ('build/cache', 0.05),
+    ('src', 0.05),
+)
+
+
+def make_project(root, files):
+    """ Making a project of :param files: files on :param root:.
+    """
+    for top, ratio in LAYOUT:
+        count = int(files * ratio)
+        for i in range(0, count, FILES_PER_DIR):
+            d = os.path.join(root, top, f'pkg{i // (FILES_PER_DIR * 50)}', f'mod{i // FILES_PER_DIR}')
+            os.makedirs(d, exist_ok=True)
+            for j in range(min(FILES_PER_DIR, count - i)):
+                name = f'file{j}.py' if j % 10 else f'file{j}.pyc'
+                with open(os.path.join(d, name), 'w') as f:
+                    f.write(name)
+    with open(os.path.join(root, 'important.log'), 'w') as f:
+        f.write('log')
+    with open(os.path.join(root, '.ebignore'), 'w') as f:
+        f.write(EBIGNORE)
+
+
+def walk_like_ebcli(root):
+    """ Listing every ignored path first and checking walked files against it, like ebcli does.
+    """
+    with open(os.path.join(root, '.ebignore')) as f:
+        spec = PathSpec.from_lines('gitwildmatch', f)
+    ignored = set(spec.match_tree_files(root))
+    shipped = []
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        reldir = os.path.relpath(dirpath, root)
+        reldir = '' if reldir == os.curdir else reldir.replace(os.sep, '/') + '/'
+        for name in sorted(files):
+            path = os.path.join(dirpath, name)
+            if name.endswith('~') or reldir + name in ignored or stat.S_ISSOCK(os.stat(path).st_mode):
+                continue
+            shipped.append(reldir + name)
+    return shipped
+
+
+def walk_like_ebi(root):
+    matcher = ignore.load(os.path.join(root, '.ebignore'))
+    return [relpath for relpath, _, _ in ignore.walk(root, matcher) if not relpath.endswith('/')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=500000, help='The number of files in the project')
+    parser.add_argument('--root', help='Directory to make the project in (kept after the run)')
+    parsed = parser.parse_args()
+
+    root = parsed.root or tempfile.mkdtemp(prefix='ebi-ignore-')
+    try:
+        if not os.path.exists(os.path.join(root, '.ebignore')):
+            start = time.perf_counter()
+            make_project(root, parsed.files)
+            print(f'Made {parsed.files} files in {time.perf_counter() - start:.1f}s on {root}')
+
+        start = time.perf_counter()
+        expected = walk_like_ebcli(root)
+        ebcli_time = time.perf_counter() - start
+        start = time.perf_counter()
+        actual = walk_like_ebi(root)
+        ebi_time = time.perf_counter() - start
+
+        print(f'ebcli: {ebcli_time:.2f}s, ebi: {ebi_time:.2f}s ({ebcli_time / ebi_time:.0f}x), '
+              f'{len(actual)} files shipped')
+        if actual != expected:
+            print('FAIL: shipped files differ')
+            sys.exit(1)
+    finally:
+        if not parsed.root:
+            shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+""" Measuring startup time of the ebi CLI with ``python -X importtime``.
+
+It fails when the import time of ``ebi --version`` exceeds the budget, or when modules
+which should be imported lazily (boto3, botocore, ebcli) are imported by it::
+
+    $ python benchmarks/startup.py
+    $ python benchmarks/startup.py --budget-ms 80 -- deploy --help
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+DEFAULT_BUDGET_MS = 100
+DEFAULT_RUNS = 5
+LAZY_MODULES = ('boto3', 'botocore', 'ebcli')
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+RUN_EBI = 'import sys; from ebi.core import main; sys.argv[0] = "ebi"; main()'
+
+
+def measure(args):
+    """ Running ``ebi`` with :param args: once.
+
+    :return: (total import microseconds, {module: cumulative microseconds}) tuple.
+    """
+    res = subprocess.run([sys.executable, '-X', 'importtime', '-c', RUN_EBI, *args],
+                         stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    total = 0
+    modules = {}
+    for line in res.stderr.splitlines():
+        m = IMPORTTIME_RE.match(line)
+        if not m:
+            continue
+        cumulative, indent, name = int(m.group(2)), len(m.group(3)), m.group(4)
+        modules[name] = cumulative
+        # Top level imports have a single space of indent. Nested ones are included in their cumulative time.
+        if indent == 1:
+            total += cumulative
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help='Maximum median import time in milliseconds')
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS)
+    parser.add_argument('--top', type=int, default=10, help='The number of slowest imports to show')
+    parser.add_argument('args', nargs='*', default=['--version'], help='Arguments of ebi (default: --version)')
+    parsed = parser.parse_args()
+
+    totals = []
+    modules = {}
+    for _ in range(parsed.runs):
+        total, modules = measure(parsed.args)
+        totals.append(total)
+    median_ms = statistics.median(totals) / 1000
+
+    print(f'ebi {" ".join(parsed.args)}: median import time {median_ms:.1f}ms over {parsed.runs} runs '
+          f'(budget {parsed.budget_ms:.0f}ms)')
+    for name, cumulative in sorted(modules.items(), key=lambda x: -x[1])[:parsed.top]:
+        print(f'  {cumulative / 1000:8.1f}ms  {name}')
+
+    failed = False
+    lazy = sorted(name for name in modules if name.split('.')[0] in LAZY_MODULES)
+    if lazy:
+        print(f'FAIL: imported lazily loaded modules: {", ".join(lazy[:5])}')
+        failed = True
+    if median_ms > parsed.budget_ms:
+        print(f'FAIL: {median_ms:.1f}ms exceeds the budget of {parsed.budget_ms:.0f}ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+""" Benchmarking bundling, uploading and whole deploy flows on synthetic projects.
+
+Projects of the given numbers of files are made with compressible sources, incompressible
+assets and ignored dependencies. Each case runs in its own process with an empty cache,
+against an in-memory stand-in of AWS (see ``fakeaws.py``), and reports:
+
+* wall_time: seconds the case took
+* peak_rss: peak resident memory in MiB, of the case and its compressing processes
+* bytes_written: bytes of files the case left in the project and the cache
+* bytes_uploaded: bytes sent to S3
+* api_calls: AWS API calls made
+
+Results are compared with a saved baseline, failing when a metric grows more than its threshold::
+
+    $ python benchmarks/suite.py --sizes 1000,10000 --save-baseline baseline.json
+    $ python benchmarks/suite.py --sizes 1000,10000 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, '..'))
+
+EBIGNORE = """\
+node_modules/
+*.log
+"""
+DOCKERRUN = '{"AWSEBDockerrunVersion": "1", "Image": {"Name": "example/app"}, "Ports": [{"ContainerPort": 80}]}\n'
+EB_CONFIG = """\
+global:
+  application_name: bench
+  default_region: us-east-1
+"""
+FILES_PER_DIR = 100
+# Kinds of files, their ratio in the project and their sizes in bytes.
+LAYOUT = (
+    ('src', 0.60, 2048, False),
+    ('assets', 0.15, 8192, True),
+    ('node_modules', 0.25, 2048, False),
+)
+WORDS = ('def', 'return', 'import', 'class', 'self', 'value', 'if', 'else', 'for', 'in', 'None', 'logger',
+         'request', 'response', 'data', '=', '(', ')', ':', 'True', 'False', 'name', 'path', 'config')
+
+OPERATIONS = ('make_version_file', 'upload_app_version', 'deploy', 'bgdeploy', 'clonedeploy')
+METRICS = ('wall_time', 'peak_rss', 'bytes_written', 'bytes_uploaded', 'api_calls')
+# Ratios each metric may grow from the baseline.
+DEFAULT_THRESHOLDS = {
+    'wall_time': 0.25,
+    'peak_rss': 0.25,
+    'bytes_written': 0.05,
+    'bytes_uploaded': 0.05,
+    'api_calls': 0,
+}
+# Growth ignored regardless of thresholds, so that tiny cases don't fail on noise.
+ABSOLUTE_SLACK = {
+    'wall_time': 0.05,
+    'peak_rss': 5,
+}
+
+APP_NAME = 'bench'
+
+
+def make_project(root, files, seed=0):
+    """ Making a project of :param files: files on :param root:, the same for the same :param seed:.
+    """
+    rng = random.Random(seed)
+    for top, ratio, size, incompressible in LAYOUT:
+        count = int(files * ratio)
+        for i in range(0, count, FILES_PER_DIR):
+            d = os.path.join(root, top, f'pkg{i // (FILES_PER_DIR * 50)}', f'mod{i // FILES_PER_DIR}')
+            os.makedirs(d, exist_ok=True)
+            for j in range(min(FILES_PER_DIR, count - i)):
+                if incompressible:
+                    with open(os.path.join(d, f'image{j}.png'), 'wb') as f:
+                        f.write(rng.randbytes(size))
+                else:
+                    text = ' '.join(rng.choice(WORDS) for _ in range(size // 5))
+                    with open(os.path.join(d, f'file{j}.py'), 'w') as f:
+                        f.write(text[:size])
+    os.makedirs(os.path.join(root, '.ebextensions'), exist_ok=True)
+    os.makedirs(os.path.join(root, '.elasticbeanstalk'), exist_ok=True)
+    for name, content in (('Dockerrun.aws.json', DOCKERRUN),
+                          ('.ebextensions/01.config', 'option_settings: []\n'),
+                          ('.elasticbeanstalk/config.yml', EB_CONFIG),
+                          ('debug.log', 'log\n'),
+                          ('.ebignore', EBIGNORE)):
+        with open(os.path.join(root, name), 'w') as f:
+            f.write(content)
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(dirpath, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def _peak_rss():
+    """ Peak RSS in MiB of this process and its waited children.
+    """
+    # ru_maxrss is in bytes on macOS, in KiB on Linux.
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / unit
+
+
+def _setup_fake_aws(latency):
+    import boto3
+    from ebi import clients
+    import fakeaws
+
+    boto3.setup_default_session(region_name='us-east-1', aws_access_key_id='fake', aws_secret_access_key='fake')
+    fake = fakeaws.FakeAWS(latency=latency)
+    fake.install(boto3._get_default_session())
+    clients.reset()
+    fake.add_environment(APP_NAME, 'bench-blue', APP_NAME, version='v0')
+    fake.add_environment(APP_NAME, 'bench-green', f'{APP_NAME}-green', version='v0')
+    return fake
+
+
+def _run_command(argv):
+    import importlib
+    from ebi import core
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    importlib.import_module(core.COMMANDS[argv[0]]).apply_args(subparsers.add_parser(argv[0]))
+    parsed = parser.parse_args(argv)
+    try:
+        parsed.func(parsed)
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError(f'{argv[0]} exited with {e.code}')
+
+
+def _make_version_file(jobs):
+    from ebi import appversion
+
+    if os.path.isfile('.ebignore'):
+        return appversion.make_version_file_with_ebignore('bench', jobs=jobs)
+    return appversion.make_version_file('bench', jobs=jobs)
+
+
+def run_case(operation, jobs, latency):
+    """ Running :param operation: in the project on the current directory, returning its metrics.
+    """
+    from ebi import appversion, clients
+
+    fake = _setup_fake_aws(latency)
+    common = ['--version', 'v1', '--jobs', str(jobs)]
+    commands = {
+        'deploy': ['deploy', APP_NAME, 'bench-blue'] + common,
+        'bgdeploy': ['bgdeploy', APP_NAME, 'bench-blue', 'bench-green', APP_NAME,
+                     '--capacity', '--capacity-interval', '0.01'] + common,
+        'clonedeploy': ['clonedeploy', APP_NAME, 'bench-next', APP_NAME] + common,
+    }
+    bundled_zip = None
+    if operation == 'upload_app_version':
+        bundled_zip = _make_version_file(jobs)
+
+    start = time.perf_counter()
+    if operation == 'make_version_file':
+        bundled_zip = _make_version_file(jobs)
+    elif operation == 'upload_app_version':
+        appversion.upload_app_version(APP_NAME, bundled_zip)
+    else:
+        _run_command(commands[operation])
+    wall_time = time.perf_counter() - start
+
+    metrics = {
+        'wall_time': wall_time,
+        'peak_rss': _peak_rss(),
+        'bytes_written': (os.path.getsize(bundled_zip) if operation == 'make_version_file' else 0)
+                         + _tree_size(os.environ['EBI_CACHE_DIR']),
+        'bytes_uploaded': fake.bytes_uploaded,
+        'api_calls': sum(clients.calls.values()),
+    }
+    if bundled_zip:
+        os.remove(bundled_zip)
+    return metrics
+
+
+def run_case_process(root, operation, ebignore, jobs, latency):
+    """ Running a case in a new process with an empty cache, returning its metrics.
+    """
+    cache_dir = tempfile.mkdtemp(prefix='ebi-bench-cache-')
+    ignore_path = os.path.join(root, '.ebignore')
+    if not ebignore:
+        os.rename(ignore_path, ignore_path + '.off')
+    try:
+        env = dict(os.environ, EBI_CACHE_DIR=cache_dir, PYTHONPATH=BENCHMARKS_DIR)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', operation,
+                              '--jobs', str(jobs), '--latency-ms', str(latency * 1000)],
+                             cwd=root, env=env, stdout=subprocess.PIPE, check=True).stdout
+        return json.loads(out.decode().splitlines()[-1])
+    finally:
+        if not ebignore:
+            os.rename(ignore_path + '.off', ignore_path)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+def compare(results, baseline, thresholds):
+    """ Returning messages of metrics in :param results: grown from :param baseline: beyond :param thresholds:.
+    """
+    regressions = []
+    for case, metrics in sorted(results.items()):
+        base = baseline.get(case)
+        if base is None:
+            continue
+        for metric in METRICS:
+            allowed = base[metric] * (1 + thresholds[metric]) + ABSOLUTE_SLACK.get(metric, 0)
+            if metrics[metric] > allowed:
+                regressions.append(f'{case}: {metric} {metrics[metric]:.6g} > {allowed:.6g} '
+                                   f'(baseline {base[metric]:.6g}, threshold {thresholds[metric]:.0%})')
+    return regressions
+
+
+def print_row(case, metrics):
+    print(f'{case:<40} {metrics["wall_time"]:>8.2f}s {metrics["peak_rss"]:>8.1f}MiB '
+          f'{metrics["bytes_written"] / 1024 / 1024:>9.2f}MiB {metrics["bytes_uploaded"] / 1024 / 1024:>9.2f}MiB '
+          f'{metrics["api_calls"]:>6d}', flush=True)
+
+
+def parse_thresholds(values):
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    for value in values:
+        metric, _, ratio = value.partition('=')
+        if metric not in thresholds:
+            raise argparse.ArgumentTypeError(f'Unknown metric {metric}')
+        thresholds[metric] = float(ratio)
+    return thresholds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma separated numbers of files in projects (up to 1000000)')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help=f'Comma separated operations to run, of {", ".join(OPERATIONS)}')
+    parser.add_argument('--jobs', type=int, default=1, help='The number of processes compressing bundles')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Milliseconds each fake AWS call takes')
+    parser.add_argument('--baseline', help='JSON file of results to compare with')
+    parser.add_argument('--save-baseline', help='JSON file to save results to')
+    parser.add_argument('--threshold', action='append', default=[], metavar='METRIC=RATIO',
+                        help='Ratio METRIC may grow from the baseline, e.g. wall_time=0.5')
+    parser.add_argument('--run-case', choices=OPERATIONS, help=argparse.SUPPRESS)
+    parsed = parser.parse_args()
+
+    if parsed.run_case:
+        print(json.dumps(run_case(parsed.run_case, parsed.jobs, parsed.latency_ms / 1000)))
+        return
+
+    thresholds = parse_thresholds(parsed.threshold)
+    operations = parsed.operations.split(',')
+    results = {}
+    print(f'{"CASE":<40} {"WALL":>9} {"PEAK RSS":>11} {"WRITTEN":>12} {"UPLOADED":>12} {"CALLS":>6}')
+    for size in (int(s) for s in parsed.sizes.split(',')):
+        root = tempfile.mkdtemp(prefix='ebi-bench-')
+        try:
+            make_project(root, size)
+            for ebignore in (False, True):
+                for operation in operations:
+                    case = f'{operation}-{size}' + ('-ebignore' if ebignore else '')
+                    results[case] = run_case_process(root, operation, ebignore, parsed.jobs,
+                                                     parsed.latency_ms / 1000)
+                    print_row(case, results[case])
+        finally:
+            shutil.rmtree(root)
+
+    if parsed.save_baseline:
+        with open(parsed.save_baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'platform': platform.platform(),
+                       'jobs': parsed.jobs, 'results': results}, f, indent=2, sort_keys=True)
+    if parsed.baseline:
+        with open(parsed.baseline) as f:
+            regressions = compare(results, json.load(f)['results'], thresholds)
+        for message in regressions:
+            print(f'REGRESSION {message}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
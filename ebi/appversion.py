@@ -1,24 +1,43 @@
+import contextlib
+import contextvars
 import logging
 import os
-import shutil
 import tempfile
-import zipfile
+import threading
 
-import boto3
 from ebcli.core import fileoperations
-from ebcli.lib import s3 as ebs3
-from ebcli.lib import elasticbeanstalk
-from ebcli.objects.exceptions import NotFoundError
+
+from . import cache, clients, s3upload, trace, tuning
+from .bundleindex import BundleIndex
+from .bundle import DOCKER_COMPOSE_NAME, DOCKEREXT_NAME, DOCKERRUN_NAME  # noqa: F401
+from .bundle import hash_bundle_members, iter_bundle_members, write_bundle
 
 logger = logging.getLogger('ebi')
 
+# Directory to make bundles in instead of the current one, set by ``ebi serve`` for each request.
+# The working directory is shared by threads, so members of bundles are listed in it one at a time.
+project_dir = contextvars.ContextVar('ebi_project_dir', default=None)
+_chdir_lock = threading.Lock()
+
+
+class BundleCancelled(Exception):
+    pass
+
+
+def _check_cancel(cancel):
+    if cancel is not None and cancel.is_set():
+        raise BundleCancelled('Making the application version was cancelled')
+
 
-DOCKERRUN_NAME = 'Dockerrun.aws.json'
-DOCKER_COMPOSE_NAME = 'docker-compose.yml'
-DOCKEREXT_NAME = '.ebextensions/'
+def _cancellable(members, cancel):
+    """ Iterating :param members: until :param cancel: (``threading.Event``) is set.
+    """
+    for member in members:
+        _check_cancel(cancel)
+        yield member
 
 
-def make_version_file_with_ebignore(version_label, dockerrun=None, docker_compose=None, ebext=None):
+def make_version_file_with_ebignore(version_label, dockerrun=None, docker_compose=None, ebext=None, jobs=1):
     """ Making zip file to upload for ElasticBeanstalk based on ebignore
 
     :param version_label: will be name of the created zip file
@@ -27,53 +46,14 @@ def make_version_file_with_ebignore(version_label, dockerrun=None, docker_compos
     * Including :param docker_compose: file as docker-compose.yml (for Amazon linux2)
     * Including :param ebext: directory as .ebextensions/
 
+    :param jobs: the number of processes compressing files
     :return: File path to created zip file (current directory).
     """
-    ebext = ebext or DOCKEREXT_NAME
-
-    tempd = tempfile.mkdtemp()
-    try:
-        ignore_files = fileoperations.get_ebignore_list()
-
-        # Dockerrun, docker-compose and ebextensions files are added to zip file later.
-        ignore_files |= {DOCKERRUN_NAME, DOCKER_COMPOSE_NAME}
-        ignore_ebext_files = set()
-        if os.path.isdir(DOCKEREXT_NAME):
-            for file in os.listdir(DOCKEREXT_NAME):
-                ebext_file_path = os.path.join(DOCKEREXT_NAME, file)
-                if os.path.isfile(ebext_file_path):
-                    ignore_ebext_files.add(ebext_file_path)
-        ignore_files |= ignore_ebext_files
-
-        zip_filename = f"{version_label}.zip"
-        temp_zip_path = os.path.join(tempd, zip_filename)
-        fileoperations.zip_up_project(temp_zip_path, ignore_list=ignore_files)
-        shutil.copyfile(temp_zip_path, zip_filename)
-
-        logger.info(f'Adding {DOCKERRUN_NAME}, {DOCKER_COMPOSE_NAME}, {DOCKEREXT_NAME} to archive.')
-        with zipfile.ZipFile(zip_filename, 'a', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as f:
-            if os.path.isdir(ebext):
-                for file in os.listdir(ebext):
-                    source_ebext_file_path = os.path.join(ebext, file)
-                    target_ebext_file_path = os.path.join(DOCKEREXT_NAME, file)
-                    if os.path.isfile(source_ebext_file_path):
-                        f.write(source_ebext_file_path, arcname=target_ebext_file_path)
-
-            if docker_compose:
-                f.write(docker_compose, arcname=DOCKER_COMPOSE_NAME)
-                if dockerrun:
-                    f.write(dockerrun, arcname=DOCKERRUN_NAME)
-            else:
-                dockerrun = dockerrun or DOCKERRUN_NAME
-                f.write(dockerrun, arcname=DOCKERRUN_NAME)
-
-        return zip_filename
-
-    finally:
-        shutil.rmtree(tempd)
+    members = iter_bundle_members(dockerrun, docker_compose, ebext, root=fileoperations.get_project_root())
+    return write_bundle(f"{version_label}.zip", members, jobs=jobs)
 
 
-def make_version_file(version_label, dockerrun=None, docker_compose=None, ebext=None):
+def make_version_file(version_label, dockerrun=None, docker_compose=None, ebext=None, jobs=1):
     """ Making zip file to upload for ElasticBeanstalk
 
     :param version_label: will be name of the created zip file
@@ -82,68 +62,344 @@ def make_version_file(version_label, dockerrun=None, docker_compose=None, ebext=
     * Including :param docker_compose: file as docker-compose.yml (for Amazon linux2)
     * Including :param ebext: directory as .ebextensions/
 
+    :param jobs: the number of processes compressing files
     :return: File path to created zip file (current directory).
     """
-    dockerrun = dockerrun or DOCKERRUN_NAME
-
-    ebext = ebext or DOCKEREXT_NAME
-
-    tempd = tempfile.mkdtemp()
-    try:
-        if os.path.isdir(ebext):
-            deploy_ebext = os.path.join(tempd, DOCKEREXT_NAME)
-            shutil.copytree(ebext, deploy_ebext)
-
-        # docker-compose takes precedence over dockerrun
-        if docker_compose:
-            deploy_docker_compose = os.path.join(tempd, DOCKER_COMPOSE_NAME)
-            shutil.copyfile(docker_compose, deploy_docker_compose)
-        else:
-            deploy_dockerrun = os.path.join(tempd, DOCKERRUN_NAME)
-            shutil.copyfile(dockerrun, deploy_dockerrun)
-
-        return shutil.make_archive(version_label, 'zip', root_dir=tempd)
-    finally:
-        shutil.rmtree(tempd)
+    members = iter_bundle_members(dockerrun, docker_compose, ebext)
+    return write_bundle(os.path.abspath(f"{version_label}.zip"), members, jobs=jobs)
 
 
-def upload_app_version(app_name, bundled_zip):
+def upload_app_version(app_name, bundled_zip, key=None,
+                       concurrency=s3upload.DEFAULT_CONCURRENCY, part_size=s3upload.DEFAULT_PART_SIZE, cancel=None):
     """ Uploading zip file of app version to S3
     :param app_name: application name to deploy
     :param bundled_zip: String path to zip file
+    :param key: S3 key to upload. default is the zip file name under :param app_name:.
+    :param concurrency: the number of parts uploaded at once
+    :param part_size: size of multipart upload parts in MiB
+    :param cancel: ``threading.Event`` stopping the upload when it's set.
     :return: bucket name and key for file (as tuple).
     """
-    bucket = elasticbeanstalk.get_storage_location()
-    key = f'{app_name}/{os.path.basename(bundled_zip)}'
-    try:
-        ebs3.get_object_info(bucket, key)
-        logger.warning('S3 object already exists at %s. Skipping upload and reusing the existing object; '
-                       'it may not match your local bundle.', key)
-    except NotFoundError:
-        logger.info(f'Uploading archive to s3 location: {key}')
-        ebs3.upload_application_version(bucket, key, bundled_zip)
+    bucket = get_storage_location()
+    if key:
+        # Keys are content-addressed, so an existing object has the same contents.
+        exists_message = 'S3 object already exists at %s. Skipping upload.'
+    else:
+        key = f'{app_name}/{os.path.basename(bundled_zip)}'
+        exists_message = ('S3 object already exists at %s. Skipping upload and reusing the existing object; '
+                          'it may not match your local bundle.')
+    with trace.span('upload', key=key) as span:
+        if s3_object_exists(bucket, key):
+            logger.warning(exists_message, key)
+            span.set(bytes=0)
+        else:
+            logger.info(f'Uploading archive to s3 location: {key}')
+            stats = s3upload.upload_file(bucket, key, bundled_zip, concurrency=concurrency,
+                                         part_size=part_size * 1024 * 1024, cancel=cancel)
+            span.set(bytes=stats['bytes'])
+            tuning.record_upload(stats['bytes'], stats['seconds'])
     return bucket, key
 
 
-def make_application_version(app_name, version, dockerrun, docker_compose, ebext, description):
-    if os.path.isfile(".ebignore"):
-        bundled_zip = make_version_file_with_ebignore(version, dockerrun=dockerrun, docker_compose=docker_compose, ebext=ebext)
-    else:
-        logger.info('.ebignore does not exist. Make a version file not using ebignore')
-        bundled_zip = make_version_file(version, dockerrun=dockerrun, docker_compose=docker_compose, ebext=ebext)
+def get_storage_location(region_name=None):
+    """ Returning the S3 bucket Elastic Beanstalk stores application versions in, creating it at first.
+    """
+    return clients.get_client('elasticbeanstalk', region_name).create_storage_location()['S3Bucket']
+
+
+def s3_object_exists(bucket, key, region_name=None):
+    res = clients.get_client('s3', region_name).list_objects_v2(Bucket=bucket, Prefix=key, MaxKeys=1)
+    return any(obj['Key'] == key for obj in res.get('Contents', []))
+
+
+def stream_app_version(bucket, key, members, jobs=1,
+                       concurrency=s3upload.DEFAULT_CONCURRENCY, part_size=s3upload.DEFAULT_PART_SIZE, index=None,
+                       cancel=None, level=None):
+    """ Building the bundle of :param members: straight into S3 :param bucket: and :param key:
+
+    Compression and upload overlap. Memory is bounded to twice :param concurrency: parts
+    of :param part_size: MiB. Members not changed from the previous bundle in :param index:
+    are copied from it. The upload is aborted when :param cancel: (``threading.Event``) is set.
+    Files are deflated at :param level: (0 stores them, None is the default).
+    """
+    logger.info(f'Streaming archive to s3 location: {key}')
+    previous = index and index.previous_bundle(level)
     try:
-        bucket, key = upload_app_version(app_name, bundled_zip)
-
-        logger.info('Creating application version')
-        eb = boto3.client('elasticbeanstalk')
-        eb.create_application_version(
-            ApplicationName=app_name,
-            VersionLabel=version,
-            Description=description,
-            SourceBundle={
-                'S3Bucket': bucket,
-                'S3Key': key,
-            }
-        )
+        with trace.span('stream', key=key) as span, \
+                s3upload.MultipartWriter(bucket, key, concurrency=concurrency,
+                                         part_size=part_size * 1024 * 1024) as out:
+            write_bundle(out, _cancellable(members, cancel), jobs=jobs, previous=previous, level=level)
+            span.set(bytes=out.tell())
     finally:
-        os.remove(bundled_zip)
+        if previous:
+            previous.close()
+
+
+def find_application_version(eb, app_name, key):
+    """ Finding label of an application version of :param app_name: whose source bundle is :param key:.
+    """
+    paginator = eb.get_paginator('describe_application_versions')
+    for page in paginator.paginate(ApplicationName=app_name):
+        for v in page['ApplicationVersions']:
+            if v.get('SourceBundle', {}).get('S3Key') == key and v.get('Status') != 'FAILED':
+                return v['VersionLabel']
+    return None
+
+
+def build_bundle(digest, members, cache_size, jobs=1, index=None, cancel=None, level=None):
+    """ Building the bundle for :param digest: or reusing the cached one.
+
+    :param cache_size: local bundle cache size in MiB. 0 disables the cache.
+    :param jobs: the number of processes compressing files.
+    :param index: ``BundleIndex`` of the project. Members not changed from the previous bundle
+                  are copied from it.
+    :param cancel: ``threading.Event`` stopping the build when it's set.
+    :param level: deflate level of files. 0 stores them, None is the default.
+    :return: (zip path, whether the zip is temporary) tuple.
+    """
+    with trace.span('bundle') as span:
+        if cache_size:
+            cached = cache.lookup_bundle(digest)
+            if cached:
+                logger.info('Reusing cached bundle %s', cached)
+                span.set(cached=True, bytes=os.path.getsize(cached))
+                return cached, False
+
+        directory = cache.get_cache_dir('bundles') if cache_size else project_dir.get() or '.'
+        fd, zip_path = tempfile.mkstemp(suffix=cache.TEMP_SUFFIX, dir=directory)
+        os.close(fd)
+        previous = index and index.previous_bundle(level)
+        try:
+            write_bundle(zip_path, _cancellable(members, cancel), jobs=jobs, previous=previous, level=level)
+        except BaseException:
+            os.remove(zip_path)
+            raise
+        finally:
+            if previous:
+                previous.close()
+        span.set(cached=False, bytes=os.path.getsize(zip_path))
+    if cache_size:
+        return cache.store_bundle(digest, zip_path, cache_size * 1024 * 1024), False
+    return zip_path, True
+
+
+@contextlib.contextmanager
+def _in_project_dir():
+    """ Changing the working directory to ``project_dir`` in the ``with`` block, when it's set.
+    """
+    path = project_dir.get()
+    if path is None:
+        yield
+        return
+    with _chdir_lock:
+        previous = os.getcwd()
+        os.chdir(path)
+        try:
+            yield
+        finally:
+            os.chdir(previous)
+
+
+def make_application_versions(app_names, version, dockerrun, docker_compose, ebext, description, **kwargs):
+    """ Making the application version :param version: for each of :param app_names: from one bundle.
+
+    The bundle is keyed by the digest of its contents. If the same contents were already
+    uploaded or registered as an application version, these are reused.
+    It's built and uploaded once, under the first application, and the others share the object.
+    With :param stream:, a bundle not in the local cache is uploaded while it's being built,
+    without writing it to a local file.
+    :param compression: deflate level of files (0 stores them), ``'auto'`` to choose the level
+    by ``tuning.choose_level``, or None for the default.
+    It stops with ``BundleCancelled`` (or ``s3upload.UploadError``) when :param cancel: (``threading.Event``) is set,
+    e.g. because a step running alongside failed.
+
+    Files are read from ``project_dir`` when it's set, or from the current directory.
+
+    :return: dict of application name to the version label to deploy (the existing one when it's reused).
+    """
+    return _make_application_versions(app_names, version, dockerrun, docker_compose, ebext, description, **kwargs)
+
+
+def list_bundle_members(dockerrun, docker_compose, ebext):
+    """ Listing members of the bundle of the current directory, the project not ignored by
+    ``.ebignore`` when it exists (like ``make_version_file_with_ebignore``), or ``make_version_file``'s.
+
+    :return: (members, project root or None without ``.ebignore``) tuple.
+    """
+    use_ebignore = os.path.isfile(".ebignore")
+    if not use_ebignore:
+        logger.info('.ebignore does not exist. Make a version file not using ebignore')
+    root = fileoperations.get_project_root() if use_ebignore else None
+    return list(iter_bundle_members(dockerrun, docker_compose, ebext, root=root)), root
+
+
+def _hash_members(dockerrun, docker_compose, ebext):
+    """ Listing members of the bundle of ``project_dir`` (or the current directory) and hashing these.
+
+    Only listing is done in the directory. Paths of members are absolute, so the rest of making
+    the version doesn't depend on the working directory, and runs of ``ebi serve`` go on at once.
+
+    :return: (members, ``BundleIndex``, digest) tuple.
+    """
+    with trace.span('hash') as span:
+        with _in_project_dir():
+            members, root = list_bundle_members(dockerrun, docker_compose, ebext)
+            members = [(arcname, os.path.abspath(path), kind) for arcname, path, kind in members]
+            index = BundleIndex(root or os.getcwd())
+        digest = hash_bundle_members(members, file_hash=index.file_hash)
+        span.set(files=len(members))
+    index.log_stats()
+    logger.info('Bundle digest is %s', digest)
+    return members, index, digest
+
+
+def _upload_members(app_name, bucket, key, members, index, digest, cache_size=cache.DEFAULT_BUNDLE_CACHE_SIZE, jobs=1,
+                    upload_concurrency=s3upload.DEFAULT_CONCURRENCY, part_size=s3upload.DEFAULT_PART_SIZE,
+                    stream=False, cancel=None, compression=None):
+    """ Building the bundle of :param members: and uploading it to :param bucket: and :param key:
+    unless it's there already.
+    """
+    bundled_zip = temporary = None
+    built = False
+    level = None
+    if s3_object_exists(bucket, key):
+        logger.info('S3 object already exists at %s. Skipping build and upload.', key)
+    else:
+        cached = bool(cache_size and cache.lookup_bundle(digest))
+        level = None if compression == 'auto' else compression
+        if compression == 'auto' and not cached:
+            with trace.span('tune') as span:
+                level = tuning.choose_level(members, jobs=jobs, overlap=stream)
+                span.set(level=level)
+        if stream and not cached:
+            stream_app_version(bucket, key, members, jobs=jobs, concurrency=upload_concurrency, part_size=part_size,
+                               index=index, cancel=cancel, level=level)
+        else:
+            bundled_zip, temporary = build_bundle(digest, members, cache_size, jobs=jobs, index=index, cancel=cancel,
+                                                  level=level)
+            built = not cached
+    # A cached bundle may have been deflated at another level, so only a bundle built now is recorded.
+    index.save(members, bundle_path=bundled_zip if built and not temporary else None, level=level)
+
+    if bundled_zip:
+        try:
+            upload_app_version(app_name, bundled_zip, key=key, concurrency=upload_concurrency,
+                               part_size=part_size, cancel=cancel)
+        finally:
+            if temporary:
+                os.remove(bundled_zip)
+
+
+def find_application_versions(eb, app_names, key, version):
+    """ Finding versions of :param app_names: whose source bundle is :param key:, to reuse these
+    instead of making :param version:.
+
+    :return: dict of application name to the version label found.
+    """
+    versions = {}
+    for app_name in app_names:
+        existing = find_application_version(eb, app_name, key)
+        if existing:
+            logger.info('Application version %s of %s has the same bundle. Reusing it instead of %s',
+                        existing, app_name, version)
+            versions[app_name] = existing
+    return versions
+
+
+def _create_application_versions(eb, app_names, version, description, bucket, key):
+    for app_name in app_names:
+        logger.info('Creating application version for %s', app_name)
+        with trace.span('create_application_version', app=app_name):
+            eb.create_application_version(
+                ApplicationName=app_name,
+                VersionLabel=version,
+                Description=description,
+                SourceBundle={
+                    'S3Bucket': bucket,
+                    'S3Key': key,
+                }
+            )
+    return {app_name: version for app_name in app_names}
+
+
+def _make_application_versions(app_names, version, dockerrun, docker_compose, ebext, description, cancel=None,
+                               **bundle_options):
+    members, index, digest = _hash_members(dockerrun, docker_compose, ebext)
+    _check_cancel(cancel)
+    key = f'{app_names[0]}/{digest}.zip'
+
+    eb = clients.get_client('elasticbeanstalk')
+    versions = find_application_versions(eb, app_names, key, version)
+    if len(versions) == len(app_names):
+        index.save(members)
+        return versions
+
+    bucket = get_storage_location()
+    _upload_members(app_names[0], bucket, key, members, index, digest, cancel=cancel, **bundle_options)
+
+    _check_cancel(cancel)
+    versions.update(_create_application_versions(eb, [app_name for app_name in app_names if app_name not in versions],
+                                                 version, description, bucket, key))
+    return versions
+
+
+def upload_bundle(app_name, dockerrun, docker_compose, ebext, cancel=None, **bundle_options):
+    """ Making the bundle and uploading it under :param app_name: to the storage bucket of the region
+    of the session, unless it's there already.
+
+    See ``make_application_versions`` for other parameters.
+
+    :return: bucket name and key of the bundle (as tuple).
+    """
+    members, index, digest = _hash_members(dockerrun, docker_compose, ebext)
+    _check_cancel(cancel)
+    key = f'{app_name}/{digest}.zip'
+    bucket = get_storage_location()
+    _upload_members(app_name, bucket, key, members, index, digest, cancel=cancel, **bundle_options)
+    return bucket, key
+
+
+def copy_bundle(bucket, key, region_name, concurrency=s3upload.DEFAULT_CONCURRENCY,
+                part_size=s3upload.DEFAULT_PART_SIZE, cancel=None):
+    """ Copying the bundle on :param bucket: and :param key: to the storage bucket of :param region_name:
+    on the S3 side, unless it's there already.
+
+    :param concurrency: the number of parts copied at once
+    :param part_size: size of multipart copy parts in MiB
+    :return: bucket name in :param region_name:.
+    """
+    destination = get_storage_location(region_name)
+    with trace.span('copy', region=region_name, key=key) as span:
+        if s3_object_exists(destination, key, region_name=region_name):
+            logger.info('S3 object already exists at %s in %s. Skipping copy.', key, region_name)
+            span.set(bytes=0)
+        else:
+            logger.info('Copying %s to %s', key, region_name)
+            stats = s3upload.copy_object(bucket, key, destination, region_name=region_name, concurrency=concurrency,
+                                         part_size=part_size * 1024 * 1024, cancel=cancel)
+            span.set(bytes=stats['bytes'])
+    return destination
+
+
+def create_application_versions(app_names, version, description, bucket, key, region_name=None):
+    """ Making :param version: of each of :param app_names: in :param region_name: from the bundle
+    on :param bucket: and :param key:. Versions having the bundle already are reused.
+
+    :return: dict of application name to the version label to deploy.
+    """
+    eb = clients.get_client('elasticbeanstalk', region_name)
+    versions = find_application_versions(eb, app_names, key, version)
+    versions.update(_create_application_versions(eb, [app_name for app_name in app_names if app_name not in versions],
+                                                 version, description, bucket, key))
+    return versions
+
+
+def make_application_version(app_name, version, dockerrun, docker_compose, ebext, description, **kwargs):
+    """ Making the application version :param version: for :param app_name:
+
+    See ``make_application_versions`` for :param kwargs:.
+
+    :return: Version label to deploy (the existing one when it's reused).
+    """
+    return make_application_versions([app_name], version, dockerrun, docker_compose, ebext, description,
+                                     **kwargs)[app_name]
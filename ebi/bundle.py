@@ -0,0 +1,226 @@
+import hashlib
+import logging
+import os
+import shutil
+import stat
+import zipfile
+
+from . import compress, ignore
+
+logger = logging.getLogger(__name__)
+
+
+DOCKERRUN_NAME = 'Dockerrun.aws.json'
+DOCKER_COMPOSE_NAME = 'docker-compose.yml'
+DOCKEREXT_NAME = '.ebextensions/'
+EBIGNORE_NAME = '.ebignore'
+
+# Fixed timestamp for every zip entry, so the same inputs always make the same bundle.
+BUNDLE_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+# The "magic" external attribute ebcli uses for symlink entries (S_IFLNK | 0755).
+SYMLINK_ATTR = 0xA1ED0000
+# Size of the buffer members are streamed through. Memory use doesn't depend on file sizes.
+BUFFER_SIZE = 1024 * 1024
+
+MEMBER_FILE = 'file'
+MEMBER_DIR = 'dir'
+MEMBER_LINK = 'link'
+# Compressed data copied from a previous bundle. The source is (ZipFile, ZipInfo) instead of a path.
+MEMBER_RAW = 'raw'
+
+
+def load_ebignore(root):
+    """ Loading ``.ebignore`` on :param root: as a matcher of project relative paths.
+    """
+    return ignore.load(os.path.join(root, EBIGNORE_NAME))
+
+
+def _walk_project(root, matcher, replaced):
+    """ Yielding (arcname, path, kind) for the project like ``fileoperations.zip_up_project`` does.
+
+    Editor backup files, sockets, files matched by :param matcher: or in :param replaced: and
+    the ``.elasticbeanstalk`` directory are skipped. A directory entry is added for every directory
+    having files. Directories and files are visited in sorted order, and directories whose contents
+    are all ignored are not walked.
+    """
+    for arcname, path, is_link in ignore.walk(root, matcher, replaced.__contains__):
+        if arcname.endswith('/'):
+            yield arcname, path, MEMBER_DIR
+        else:
+            yield arcname, path, MEMBER_LINK if is_link else MEMBER_FILE
+
+
+def _walk_ebext(ebext):
+    """ Yielding members of :param ebext: as ``.ebextensions/``. Symlinked directories are followed
+    like ``shutil.copytree`` did, except those leading back to a directory being walked.
+    """
+    yield DOCKEREXT_NAME, ebext, MEMBER_DIR
+    walking = {}
+    for dirpath, dirs, files in os.walk(ebext, followlinks=True):
+        depth = dirpath.count(os.sep)
+        walking = {path: d for path, d in walking.items() if d < depth}
+        walking[os.path.realpath(dirpath)] = depth
+        dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(dirpath, d)) not in walking)
+        reldir = os.path.relpath(dirpath, ebext)
+        reldir = DOCKEREXT_NAME if reldir == os.curdir else DOCKEREXT_NAME + reldir.replace(os.sep, '/') + '/'
+        for d in dirs:
+            yield reldir + d + '/', os.path.join(dirpath, d), MEMBER_DIR
+        for f in sorted(files):
+            yield reldir + f, os.path.join(dirpath, f), MEMBER_FILE
+
+
+def iter_bundle_members(dockerrun=None, docker_compose=None, ebext=None, root=None):
+    """ Iterating members of the zip file to upload for ElasticBeanstalk
+
+    * With :param root:, files of the project on it not ignored by ``.ebignore`` are included
+    * Including :param dockerrun: file as Dockerrun.aws.json
+    * Including :param docker_compose: file as docker-compose.yml (for Amazon linux2)
+    * Including :param ebext: directory as .ebextensions/
+
+    The project is walked lazily, only once, in a deterministic order.
+
+    :return: Iterator of (arcname, path, kind) tuples.
+    """
+    ebext = ebext or DOCKEREXT_NAME
+
+    if root is not None:
+        matcher = load_ebignore(root)
+
+        # Dockerrun, docker-compose and ebextensions files are replaced by given ones.
+        replaced = {EBIGNORE_NAME, DOCKERRUN_NAME, DOCKER_COMPOSE_NAME}
+        if os.path.isdir(DOCKEREXT_NAME):
+            for file in os.listdir(DOCKEREXT_NAME):
+                if os.path.isfile(os.path.join(DOCKEREXT_NAME, file)):
+                    replaced.add(DOCKEREXT_NAME + file)
+
+        yield from _walk_project(root, matcher, replaced)
+
+        if os.path.isdir(ebext):
+            for file in sorted(os.listdir(ebext)):
+                path = os.path.join(ebext, file)
+                if os.path.isfile(path):
+                    yield DOCKEREXT_NAME + file, path, MEMBER_FILE
+
+        if docker_compose:
+            yield DOCKER_COMPOSE_NAME, docker_compose, MEMBER_FILE
+            if dockerrun:
+                yield DOCKERRUN_NAME, dockerrun, MEMBER_FILE
+        else:
+            yield DOCKERRUN_NAME, dockerrun or DOCKERRUN_NAME, MEMBER_FILE
+    else:
+        if os.path.isdir(ebext):
+            yield from _walk_ebext(ebext)
+
+        # docker-compose takes precedence over dockerrun
+        if docker_compose:
+            yield DOCKER_COMPOSE_NAME, docker_compose, MEMBER_FILE
+        else:
+            yield DOCKERRUN_NAME, dockerrun or DOCKERRUN_NAME, MEMBER_FILE
+
+
+def _is_executable(path):
+    return bool(os.stat(path).st_mode & stat.S_IXUSR)
+
+
+def _sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(BUFFER_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_bundle_members(members, file_hash=_sha256_file):
+    """ Calculating content digest of :param members: (from ``iter_bundle_members``).
+
+    Only arcnames, executable bits and contents are hashed, so the digest doesn't depend on
+    the machine or time the bundle is built.
+
+    :param file_hash: function returning sha256 hex digest of a file (e.g. ``BundleIndex.file_hash``).
+    """
+    digest = hashlib.sha256()
+    for arcname, path, kind in members:
+        digest.update(f'{kind}\0{arcname}\0'.encode())
+        if kind == MEMBER_LINK:
+            digest.update(os.readlink(path).encode())
+        elif kind == MEMBER_FILE:
+            digest.update(b'x' if _is_executable(path) else b'-')
+            digest.update(file_hash(path).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _file_attr(path):
+    return (stat.S_IFREG | (0o755 if _is_executable(path) else 0o644)) << 16
+
+
+def make_zipinfo(arcname, path, kind, level=None):
+    """ Making the zip entry of a member. :param level: of deflate, 0 to store files, or None for the default.
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time=BUNDLE_DATE_TIME)
+    zinfo.create_system = 3
+    if kind == MEMBER_DIR:
+        zinfo.external_attr = (stat.S_IFDIR | 0o755) << 16 | 0x10
+    elif kind == MEMBER_LINK:
+        zinfo.external_attr = SYMLINK_ATTR
+    else:
+        zinfo.external_attr = _file_attr(path)
+        if kind == MEMBER_FILE:
+            zinfo.file_size = os.path.getsize(path)
+            if level == 0:
+                zinfo.compress_type = zipfile.ZIP_STORED
+            else:
+                zinfo.compress_type = compress.choose_compress_type(path, zinfo.file_size)
+                zinfo._compresslevel = level
+    return zinfo
+
+
+def write_member(zf, zinfo, path, kind):
+    """ Streaming a member from :param path: to :param zf: through a fixed size buffer.
+    """
+    if kind == MEMBER_DIR:
+        zf.writestr(zinfo, b'')
+    elif kind == MEMBER_LINK:
+        zf.writestr(zinfo, os.readlink(path))
+    elif kind == MEMBER_RAW:
+        compress.copy_raw_member(zf, zinfo, *path)
+    else:
+        with open(path, 'rb') as src, zf.open(zinfo, 'w') as dest:
+            shutil.copyfileobj(src, dest, BUFFER_SIZE)
+
+
+def write_bundle(output, members, jobs=1, previous=None, level=None):
+    """ Writing :param members: to :param output: in a single pass.
+
+    Every member is streamed from its source straight to its final arcname, with fixed
+    timestamps and permissions. Already compressed files are stored as they are.
+
+    :param output: File path or writable file object (it doesn't need to be seekable).
+    :param jobs: The number of processes deflating members. With 1, members are deflated
+                 in this process through a fixed size buffer.
+    :param previous: ``bundleindex.PreviousBundle``. Files not changed from it are copied
+                     from it as they are compressed, without compressing these again.
+    :param level: Deflate level (see ``tuning``). 0 stores files. None uses the zlib default.
+    :return: :param output:
+    """
+    output_path = os.path.abspath(output) if isinstance(output, (str, os.PathLike)) else None
+
+    def entries():
+        for arcname, path, kind in members:
+            if kind == MEMBER_FILE:
+                if os.path.abspath(path) == output_path:
+                    # The output itself may show up while walking the project.
+                    continue
+                info = previous and previous.find(arcname, path, _file_attr(path))
+                if info:
+                    yield make_zipinfo(arcname, path, MEMBER_RAW), (previous.zf, info), MEMBER_RAW
+                    continue
+            yield make_zipinfo(arcname, path, kind, level), path, kind
+
+    with zipfile.ZipFile(output, 'w', compression=zipfile.ZIP_DEFLATED, allowZip64=True) as f:
+        if jobs > 1:
+            compress.write_parallel(f, entries(), jobs, write_member, MEMBER_FILE, level=level)
+        else:
+            for zinfo, path, kind in entries():
+                write_member(f, zinfo, path, kind)
+    return output
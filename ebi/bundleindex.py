@@ -0,0 +1,151 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import zipfile
+
+from . import cache
+
+logger = logging.getLogger(__name__)
+
+
+INDEX_VERSION = 1
+# Files modified this close to the time the index was written may change again without
+# their mtime changing (like git's "racily clean" entries), so these are always hashed.
+RACY_WINDOW_NS = 2 * 1000 ** 3
+
+
+def _sha256_file(path, buffer_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(buffer_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class BundleIndex:
+    """ Persistent per-project index of file contents, like git's index.
+
+    Files are keyed on path, size, mtime and inode. While these don't change,
+    the content hash recorded last time is used instead of reading the file.
+    The index also remembers the last bundle built for the project and the hashes
+    of its members, so that unchanged members can be copied from it.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        name = hashlib.sha256(self.root.encode()).hexdigest()[:16]
+        self.path = os.path.join(cache.get_cache_dir('index'), f'{name}.json')
+        self.files = {}
+        self.bundle = None
+        self.written_ns = 0
+        self.hashed = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == INDEX_VERSION:
+            self.files = data['files']
+            self.bundle = data['bundle']
+            self.written_ns = data['written_ns']
+
+    def file_hash(self, path):
+        """ Returning sha256 hex digest of the file on :param path:, from the index when it's unchanged.
+        """
+        path = os.path.abspath(path)
+        if path in self.hashed:
+            return self.hashed[path]
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        entry = self.files.get(path)
+        if entry and entry[:3] == stamp and st.st_mtime_ns < self.written_ns - RACY_WINDOW_NS:
+            self.hits += 1
+            digest = entry[3]
+        else:
+            self.misses += 1
+            digest = _sha256_file(path)
+            self.files[path] = stamp + [digest]
+        self.hashed[path] = digest
+        return digest
+
+    def previous_bundle(self, level=None):
+        """ Returning the last bundle built for the project as ``PreviousBundle``, or None.
+
+        Members of a bundle deflated at another level than :param level: (0 stores files) aren't
+        what a new bundle would have, so it's None then, and the bundle is built from scratch.
+        """
+        if not self.bundle or not os.path.isfile(self.bundle['path']):
+            return None
+        if 'level' not in self.bundle or self.bundle['level'] != level:
+            logger.info('Compression level changed from the previous bundle, compressing all members')
+            return None
+        try:
+            return PreviousBundle(self, self.bundle['path'], self.bundle['members'])
+        except (OSError, zipfile.BadZipFile):
+            return None
+
+    def save(self, members, bundle_path=None, level=None):
+        """ Saving the index, recording :param bundle_path: as the last bundle of :param members:
+        deflated at :param level:.
+        """
+        paths = {os.path.abspath(path) for _, path, _ in members}
+        self.files = {path: entry for path, entry in self.files.items() if path in paths}
+        if bundle_path:
+            self.bundle = {
+                'path': bundle_path,
+                'level': level,
+                'members': {arcname: self.files[os.path.abspath(path)][3]
+                            for arcname, path, _ in members if os.path.abspath(path) in self.files},
+            }
+        data = {'version': INDEX_VERSION, 'files': self.files, 'bundle': self.bundle, 'written_ns': time.time_ns()}
+        tmp = f'{self.path}.{os.getpid()}'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+
+    def log_stats(self):
+        total = self.hits + self.misses
+        if total:
+            logger.info('Bundle index: %d/%d files unchanged (%.0f%% hit rate)',
+                        self.hits, total, 100 * self.hits / total)
+
+
+class PreviousBundle:
+    """ The last bundle built for a project, to copy unchanged compressed members from.
+    """
+
+    def __init__(self, index, path, hashes):
+        self.index = index
+        self.zf = zipfile.ZipFile(path)
+        self.hashes = hashes
+        self.reused = 0
+        self.reused_bytes = 0
+        self.recompressed = 0
+        self.recompressed_bytes = 0
+
+    def find(self, arcname, path, external_attr):
+        """ Returning ZipInfo of :param arcname: in the previous bundle when its content didn't change.
+        """
+        try:
+            info = self.zf.getinfo(arcname)
+        except KeyError:
+            info = None
+        if (info is not None and info.external_attr == external_attr
+                and self.hashes.get(arcname) == self.index.file_hash(path)):
+            self.reused += 1
+            self.reused_bytes += info.file_size
+            return info
+        self.recompressed += 1
+        self.recompressed_bytes += os.path.getsize(path)
+        return None
+
+    def close(self):
+        self.zf.close()
+        total = self.reused + self.recompressed
+        if total:
+            logger.info('Incremental bundle: reused %d/%d members (%.0f%%), %d bytes recompressed',
+                        self.reused, total, 100 * self.reused / total, self.recompressed_bytes)
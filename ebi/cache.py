@@ -0,0 +1,76 @@
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_BUNDLE_CACHE_SIZE = 1024  # MiB
+# Suffix of bundles being built, which aren't cached bundles to count or evict until stored.
+TEMP_SUFFIX = '.zip.tmp'
+
+
+def get_cache_dir(*parts):
+    """ Returning (and creating) a directory under the ebi cache directory.
+
+    The base directory is ``$EBI_CACHE_DIR`` or ``$XDG_CACHE_HOME/ebi`` (``~/.cache/ebi`` by default).
+    """
+    base = os.environ.get('EBI_CACHE_DIR')
+    if not base:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'ebi')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_bundle_path(digest):
+    return os.path.join(get_cache_dir('bundles'), f'{digest}.zip')
+
+
+def lookup_bundle(digest):
+    """ Returning path to the cached bundle for :param digest: or None.
+
+    The hit is marked as recently used so that it survives eviction.
+    """
+    path = get_bundle_path(digest)
+    if not os.path.isfile(path):
+        return None
+    os.utime(path)
+    return path
+
+
+def store_bundle(digest, zip_path, max_size):
+    """ Moving :param zip_path: into the cache as the bundle for :param digest:.
+
+    :param max_size: cache size limit in bytes. Least recently used bundles are evicted above it.
+    :return: File path to the cached bundle.
+    """
+    path = get_bundle_path(digest)
+    os.replace(zip_path, path)
+    evict_bundles(max_size, keep=path)
+    return path
+
+
+def evict_bundles(max_size, keep=None):
+    """ Removing least recently used bundles until the cache fits in :param max_size: bytes.
+
+    Bundles being built (``TEMP_SUFFIX``), possibly by other processes, are left alone.
+    """
+    directory = get_cache_dir('bundles')
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith('.zip') and entry.is_file():
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path == keep:
+            continue
+        logger.debug('Evicting cached bundle %s', path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
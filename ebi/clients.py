@@ -0,0 +1,137 @@
+import collections
+import json
+import logging
+import threading
+
+import boto3
+from botocore import xform_name
+from botocore.config import Config
+
+from . import trace
+
+logger = logging.getLogger(__name__)
+
+
+# Clients are shared by threads uploading parts and deploying environments, so their
+# connection pools are larger than botocore's default of 10.
+MAX_POOL_CONNECTIONS = 50
+# Operations which don't change anything. Others invalidate memoized results of the service.
+READ_ONLY_PREFIXES = ('Describe', 'List', 'Get', 'Head', 'Check')
+
+_lock = threading.RLock()
+_clients = {}
+_memo = {}
+calls = collections.Counter()
+hits = collections.Counter()
+
+
+def get_client(service_name, region_name=None):
+    """ Returning the client of :param service_name: shared in the run, creating it at first.
+
+    Creating clients from the default session is not thread-safe, so it's done under a lock.
+    Clients themselves are thread-safe.
+    """
+    key = (service_name, region_name)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = _create_client(service_name, region_name)
+    return client
+
+
+def _create_client(service_name, region_name):
+    client = boto3.client(service_name, region_name=region_name,
+                          config=Config(max_pool_connections=MAX_POOL_CONNECTIONS))
+    client.meta.events.register_first('before-call', _count_call)
+    client.meta.events.register('after-call', _invalidate_after_call)
+    return client
+
+
+def get_ebcli_client(region_name=None):
+    """ Returning the Elastic Beanstalk client on the API model shipped with ebcli, shared in the run.
+
+    The model has parameters botocore's lacks, e.g. ``TemplateSpecification`` of ``create_environment``
+    which ``eb clone`` uses. It lacks some paginators, so it's used only for these.
+    """
+    from ebcli.lib import aws as ebaws
+
+    key = ('elasticbeanstalk-ebcli', region_name)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            # The loader is taken from the session while creating a client.
+            session = boto3._get_default_session()._session
+            loader = session.get_component('data_loader')
+            session.register_component('data_loader', ebaws._get_data_loader())
+            try:
+                client = _clients[key] = _create_client('elasticbeanstalk', region_name)
+            finally:
+                session.register_component('data_loader', loader)
+    return client
+
+
+def _service_name(model):
+    return model.service_model.service_name
+
+
+def _count_call(model, **kwargs):
+    with _lock:
+        calls[f'{_service_name(model)}.{xform_name(model.name)}'] += 1
+    trace.count_api_call()
+
+
+def _invalidate_after_call(model, **kwargs):
+    if not model.name.startswith(READ_ONLY_PREFIXES):
+        invalidate(_service_name(model))
+
+
+def memoized_call(service_name, operation_name, region_name=None, **kwargs):
+    """ Calling read-only :param operation_name: of :param service_name: once per run for the same arguments.
+
+    Results are invalidated by ``invalidate``, which is called after mutating calls of the service
+    made through shared clients.
+    """
+    key = (service_name, region_name, operation_name, json.dumps(kwargs, sort_keys=True, default=str))
+    with _lock:
+        if key in _memo:
+            hits[f'{service_name}.{operation_name}'] += 1
+            return _memo[key]
+    result = getattr(get_client(service_name, region_name), operation_name)(**kwargs)
+    with _lock:
+        _memo[key] = result
+    return result
+
+
+def describe_environments(region_name=None, **kwargs):
+    return memoized_call('elasticbeanstalk', 'describe_environments', region_name=region_name, **kwargs)
+
+
+def describe_auto_scaling_groups(region_name=None, **kwargs):
+    return memoized_call('autoscaling', 'describe_auto_scaling_groups', region_name=region_name, **kwargs)
+
+
+def invalidate(service_name=None):
+    """ Forgetting memoized results of :param service_name:, or of all services.
+    """
+    with _lock:
+        for key in [key for key in _memo if service_name is None or key[0] == service_name]:
+            del _memo[key]
+
+
+def reset():
+    """ Dropping clients, memoized results and counters, e.g. after the default session changed.
+    """
+    with _lock:
+        _clients.clear()
+        _memo.clear()
+        calls.clear()
+        hits.clear()
+
+
+def log_stats():
+    total = sum(calls.values())
+    if not total:
+        return
+    for name, count in sorted(calls.items()):
+        logger.debug('%s: %d calls', name, count)
+    logger.info('AWS API calls: %d, memoized describe hits: %d', total, sum(hits.values()))
@@ -1,79 +1,80 @@
 import logging
-import subprocess
 import sys
-import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-
-from .. import appversion
+from .. import health, trace
+from ..waiter import Backoff, wait_until
 from . import utils
 
 logger = logging.getLogger(__name__)
 
 
-def get_instance_health(group_name, number):
-    autoscale = boto3.client('autoscaling')
-    as_json = autoscale.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[group_name])
-    instances = as_json['AutoScalingGroups'][0]['Instances']
-    instance_number = len(instances)
-    if instance_number != number:
-        return False
-
-    if not instances:
-        return True
-
-    # Wait for the all of instance status to be healthy.
-    ec2 = boto3.client('ec2')
-    res = ec2.describe_instance_status(
-        InstanceIds=[instance['InstanceId'] for instance in instances])
-    statuses = res['InstanceStatuses']
-    # describe_instance_status returns only running instances by default,
-    # so fewer statuses than instances means some are not running yet.
-    if len(statuses) != instance_number:
-        return False
-    for status in statuses:
-        if status['InstanceStatus']['Status'] != 'ok':
-            return False
-    return True
-
-
-def update_secondary_group_capacity(primary_group_name, secondary_group_name, secondary_env_name, app_name):
-    autoscale = boto3.client('autoscaling')
-    as_json = autoscale.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[primary_group_name])
-    number = as_json['AutoScalingGroups'][0]['DesiredCapacity']
-    min_size = as_json['AutoScalingGroups'][0]['MinSize']
-    max_size = as_json['AutoScalingGroups'][0]['MaxSize']
-
-    autoscale.update_auto_scaling_group(
-        AutoScalingGroupName=secondary_group_name,
-        MaxSize=max_size,
-        MinSize=min_size,
-        DesiredCapacity=number
-    )
+DEFAULT_CAPACITY_TIMEOUT = 20
+DEFAULT_CAPACITY_INTERVAL = 5
+MAX_CAPACITY_INTERVAL = 60
+
+
+def get_group_sizes(*group_names):
+    """ Returning DesiredCapacity, MinSize and MaxSize of each of :param group_names: as dicts, in one call.
+    """
+    from .. import clients
+
+    groups = clients.describe_auto_scaling_groups(AutoScalingGroupNames=list(group_names))['AutoScalingGroups']
+    by_name = {group['AutoScalingGroupName']: group for group in groups}
+    return [{name: by_name[group_name][name] for name in ('DesiredCapacity', 'MinSize', 'MaxSize')}
+            for group_name in group_names]
+
+
+def set_group_sizes(group_name, sizes):
+    """ Setting :param sizes: (from ``get_group_sizes``) to :param group_name:.
+    """
+    from .. import clients
+
+    clients.get_client('autoscaling').update_auto_scaling_group(AutoScalingGroupName=group_name, **sizes)
+
+
+def scale_secondary_group(primary_group_name, secondary_group_name):
+    """ Making the secondary group as large as the primary one.
+
+    :return: (sizes set to the secondary group, its sizes before) tuple of dicts from ``get_group_sizes``.
+    """
+    sizes, previous = get_group_sizes(primary_group_name, secondary_group_name)
+    set_group_sizes(secondary_group_name, sizes)
     logger.info(
         'The number of instances to run was set to %d, the minimum size to %d, the maximum size to %d',
-        number,
-        min_size,
-        max_size
+        sizes['DesiredCapacity'],
+        sizes['MinSize'],
+        sizes['MaxSize']
     )
+    return sizes, previous
 
-    # Wait for the instance to come up.
+
+def wait_for_capacity(secondary_group_name, secondary_env_name, number, health_check='ec2',
+                      timeout=DEFAULT_CAPACITY_TIMEOUT, interval=DEFAULT_CAPACITY_INTERVAL, cancel=None):
+    """ Waiting until :param number: instances of the secondary group are healthy.
+
+    :param health_check: Name of the check in ``health.HEALTH_CHECKS``.
+    :param timeout: minutes to wait.
+    :param interval: seconds to wait first between checks. It grows exponentially.
+    :param cancel: ``threading.Event`` to stop waiting when it's set.
+    :return: True when they are healthy, False when it timed out or was cancelled.
+    """
     logger.info('Wait for the instance to come up')
-    start = time.time()
-    while not get_instance_health(secondary_group_name, number):
-        passed_time = time.time() - start
-        # Make timeout 20 minutes
-        if passed_time >= 20 * 60:
-            logger.warning("The capacity set operation timed out.")
-            sys.exit(1)
-        time.sleep(30)
-
-    logger.info("The all of instances are healthy.")
-
-    # update EB environment description
-    eb = boto3.client('elasticbeanstalk')
+    check = health.HEALTH_CHECKS[health_check](secondary_group_name, secondary_env_name, number)
+    backoff = Backoff(interval, max(interval, MAX_CAPACITY_INTERVAL))
+    with trace.span('wait_healthy', health_check=health_check):
+        return wait_until(check, timeout * 60, backoff, description='The all of instances are healthy', cancel=cancel)
+
+
+def apply_capacity_settings(app_name, secondary_env_name, min_size, max_size):
+    """ Setting the minimum and maximum sizes of the secondary environment, as its group was scaled directly.
+
+    Otherwise Elastic Beanstalk would bring the group back to its own settings on the next update.
+    """
+    from .. import clients
+
+    eb = clients.get_client('elasticbeanstalk')
     eb.update_environment(
         ApplicationName=app_name,
         EnvironmentName=secondary_env_name,
@@ -84,8 +85,71 @@ def update_secondary_group_capacity(primary_group_name, secondary_group_name, se
     )
 
 
+def update_secondary_group_capacity(primary_group_name, secondary_group_name, secondary_env_name, app_name,
+                                    health_check='ec2', timeout=DEFAULT_CAPACITY_TIMEOUT,
+                                    interval=DEFAULT_CAPACITY_INTERVAL):
+    """ Making the secondary group as large as the primary one and waiting until its instances are healthy.
+
+    See ``wait_for_capacity`` for :param health_check:, :param timeout: and :param interval:.
+    """
+    sizes, _ = scale_secondary_group(primary_group_name, secondary_group_name)
+    if not wait_for_capacity(secondary_group_name, secondary_env_name, sizes['DesiredCapacity'],
+                             health_check=health_check, timeout=timeout, interval=interval):
+        logger.warning("The capacity set operation timed out.")
+        sys.exit(1)
+    apply_capacity_settings(app_name, secondary_env_name, sizes['MinSize'], sizes['MaxSize'])
+
+
+def deploy_with_prescale(parsed, primary_env_name, secondary_env_name, version):
+    """ Deploying :param version: to the secondary environment while scaling it like the primary one.
+
+    Instances are launched and checked while the deployment is rolling. It returns when both
+    are done. When the deployment fails, the secondary group is brought back to its sizes before.
+    The option settings of the environment are updated after the deployment, as Elastic Beanstalk
+    doesn't accept updates of an environment being deployed.
+    """
+    from .. import resolver
+
+    primary_group_name = resolver.get_auto_scaling_group_name(primary_env_name, parsed.resolve_cache_ttl)
+    secondary_group_name = resolver.get_auto_scaling_group_name(secondary_env_name, parsed.resolve_cache_ttl)
+    cancel = threading.Event()
+
+    def deploying():
+        r = utils.deploy_version(parsed, secondary_env_name, version, cancel=cancel)
+        if r != 0:
+            cancel.set()
+        return r
+
+    logger.info('Ok, now deploying the version %s for %s', version, secondary_env_name)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        deploy_future = executor.submit(trace.wrap(deploying))
+        try:
+            with trace.span('capacity', env=secondary_env_name):
+                sizes, previous = scale_secondary_group(primary_group_name, secondary_group_name)
+                healthy = wait_for_capacity(secondary_group_name, secondary_env_name, sizes['DesiredCapacity'],
+                                            health_check=parsed.health_check, timeout=parsed.capacity_timeout,
+                                            interval=parsed.capacity_interval, cancel=cancel)
+        except BaseException:
+            cancel.set()
+            raise
+    r = deploy_future.result()
+
+    if r != 0:
+        logger.error("Failed to deploy version %s to environment %s",
+                     version, secondary_env_name)
+        logger.info('Bringing %s back to %d instances', secondary_group_name, previous['DesiredCapacity'])
+        set_group_sizes(secondary_group_name, previous)
+        sys.exit(r)
+    if not healthy:
+        logger.warning("The capacity set operation timed out.")
+        sys.exit(1)
+    apply_capacity_settings(parsed.app_name, secondary_env_name, sizes['MinSize'], sizes['MaxSize'])
+
+
 def main(parsed):
-    master_env_name = utils.get_environ_name_for_cname(parsed.app_name, parsed.cname)
+    from .. import appversion, clients, resolver
+
+    master_env_name = utils.get_environ_name_for_cname(parsed.app_name, parsed.cname, parsed.resolve_cache_ttl)
     if parsed.blue_env == master_env_name:
         primary_env_name = parsed.blue_env
         secondary_env_name = parsed.green_env
@@ -101,41 +165,35 @@ def main(parsed):
     ###
     version, description = utils.get_version_and_description(parsed)
 
-    appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose, parsed.ebext, description)
-    logger.info('Ok, now deploying the version %s for %s', version, secondary_env_name)
-    payload = ['eb', 'deploy', secondary_env_name,
-               f'--version={version}']
-    utils.append_common_options(payload, parsed)
-    r = subprocess.call(payload)
-    if r != 0:
-        logger.error("Failed to deploy version %s to environment %s",
-                     version, secondary_env_name)
-        sys.exit(r)
+    version = appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose,
+                                                  parsed.ebext, description, **utils.get_bundle_options(parsed))
+    if parsed.prescale:
+        # Setting desired capacity while deploying
+        deploy_with_prescale(parsed, primary_env_name, secondary_env_name, version)
+    else:
+        logger.info('Ok, now deploying the version %s for %s', version, secondary_env_name)
+        r = utils.deploy_version(parsed, secondary_env_name, version)
+        if r != 0:
+            logger.error("Failed to deploy version %s to environment %s",
+                         version, secondary_env_name)
+            sys.exit(r)
 
     ###
     # Set desired capacity
     ###
-    if parsed.capacity:
-        autoscale = boto3.client('autoscaling')
-        as_json = autoscale.describe_tags(
-            Filters=[
-                {
-                    'Name': 'Value',
-                    'Values': [secondary_env_name, primary_env_name]
-                },
-            ]
-        )
-        for x in as_json['Tags']:
-            if x['Key'] == 'Name' and x['Value'] == secondary_env_name:
-                secondary_group_name = x['ResourceId']
-            elif x['Key'] == 'Name' and x['Value'] == primary_env_name:
-                primary_group_name = x['ResourceId']
-        update_secondary_group_capacity(
-            primary_group_name,
-            secondary_group_name,
-            secondary_env_name,
-            parsed.app_name
-        )
+    if parsed.capacity and not parsed.prescale:
+        primary_group_name = resolver.get_auto_scaling_group_name(primary_env_name, parsed.resolve_cache_ttl)
+        secondary_group_name = resolver.get_auto_scaling_group_name(secondary_env_name, parsed.resolve_cache_ttl)
+        with trace.span('capacity', env=secondary_env_name):
+            update_secondary_group_capacity(
+                primary_group_name,
+                secondary_group_name,
+                secondary_env_name,
+                parsed.app_name,
+                health_check=parsed.health_check,
+                timeout=parsed.capacity_timeout,
+                interval=parsed.capacity_interval,
+            )
 
     ###
     # Swapping
@@ -145,11 +203,13 @@ def main(parsed):
                     secondary_env_name)
         return
 
-    eb = boto3.client('elasticbeanstalk')
+    eb = clients.get_client('elasticbeanstalk')
     logger.info('Swapping primary %s => new primary %s',
                 primary_env_name, secondary_env_name)
-    eb.swap_environment_cnames(SourceEnvironmentName=primary_env_name,
-                               DestinationEnvironmentName=secondary_env_name)
+    with trace.span('swap'):
+        eb.swap_environment_cnames(SourceEnvironmentName=primary_env_name,
+                                   DestinationEnvironmentName=secondary_env_name)
+    resolver.invalidate(parsed.app_name)
     logger.info('DONE successfully. Primary %s => new primary %s.'
                 'If problem, re-swap new primary to primary',
                 primary_env_name, secondary_env_name)
@@ -164,6 +224,18 @@ def apply_args(parser):
                                          'environment',
                         action='store_true', default=False)
     utils.add_common_args(parser)
+    utils.add_resolve_args(parser)
     parser.add_argument('--capacity', help='Set the number of instances.',
                         action='store_true', default=False)
+    parser.add_argument('--prescale', action='store_true', default=False,
+                        help='Like --capacity, but scale the standby environment while deploying to it')
+    parser.add_argument('--capacity-timeout', type=int, default=DEFAULT_CAPACITY_TIMEOUT,
+                        help='The number of minutes to wait for instances to be healthy with --capacity')
+    parser.add_argument('--capacity-interval', type=float, default=DEFAULT_CAPACITY_INTERVAL,
+                        help='The number of seconds between the first health checks with --capacity. '
+                             'It grows exponentially')
+    parser.add_argument('--health-check', choices=sorted(health.HEALTH_CHECKS), default='ec2',
+                        help='How health of instances is checked with --capacity: '
+                             'EC2 instance status, EB enhanced health or ELB target health')
+    utils.add_server_args(parser)
     parser.set_defaults(func=main)
@@ -0,0 +1,291 @@
+import collections
+import json
+import logging
+import os
+import sys
+import zipfile
+import zlib
+
+from .. import compress, trace
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_TOP = 20
+SORT_KEYS = {'compressed': 'compressed_size', 'raw': 'size'}
+# Zip headers of a member besides its name: the local header (30 bytes) and the central directory entry (46 bytes).
+MEMBER_OVERHEAD = 30 + 46
+END_OF_CENTRAL_DIRECTORY = 22
+
+# Directories of version control and caches, which are rarely needed on instances.
+IGNORED_DIRS = {
+    '.git': 'version control',
+    '.hg': 'version control',
+    '.svn': 'version control',
+    '.bzr': 'version control',
+    '__pycache__': 'Python bytecode cache',
+    '.pytest_cache': 'test cache',
+    '.mypy_cache': 'type checker cache',
+    '.ruff_cache': 'linter cache',
+    '.tox': 'test environments',
+    '.nox': 'test environments',
+    '.venv': 'virtualenv',
+    'venv': 'virtualenv',
+    '.cache': 'cache',
+    '.gradle': 'build cache',
+    '.parcel-cache': 'build cache',
+    '.sass-cache': 'build cache',
+    'htmlcov': 'coverage report',
+    'node_modules': 'dependencies, usually installed while building the image',
+    '.idea': 'editor settings',
+    '.vscode': 'editor settings',
+}
+IGNORED_FILES = {
+    '.DS_Store': 'Finder metadata',
+    '.coverage': 'coverage data',
+}
+# Extensions of build artifacts, logs and dumps, suggested once their files add up to MIN_ARTIFACT_SIZE.
+ARTIFACT_EXTENSIONS = {
+    '.log': 'logs',
+    '.zip': 'archives', '.tar': 'archives', '.gz': 'archives', '.tgz': 'archives', '.bz2': 'archives',
+    '.xz': 'archives', '.7z': 'archives', '.rar': 'archives',
+    '.sql': 'database dumps', '.dump': 'database dumps', '.sqlite': 'databases', '.sqlite3': 'databases',
+    '.bak': 'backups', '.tmp': 'temporary files', '.swp': 'editor swap files',
+    '.iso': 'disk images', '.dmg': 'disk images',
+}
+MIN_ARTIFACT_SIZE = 1024 * 1024
+# Other files this large are suggested one by one.
+LARGE_FILE_SIZE = 10 * 1024 * 1024
+
+
+def _compressed_size(path, size, level):
+    """ Returning the size of the file on :param path: in the bundle, deflated at :param level: unless it's stored.
+    """
+    if level == 0 or compress.choose_compress_type(path, size) == zipfile.ZIP_STORED:
+        return size
+    return compress.deflated_size(path, level)
+
+
+def measure_files(members, level=zlib.Z_DEFAULT_COMPRESSION, jobs=1, file_hash=None):
+    """ Measuring files of :param members: (from ``iter_bundle_members``) as these'd be in the bundle.
+
+    :param level: of deflate, 0 to store files.
+    :param jobs: the number of processes compressing files.
+    :param file_hash: function returning sha256 hex digest of a file (e.g. ``BundleIndex.file_hash``).
+    :return: list of dicts of path (arcname), size, compressed_size and sha256.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from ..bundle import MEMBER_FILE
+
+    files = [(arcname, path, os.path.getsize(path)) for arcname, path, kind in members if kind == MEMBER_FILE]
+    args = ([path for _, path, _ in files], [size for _, _, size in files], [level] * len(files))
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            compressed = list(executor.map(_compressed_size, *args, chunksize=64))
+    else:
+        compressed = list(map(_compressed_size, *args))
+    return [{'path': arcname, 'size': size, 'compressed_size': compressed_size,
+             'sha256': file_hash(path) if file_hash else None}
+            for (arcname, path, size), compressed_size in zip(files, compressed)]
+
+
+def _ratio(compressed_size, size):
+    return round(compressed_size / size, 3) if size else 1.0
+
+
+def _totals(files):
+    size = sum(f['size'] for f in files)
+    compressed_size = sum(f['compressed_size'] for f in files)
+    return {'files': len(files), 'size': size, 'compressed_size': compressed_size,
+            'ratio': _ratio(compressed_size, size)}
+
+
+def summarize_directories(files):
+    """ Returning totals of files under each directory (at any depth) of :param files:.
+    """
+    directories = collections.defaultdict(collections.Counter)
+    for f in files:
+        parts = f['path'].split('/')[:-1]
+        for i in range(1, len(parts) + 1):
+            totals = directories['/'.join(parts[:i]) + '/']
+            totals.update(files=1, size=f['size'], compressed_size=f['compressed_size'])
+    return [{'path': path, 'files': totals['files'], 'size': totals['size'],
+             'compressed_size': totals['compressed_size'], 'ratio': _ratio(totals['compressed_size'], totals['size'])}
+            for path, totals in directories.items()]
+
+
+def find_duplicates(files):
+    """ Returning groups of :param files: having the same contents, with bytes they waste in the bundle.
+    """
+    groups = collections.defaultdict(list)
+    for f in files:
+        if f['sha256'] and f['size']:
+            groups[f['sha256']].append(f)
+    return [{'sha256': sha256, 'size': same[0]['size'], 'compressed_size': same[0]['compressed_size'],
+             'wasted': same[0]['compressed_size'] * (len(same) - 1), 'paths': [f['path'] for f in same]}
+            for sha256, same in groups.items() if len(same) > 1]
+
+
+def _is_replaced(path):
+    from ..bundle import DOCKER_COMPOSE_NAME, DOCKEREXT_NAME, DOCKERRUN_NAME
+
+    return path in (DOCKERRUN_NAME, DOCKER_COMPOSE_NAME) or path.startswith(DOCKEREXT_NAME)
+
+
+def suggest_ignores(files):
+    """ Suggesting ``.ebignore`` patterns for version control and cache directories, artifacts and large files.
+
+    :return: list of dicts of pattern, reason, files, size and compressed_size, most saving first.
+    """
+    matched = collections.defaultdict(list)
+    reasons = {}
+    for f in files:
+        if _is_replaced(f['path']):
+            continue
+        parts = f['path'].split('/')
+        directory = next((part for part in parts[:-1] if part in IGNORED_DIRS), None)
+        extension = os.path.splitext(parts[-1])[1].lower()
+        if directory:
+            pattern, reason = f'{directory}/', IGNORED_DIRS[directory]
+        elif parts[-1] in IGNORED_FILES:
+            pattern, reason = parts[-1], IGNORED_FILES[parts[-1]]
+        elif extension in ARTIFACT_EXTENSIONS:
+            pattern, reason = f'*{extension}', ARTIFACT_EXTENSIONS[extension]
+        elif f['size'] >= LARGE_FILE_SIZE:
+            pattern, reason = f'/{f["path"]}', 'large file'
+        else:
+            continue
+        matched[pattern].append(f)
+        reasons[pattern] = reason
+
+    suggestions = []
+    for pattern, pattern_files in matched.items():
+        totals = _totals(pattern_files)
+        if pattern.startswith('*') and totals['size'] < MIN_ARTIFACT_SIZE:
+            continue
+        suggestions.append(dict(pattern=pattern, reason=reasons[pattern], **totals))
+    return sorted(suggestions, key=lambda s: s['compressed_size'], reverse=True)
+
+
+def make_report(members, level=zlib.Z_DEFAULT_COMPRESSION, jobs=1, top=DEFAULT_TOP, sort='compressed_size',
+                file_hash=None, suggest=True):
+    """ Making the report of the bundle of :param members:.
+
+    :param sort: ``compressed_size`` or ``size`` to rank directories and files by.
+    :param suggest: whether to suggest ``.ebignore`` patterns.
+    :return: dict of totals, top directories and files, duplicates and suggestions.
+    """
+    with trace.span('measure') as span:
+        files = measure_files(members, level=level, jobs=jobs, file_hash=file_hash)
+        span.set(files=len(files))
+    totals = _totals(files)
+    headers = sum(MEMBER_OVERHEAD + 2 * len(arcname.encode()) for arcname, _, _ in members)
+    return dict(
+        totals,
+        members=len(members),
+        level=level,
+        bundle_size=totals['compressed_size'] + headers + END_OF_CENTRAL_DIRECTORY,
+        directories=sorted(summarize_directories(files), key=lambda d: d[sort], reverse=True)[:top],
+        largest_files=[dict(f, ratio=_ratio(f['compressed_size'], f['size']))
+                       for f in sorted(files, key=lambda f: f[sort], reverse=True)[:top]],
+        duplicates=sorted(find_duplicates(files), key=lambda d: d['wasted'], reverse=True)[:top],
+        suggestions=suggest_ignores(files) if suggest else [],
+    )
+
+
+def _mib(size):
+    return f'{size / 1024 / 1024:.2f}'
+
+
+def _log_table(rows):
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        logger.info('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
+def log_report(report):
+    """ Logging :param report: as tables.
+    """
+    logger.info('%d files, %s MiB raw, %s MiB compressed (%.0f%%), bundle about %s MiB',
+                report['files'], _mib(report['size']), _mib(report['compressed_size']), 100 * report['ratio'],
+                _mib(report['bundle_size']))
+    for title, entries in (('Directories', report['directories']), ('Files', report['largest_files'])):
+        if not entries:
+            continue
+        logger.info('')
+        _log_table([(title.upper(), 'RAW MiB', 'COMPRESSED MiB', 'RATIO')]
+                   + [(e['path'], _mib(e['size']), _mib(e['compressed_size']), f'{100 * e["ratio"]:.0f}%')
+                      for e in entries])
+    if report['duplicates']:
+        logger.info('')
+        _log_table([('DUPLICATES', 'COPIES', 'WASTED MiB', 'SHA256')]
+                   + [(d['paths'][0], str(len(d['paths'])), _mib(d['wasted']), d['sha256'][:12])
+                      for d in report['duplicates']])
+    if report['suggestions']:
+        logger.info('')
+        _log_table([('SUGGESTED .ebignore', 'FILES', 'RAW MiB', 'COMPRESSED MiB', 'REASON')]
+                   + [(s['pattern'], str(s['files']), _mib(s['size']), _mib(s['compressed_size']), s['reason'])
+                      for s in report['suggestions']])
+
+
+def write_json(path, report):
+    """ Writing :param report: to :param path: (``-`` for stdout) as JSON.
+    """
+    if path == '-':
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def main(parsed):
+    from .. import appversion, tuning
+    from ..bundleindex import BundleIndex
+
+    level = parsed.compression
+    if level == 'auto':
+        level = tuning.load().get('level', tuning.DEFAULT_LEVEL)
+    elif level is None:
+        level = tuning.DEFAULT_LEVEL
+
+    with trace.span('list') as span:
+        members, root = appversion.list_bundle_members(parsed.dockerrun, parsed.docker_compose, parsed.ebext)
+        span.set(files=len(members))
+    # Without .ebignore, only these files are bundled, and adding one would bundle the whole project.
+    report = make_report(members, level=level, jobs=parsed.jobs, top=parsed.top, sort=SORT_KEYS[parsed.sort],
+                         file_hash=BundleIndex(root or os.getcwd()).file_hash, suggest=root is not None)
+
+    budget = int(parsed.budget * 1024 * 1024) if parsed.budget is not None else None
+    report['budget'] = budget
+    report['over_budget'] = budget is not None and report['bundle_size'] > budget
+    log_report(report)
+    if parsed.json:
+        try:
+            write_json(parsed.json, report)
+        except OSError as e:
+            logger.error('Failed to write the report to %s: %s', parsed.json, e)
+            sys.exit(1)
+    if report['over_budget']:
+        logger.error('The bundle (%s MiB) exceeds the budget of %s MiB', _mib(report['bundle_size']), _mib(budget))
+        sys.exit(1)
+
+
+def apply_args(parser):
+    parser.add_argument('--dockerrun', help='Path to file used as Dockerrun.aws.json')
+    parser.add_argument('--docker-compose', help='Path to file used as docker-compose.yml')
+    parser.add_argument('--ebext', help='Path to directory used as .ebextensions/')
+    parser.add_argument('--top', type=int, default=DEFAULT_TOP,
+                        help=f'The number of directories, files and duplicates listed (default: {DEFAULT_TOP})')
+    parser.add_argument('--sort', choices=tuple(SORT_KEYS), default='compressed',
+                        help='Rank directories and files by compressed or raw size')
+    parser.add_argument('--compression', type=utils.compression_level, metavar='{auto,stored,1-9}',
+                        help='Deflate level to measure with. auto uses the level chosen by the last deploy')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='The number of processes compressing files')
+    parser.add_argument('--json', metavar='PATH', help='Write the report to PATH (- for stdout) as JSON')
+    parser.add_argument('--budget', type=float, metavar='MiB',
+                        help='Fail when the bundle is larger than this many MiB')
+    utils.add_session_args(parser)
+    parser.set_defaults(func=main)
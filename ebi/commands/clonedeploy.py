@@ -1,11 +1,11 @@
 import logging
 import subprocess
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import boto3
-
-from .. import appversion
+from .. import trace
 from . import utils
 
 logger = logging.getLogger(__name__)
@@ -27,38 +27,123 @@ def make_next_env_names(base_env_name, base_cname):
     return f'{base_env_name}{suffix}', f'{base_cname}{suffix}'
 
 
-def main(parsed):
-    master_env_name = utils.get_environ_name_for_cname(parsed.app_name, parsed.cname)
-    next_env_name, next_env_cname = make_next_env_names(parsed.env_name, parsed.cname)
+def clone_environment(parsed, master_env_name, next_env_name, next_env_cname, cancel):
+    """ Cloning :param master_env_name: to :param next_env_name: until it's done or :param cancel: is set.
+
+    :return: exit code. ``engine.EXIT_INTERRUPTED`` when it was cancelled.
+    """
+    from .. import engine
+
+    with trace.span('clone', env=next_env_name):
+        if not parsed.eb_cli:
+            return engine.clone(parsed.app_name, master_env_name, next_env_name, next_env_cname,
+                                exact=parsed.exact, timeout=parsed.timeout, cancel=cancel)
+        payload = ['eb', 'clone', master_env_name,
+                   '--timeout=45',  # Basically, it takes a while.
+                   f'--clone_name={next_env_name}',
+                   f'--cname={next_env_cname}']
+        utils.append_common_options(payload, parsed)
+        if parsed.exact:
+            payload.append('--exact')
+        process = subprocess.Popen(payload)
+        while True:
+            try:
+                return process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    process.terminate()
+                    process.wait()
+                    return engine.EXIT_INTERRUPTED
+
+
+def make_version(parsed, cancel):
+    """ Bundling, uploading and creating the application version to deploy, until :param cancel: is set.
+    """
+    from .. import appversion
 
-    ###
-    # Cloning
-    ###
-    payload = ['eb', 'clone', master_env_name,
-               '--timeout=45',  # Basically, it takes a while.
-               f'--clone_name={next_env_name}',
-               f'--cname={next_env_cname}']
-    utils.append_common_options(payload, parsed)
-    if parsed.exact:
-        payload.append('--exact')
-
-    r = subprocess.call(payload)
+    version, description = utils.get_version_and_description(parsed)
+    return appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose,
+                                                parsed.ebext, description, cancel=cancel,
+                                                **utils.get_bundle_options(parsed))
+
+
+def clone_and_make_version(parsed, master_env_name, next_env_name, next_env_cname):
+    """ Cloning the environment and making the application version at once, as they don't depend on each other.
+
+    When one of them fails, the other is cancelled. A clone cancelled before it's ready is terminated.
+    It exits with the exit code of the clone when it failed first, or raises the error of making the version.
+
+    :return: Version label to deploy.
+    """
+    from .. import engine
+
+    cancel = threading.Event()
+    failures = []
+
+    def fail(step):
+        failures.append(step)
+        cancel.set()
+
+    def cloning():
+        start = time.monotonic()
+        r = clone_environment(parsed, master_env_name, next_env_name, next_env_cname, cancel)
+        if r != 0:
+            fail('clone')
+        return r, time.monotonic() - start
+
+    def making_version():
+        start = time.monotonic()
+        try:
+            version = make_version(parsed, cancel)
+        except BaseException:
+            fail('version')
+            raise
+        return version, time.monotonic() - start
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        clone_future = executor.submit(trace.wrap(cloning))
+        version_future = executor.submit(trace.wrap(making_version))
+        try:
+            wait([clone_future, version_future])
+        except KeyboardInterrupt:
+            cancel.set()
+            raise
+    elapsed = time.monotonic() - start
+
+    r, clone_time = clone_future.result()
+    if failures and failures[0] == 'version':
+        if r == engine.EXIT_INTERRUPTED:
+            logger.warning('Terminating %s, which was being cloned when making the version failed', next_env_name)
+            engine.terminate(next_env_name)
+        version_future.result()
     if r != 0:
         logger.error("Failed to clone %s to environment %s",
                      master_env_name, next_env_cname)
         sys.exit(r)
 
+    version, version_time = version_future.result()
+    logger.info('Cloning took %.0fs and making the version %.0fs. Running them at once saved %.0fs',
+                clone_time, version_time, clone_time + version_time - elapsed)
+    return version
+
+
+def main(parsed):
+    from .. import clients, resolver
+
+    master_env_name = utils.get_environ_name_for_cname(parsed.app_name, parsed.cname, parsed.resolve_cache_ttl)
+    next_env_name, next_env_cname = make_next_env_names(parsed.env_name, parsed.cname)
+
     ###
-    # Deploying
+    # Cloning and making the version
     ###
-    version, description = utils.get_version_and_description(parsed)
+    version = clone_and_make_version(parsed, master_env_name, next_env_name, next_env_cname)
 
-    appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose, parsed.ebext, description)
+    ###
+    # Deploying
+    ###
     logger.info('Ok, now deploying the version %s for %s', version, next_env_name)
-    payload = ['eb', 'deploy', next_env_name,
-               f'--version={version}']
-    utils.append_common_options(payload, parsed)
-    r = subprocess.call(payload)
+    r = utils.deploy_version(parsed, next_env_name, version)
     if r != 0:
         logger.error("Failed to deploy version %s to environment %s",
                      version, next_env_name)
@@ -73,11 +158,13 @@ def main(parsed):
                     next_env_name)
         return
 
-    eb = boto3.client('elasticbeanstalk')
+    eb = clients.get_client('elasticbeanstalk')
     logger.info('Swapping primary %s => new primary %s',
                 master_env_name, next_env_name)
-    eb.swap_environment_cnames(SourceEnvironmentName=master_env_name,
-                               DestinationEnvironmentName=next_env_name)
+    with trace.span('swap'):
+        eb.swap_environment_cnames(SourceEnvironmentName=master_env_name,
+                                   DestinationEnvironmentName=next_env_name)
+    resolver.invalidate(parsed.app_name)
     logger.info('DONE successfully. Primary %s => new primary %s.'
                 'If problem, re-swap new primary to primary',
                 master_env_name, next_env_name)
@@ -91,6 +178,7 @@ def apply_args(parser):
                                          'environment',
                         action='store_true', default=False)
     utils.add_common_args(parser)
+    utils.add_resolve_args(parser)
     parser.add_argument('--exact', help='Prevents Elastic Beanstalk from updating'
                                         'the solution stack version',
                         action='store_true', default=False)
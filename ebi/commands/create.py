@@ -2,26 +2,38 @@ import logging
 import subprocess
 import sys
 
-from .. import appversion
+from .. import trace
 from . import utils
 
 logger = logging.getLogger(__name__)
 
 
 def main(parsed):
+    from .. import appversion, engine
+
     version, description = utils.get_version_and_description(parsed)
 
-    appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose, parsed.ebext, description)
+    version = appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose,
+                                                  parsed.ebext, description, **utils.get_bundle_options(parsed))
 
     logger.info('Ok, now creating version %s for environment %s', version, parsed.env_name)
-    payload = ['eb', 'create', parsed.env_name,
-               '--timeout=45',
-               f'--version={version}',
-               f'--cname={parsed.cname}']
-    utils.append_common_options(payload, parsed)
-    if parsed.cfg:
-        payload.append(f'--cfg={parsed.cfg}')
-    sys.exit(subprocess.call(payload))
+    with trace.span('create', env=parsed.env_name):
+        if not parsed.eb_cli:
+            r = engine.create(parsed.app_name, parsed.env_name, version, parsed.cname, cfg=parsed.cfg,
+                              timeout=parsed.timeout)
+            if r is not None:
+                sys.exit(r)
+            logger.info('Could not determine the platform without --cfg. Falling back to eb create')
+
+        payload = ['eb', 'create', parsed.env_name,
+                   '--timeout=45',
+                   f'--version={version}',
+                   f'--cname={parsed.cname}']
+        utils.append_common_options(payload, parsed)
+        if parsed.cfg:
+            payload.append(f'--cfg={parsed.cfg}')
+        r = subprocess.call(payload)
+    sys.exit(r)
 
 
 def apply_args(parser):
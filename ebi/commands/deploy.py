@@ -1,30 +1,210 @@
+import json
 import logging
-import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .. import appversion
+from .. import trace
 from . import utils
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_MAX_WORKERS = 8
+ON_FAILURE_STOP = 'stop'
+ON_FAILURE_CONTINUE = 'continue'
+
+
+def load_manifest(path, default_app_name=None):
+    """ Loading application and environment pairs to deploy from the JSON manifest on :param path:.
+
+    The manifest is a list of objects having ``env_name`` and ``app_name``.
+    ``app_name`` may be omitted to use :param default_app_name:.
+
+    :return: list of (app_name, env_name) tuples.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    targets = []
+    for entry in entries:
+        app_name = entry.get('app_name', default_app_name)
+        if not app_name or not entry.get('env_name'):
+            raise ValueError(f'Manifest entry {entry!r} needs app_name and env_name')
+        targets.append((app_name, entry['env_name']))
+    return targets
+
+
+def get_targets(parsed):
+    """ Determine (app_name, env_name) tuples to deploy from parsed arguments.
+    """
+    targets = [(parsed.app_name, env_name) for env_name in parsed.env_name]
+    if parsed.manifest:
+        targets += load_manifest(parsed.manifest, parsed.app_name)
+    # Deploying twice to one environment at once fails, so duplicates are dropped.
+    return list(dict.fromkeys(targets))
+
+
+def deploy_all(parsed, targets, versions, region_name=None, stopped=None):
+    """ Deploying to :param targets: at once with ``--max-workers`` threads.
+
+    With ``--on-failure stop``, deployments not started yet are skipped after a failure.
+    Deployments in progress are not cancelled.
+
+    :param versions: dict of application name to the version label to deploy.
+    :param region_name: region of :param targets:, the region of the session by default.
+    :param stopped: ``threading.Event`` set after a failure, shared with deployments to other regions.
+    :return: dict of (app_name, env_name) to (exit code or None when skipped, seconds) tuples.
+    """
+    stopped = stopped or threading.Event()
+
+    def deploy_one(app_name, env_name):
+        if stopped.is_set():
+            return None, 0.0
+        start = time.monotonic()
+        logger.info('Ok, now deploying the version %s for %s', versions[app_name], env_name)
+        code = utils.deploy_version(parsed, env_name, versions[app_name], app_name=app_name, region_name=region_name)
+        if code != 0:
+            logger.error('Failed to deploy version %s to environment %s', versions[app_name], env_name)
+            if parsed.on_failure == ON_FAILURE_STOP:
+                stopped.set()
+        return code, time.monotonic() - start
+
+    with ThreadPoolExecutor(max_workers=parsed.max_workers) as executor:
+        futures = {target: executor.submit(trace.wrap(deploy_one), *target) for target in targets}
+    return {target: future.result() for target, future in futures.items()}
+
+
+def deploy_regions(parsed, targets, version, description):
+    """ Deploying to :param targets: in each of ``--regions`` at once.
+
+    The bundle is made and uploaded once, to the storage bucket of the region of the session.
+    Each region copies it to its own storage bucket on the S3 side, makes the versions and deploys
+    them, without waiting for other regions.
+
+    :return: (results, versions) tuple. results is a dict of (region, app_name, env_name) to
+             (exit code or None when skipped, seconds) tuples, and versions is a dict of
+             (region, app_name) to the version label.
+    """
+    from botocore.exceptions import BotoCoreError, ClientError
+    from .. import appversion, clients, s3upload
+
+    app_names = list(dict.fromkeys(app_name for app_name, _ in targets))
+    options = utils.get_bundle_options(parsed)
+    bucket, key = appversion.upload_bundle(app_names[0], parsed.dockerrun, parsed.docker_compose, parsed.ebext,
+                                           **options)
+    home = clients.get_client('s3').meta.region_name
+    copy_options = {'concurrency': options.get('upload_concurrency', s3upload.DEFAULT_CONCURRENCY),
+                    'part_size': options.get('part_size', s3upload.DEFAULT_PART_SIZE)}
+    stopped = threading.Event()
+    versions = {}
+
+    def deploy_region(region):
+        start = time.monotonic()
+        try:
+            region_bucket = bucket if region == home else appversion.copy_bundle(bucket, key, region, **copy_options)
+            region_versions = appversion.create_application_versions(app_names, version, description,
+                                                                     region_bucket, key, region_name=region)
+        except (BotoCoreError, ClientError, s3upload.UploadError) as e:
+            logger.error('Failed to make the version in %s: %s', region, e)
+            if parsed.on_failure == ON_FAILURE_STOP:
+                stopped.set()
+            versions.update(((region, app_name), version) for app_name in app_names)
+            return {(region,) + target: (1, time.monotonic() - start) for target in targets}
+        versions.update(((region, app_name), label) for app_name, label in region_versions.items())
+        results = deploy_all(parsed, targets, region_versions, region_name=region, stopped=stopped)
+        return {(region,) + target: result for target, result in results.items()}
+
+    with ThreadPoolExecutor(max_workers=len(parsed.regions)) as executor:
+        futures = [executor.submit(trace.wrap(deploy_region), region) for region in parsed.regions]
+    results = {}
+    for future in futures:
+        results.update(future.result())
+    return results, versions
+
+
+def log_summary(results, versions):
+    """ Logging the result of each deployment in :param results: as a table.
+
+    :param results: dict of (app_name, env_name), or (region, app_name, env_name) with ``--regions``,
+                    to (exit code or None when skipped, seconds) tuples.
+    :param versions: dict of application name, or (region, app_name) with ``--regions``, to the version label.
+    """
+    regional = any(len(target) == 3 for target in results)
+    rows = [(('REGION',) if regional else ()) + ('APPLICATION', 'ENVIRONMENT', 'VERSION', 'RESULT', 'DURATION')]
+    for target, (code, elapsed) in results.items():
+        if code is None:
+            result = 'skipped'
+        else:
+            result = 'ok' if code == 0 else f'failed ({code})'
+        version = versions[target[:2]] if regional else versions[target[0]]
+        rows.append(target + (version, result, f'{elapsed:.0f}s'))
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        logger.info('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
+
+
 def main(parsed):
+    try:
+        targets = get_targets(parsed)
+    except (OSError, ValueError) as e:
+        logger.error('Failed to load the manifest %s: %s', parsed.manifest, e)
+        sys.exit(1)
+    if not targets:
+        logger.error('No environment to deploy. Specify env_name or --manifest')
+        sys.exit(1)
+    app_names = list(dict.fromkeys(app_name for app_name, _ in targets))
+    if parsed.eb_cli and len(app_names) > 1:
+        logger.error('eb deploy works on the application of the project. '
+                     'Deploying to several applications needs to be done without --eb-cli')
+        sys.exit(1)
+    if parsed.staged and not parsed.eb_cli:
+        logger.warning('--staged only applies to eb deploy with --eb-cli. '
+                       'It is ignored, and the bundle is made from the working tree')
+    if parsed.eb_cli and parsed.regions:
+        logger.error('Deploying to several regions needs to be done without --eb-cli')
+        sys.exit(1)
+
+    from .. import appversion
+
     version, description = utils.get_version_and_description(parsed)
 
-    appversion.make_application_version(parsed.app_name, version, parsed.dockerrun, parsed.docker_compose, parsed.ebext, description)
-    logger.info('Ok, now deploying the version %s for %s', version, parsed.env_name)
-    payload = ['eb', 'deploy', parsed.env_name,
-               f'--version={version}']
-    utils.append_common_options(payload, parsed)
-    if parsed.staged:
-        payload.append('--staged')
-    sys.exit(subprocess.call(payload))
+    if parsed.regions:
+        results, versions = deploy_regions(parsed, targets, version, description)
+        log_summary(results, versions)
+        sys.exit(next((code for code, _ in results.values() if code), 0))
+
+    versions = appversion.make_application_versions(app_names, version, parsed.dockerrun, parsed.docker_compose,
+                                                    parsed.ebext, description, **utils.get_bundle_options(parsed))
+    if len(targets) == 1:
+        app_name, env_name = targets[0]
+        logger.info('Ok, now deploying the version %s for %s', versions[app_name], env_name)
+        sys.exit(utils.deploy_version(parsed, env_name, versions[app_name], app_name=app_name))
+
+    results = deploy_all(parsed, targets, versions)
+    log_summary(results, versions)
+    sys.exit(next((code for code, _ in results.values() if code), 0))
+
+
+def region_list(value):
+    """ Parsing comma separated regions of ``--regions``.
+    """
+    return list(dict.fromkeys(region.strip() for region in value.split(',') if region.strip()))
 
 
 def apply_args(parser):
-    parser.add_argument('app_name', help='Application name to deploy')
-    parser.add_argument('env_name', help='Environ name to deploy')
+    parser.add_argument('app_name', nargs='?', help='Application name to deploy')
+    parser.add_argument('env_name', nargs='*', help='Environ names to deploy')
     utils.add_common_args(parser)
     parser.add_argument('--staged', action='store_true', default=False,
-                        help='deploy files staged in git rather than the HEAD commit')
+                        help='deploy files staged in git rather than the HEAD commit (with --eb-cli)')
+    parser.add_argument('--manifest', help='JSON file listing app_name and env_name pairs to deploy')
+    parser.add_argument('--max-workers', type=utils.positive_int, default=DEFAULT_MAX_WORKERS,
+                        help='The number of environments deployed at once')
+    parser.add_argument('--on-failure', choices=(ON_FAILURE_STOP, ON_FAILURE_CONTINUE), default=ON_FAILURE_STOP,
+                        help='Whether to start remaining deployments after one failed')
+    parser.add_argument('--regions', type=region_list, metavar='REGION,...',
+                        help='Comma separated regions to deploy to at once. The bundle is uploaded once '
+                             'and copied to the other regions by S3')
+    utils.add_server_args(parser)
     parser.set_defaults(func=main)
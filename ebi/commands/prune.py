@@ -0,0 +1,200 @@
+import collections
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import trace
+from . import utils
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_KEEP = 20
+DEFAULT_MAX_WORKERS = 8
+# The most keys DeleteObjects accepts in a call.
+DELETE_BATCH_SIZE = 1000
+
+
+def list_application_versions():
+    """ Returning application versions of all applications over pages.
+
+    Versions of all applications are needed as bundles are shared by applications deployed together.
+    """
+    from .. import clients
+
+    paginator = clients.get_client('elasticbeanstalk').get_paginator('describe_application_versions')
+    return [v for page in paginator.paginate() for v in page['ApplicationVersions']]
+
+
+def get_live_version_labels(app_name):
+    """ Returning labels of versions running on live environments of :param app_name:.
+    """
+    from .. import resolver
+
+    return {env['VersionLabel'] for env in resolver.iter_environments(app_name) if env.get('VersionLabel')}
+
+
+def select_versions(versions, live_labels, keep):
+    """ Splitting :param versions: of an application to ones to keep and ones to delete.
+
+    The :param keep: newest versions and ones in :param live_labels: are kept.
+
+    :return: (kept, deleted) tuple of lists of versions, newest first.
+    """
+    versions = sorted(versions, key=lambda v: v['DateCreated'], reverse=True)
+    kept = []
+    deleted = []
+    for i, v in enumerate(versions):
+        (kept if i < keep or v['VersionLabel'] in live_labels else deleted).append(v)
+    return kept, deleted
+
+
+def _source_bundle(version):
+    bundle = version.get('SourceBundle') or {}
+    if bundle.get('S3Bucket') and bundle.get('S3Key'):
+        return bundle['S3Bucket'], bundle['S3Key']
+    return None
+
+
+def get_unreferenced_bundles(deleted, remaining):
+    """ Returning source bundles of :param deleted: versions not used by :param remaining: ones.
+
+    :return: dict of bucket to sorted list of keys.
+    """
+    referenced = {_source_bundle(v) for v in remaining}
+    bundles = collections.defaultdict(set)
+    for v in deleted:
+        bundle = _source_bundle(v)
+        if bundle and bundle not in referenced:
+            bundles[bundle[0]].add(bundle[1])
+    return {bucket: sorted(keys) for bucket, keys in bundles.items()}
+
+
+def get_object_sizes(bucket, keys):
+    """ Returning a dict of key to size of :param keys: existing in :param bucket:.
+
+    Objects are listed by the top level prefixes of the keys, not looked up one by one.
+    """
+    from .. import clients
+
+    wanted = set(keys)
+    prefixes = {key.split('/', 1)[0] + '/' if '/' in key else key for key in wanted}
+    paginator = clients.get_client('s3').get_paginator('list_objects_v2')
+    sizes = {}
+    for prefix in sorted(prefixes):
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if obj['Key'] in wanted:
+                    sizes[obj['Key']] = obj['Size']
+    return sizes
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def delete_versions(executor, app_name, versions):
+    """ Deleting :param versions: of :param app_name: on :param executor:, leaving their bundles.
+
+    :return: list of versions deleted.
+    """
+    from botocore.exceptions import ClientError
+    from .. import clients
+
+    eb = clients.get_client('elasticbeanstalk')
+
+    def delete(v):
+        try:
+            eb.delete_application_version(ApplicationName=app_name, VersionLabel=v['VersionLabel'],
+                                          DeleteSourceBundle=False)
+        except ClientError as e:
+            logger.warning('Failed to delete version %s: %s', v['VersionLabel'], e)
+            return None
+        logger.debug('Deleted version %s', v['VersionLabel'])
+        return v
+
+    return [v for v in executor.map(trace.wrap(delete), versions) if v is not None]
+
+
+def delete_objects(executor, bucket, keys):
+    """ Deleting :param keys: in :param bucket: by ``DeleteObjects`` calls of up to 1000 keys on :param executor:.
+
+    :return: set of keys deleted.
+    """
+    from .. import clients
+
+    s3 = clients.get_client('s3')
+
+    def delete(batch):
+        res = s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True})
+        failed = {error['Key'] for error in res.get('Errors', [])}
+        for error in res.get('Errors', []):
+            logger.warning('Failed to delete s3://%s/%s: %s', bucket, error['Key'], error.get('Message'))
+        return set(batch) - failed
+
+    deleted = set()
+    for batch in executor.map(trace.wrap(delete), _batches(keys, DELETE_BATCH_SIZE)):
+        deleted |= batch
+    return deleted
+
+
+def main(parsed):
+    if parsed.keep < 0:
+        logger.error('--keep must not be negative')
+        sys.exit(1)
+
+    with trace.span('list'):
+        versions = list_application_versions()
+        live_labels = get_live_version_labels(parsed.app_name)
+    app_versions = [v for v in versions if v['ApplicationName'] == parsed.app_name]
+    others = [v for v in versions if v['ApplicationName'] != parsed.app_name]
+    kept, deleted = select_versions(app_versions, live_labels, parsed.keep)
+    bundles = get_unreferenced_bundles(deleted, kept + others)
+    with trace.span('size'):
+        sizes = {bucket: get_object_sizes(bucket, keys) for bucket, keys in bundles.items()}
+    logger.info('%d versions of %s: keeping %d (%d newest and ones on live environments), deleting %d',
+                len(app_versions), parsed.app_name, len(kept), min(parsed.keep, len(app_versions)), len(deleted))
+
+    if parsed.dry_run:
+        for v in deleted:
+            bundle = _source_bundle(v)
+            logger.info('Would delete version %s created at %s%s', v['VersionLabel'], v['DateCreated'],
+                        f' and s3://{bundle[0]}/{bundle[1]}' if bundle and bundle[1] in bundles.get(bundle[0], ())
+                        else '')
+        logger.info('Would delete %d versions and %d objects, reclaiming %.1f MiB',
+                    len(deleted), sum(len(s) for s in sizes.values()),
+                    sum(sum(s.values()) for s in sizes.values()) / 1024 / 1024)
+        return
+
+    with ThreadPoolExecutor(max_workers=parsed.max_workers) as executor:
+        with trace.span('delete_versions') as span:
+            done = delete_versions(executor, parsed.app_name, deleted)
+            span.set(versions=len(done))
+        # Bundles of versions failed to be deleted are still used.
+        bundles = get_unreferenced_bundles(done, kept + others + [v for v in deleted if v not in done])
+        reclaimed = 0
+        objects = 0
+        with trace.span('delete_objects') as span:
+            for bucket, keys in bundles.items():
+                keys = [key for key in keys if key in sizes[bucket]]
+                removed = delete_objects(executor, bucket, keys)
+                objects += len(removed)
+                reclaimed += sum(sizes[bucket][key] for key in removed)
+            span.set(bytes=reclaimed)
+    logger.info('Deleted %d versions and %d objects, reclaiming %.1f MiB', len(done), objects, reclaimed / 1024 / 1024)
+    if len(done) < len(deleted):
+        sys.exit(1)
+
+
+def apply_args(parser):
+    parser.add_argument('app_name', help='Application name to delete old versions of')
+    parser.add_argument('--keep', type=utils.positive_int, default=DEFAULT_KEEP,
+                        help=f'The number of the newest versions to keep (default: {DEFAULT_KEEP}). '
+                             'Versions on live environments are kept too')
+    parser.add_argument('--dry-run', action='store_true', default=False,
+                        help='Only show versions and objects to delete')
+    parser.add_argument('--max-workers', type=utils.positive_int, default=DEFAULT_MAX_WORKERS,
+                        help=f'The number of delete calls made at once (default: {DEFAULT_MAX_WORKERS})')
+    utils.add_session_args(parser)
+    parser.set_defaults(func=main)
@@ -0,0 +1,14 @@
+from . import utils
+
+
+def main(parsed):
+    from .. import server
+
+    server.serve(parsed.socket or server.get_default_socket(), parsed.profile, parsed.region)
+
+
+def apply_args(parser):
+    parser.add_argument('--socket',
+                        help='Path to the Unix socket to listen on (default: serve.sock in the cache directory)')
+    utils.add_session_args(parser)
+    parser.set_defaults(func=main)
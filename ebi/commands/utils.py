@@ -1,8 +1,14 @@
+import argparse
 import logging
+import os
+import subprocess
 import sys
 import time
 
-import boto3
+from .. import cache, trace
+
+# Command modules import boto3, ebcli and modules depending on these in functions,
+# so that parsing arguments and ``--help`` don't pay for importing them (see ``core.COMMANDS``).
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +30,40 @@ def get_version_and_description(parsed):
     return version, description
 
 
+def get_bundle_options(parsed):
+    """ Determine keyword arguments for ``appversion.make_application_version`` from parsed arguments.
+
+    Options not given are left to the defaults of ``make_application_version``.
+    """
+    options = {
+        'cache_size': parsed.bundle_cache_size,
+        'jobs': parsed.jobs,
+        'upload_concurrency': parsed.upload_concurrency,
+        'part_size': parsed.part_size,
+        'stream': parsed.stream,
+        'compression': parsed.compression,
+    }
+    return {name: value for name, value in options.items() if value is not None}
+
+
+def compression_level(value):
+    """ Parsing ``--compression``: ``auto``, ``stored`` or a deflate level from 1 to 9.
+    """
+    if value in ('auto', 'stored'):
+        return 0 if value == 'stored' else value
+    if value.isdigit() and 1 <= int(value) <= 9:
+        return int(value)
+    raise argparse.ArgumentTypeError(f'invalid compression {value!r} (choose auto, stored or 1 to 9)')
+
+
+def positive_int(value):
+    """ Parsing a count which needs to be 1 or more.
+    """
+    if value.isdigit() and int(value) >= 1:
+        return int(value)
+    raise argparse.ArgumentTypeError(f'invalid count {value!r} (needs to be 1 or more)')
+
+
 def append_common_options(payload, parsed):
     """ Append common eb command options to :param payload: from parsed arguments.
     """
@@ -35,32 +75,105 @@ def append_common_options(payload, parsed):
         payload.append(f'--timeout={parsed.timeout}')
 
 
-def get_environ_name_for_cname(app_name, cname):
+def deploy_version(parsed, env_name, version, app_name=None, cancel=None, region_name=None):
+    """ Deploying :param version: to :param env_name: and returning the exit code.
+
+    It's done in process, or by calling ``eb deploy`` with ``--eb-cli``.
+    :param app_name: Application of :param env_name:, ``parsed.app_name`` by default.
+    :param cancel: ``threading.Event`` to stop waiting for the deployment in process when it's set.
+    :param region_name: Region of :param env_name: (in process only), the region of the session by default.
+    """
+    attributes = {'region': region_name} if region_name else {}
+    with trace.span('deploy', env=env_name, version=version, **attributes) as span:
+        if parsed.eb_cli:
+            payload = ['eb', 'deploy', env_name,
+                       f'--version={version}']
+            append_common_options(payload, parsed)
+            if getattr(parsed, 'staged', False):
+                payload.append('--staged')
+            code = subprocess.call(payload)
+        else:
+            from .. import engine
+            code = engine.deploy(app_name or parsed.app_name, env_name, version, timeout=parsed.timeout,
+                                 cancel=cancel, region_name=region_name)
+        span.set(exit_code=code)
+        return code
+
+
+def get_environ_name_for_cname(app_name, cname, ttl=0):
     """ Determine environment name having :param cname: on :param app_name:.
 
     If cname duplicated, longer one will be returned.
     For example, there are myenv.ap-northeast-1.elasticbeanstalk.com and myenv.elasticbeanstalk.com,
     myenv.ap-northeast-1.elasticbeanstalk.com will be returned.
+
+    :param ttl: seconds to reuse the CNAME index saved by earlier runs. 0 looks environments up.
     """
-    eb = boto3.client('elasticbeanstalk')
-    res = eb.describe_environments(ApplicationName=app_name)
+    from .. import resolver
 
-    for e in reversed(sorted(res['Environments'], key=lambda x: len(x['CNAME']))):
-        if e['CNAME'].startswith(f'{cname}.'):
-            return e['EnvironmentName']
+    with trace.span('resolve', cname=cname):
+        env_name = resolver.find_environment_by_cname(app_name, cname, ttl)
+    if env_name:
+        return env_name
     logger.error('Could not find environment for applied app_name and cname')
     sys.exit(1)
 
 
+def add_resolve_args(parser):
+    """ Add arguments of commands resolving environments by CNAME to :param parser:.
+    """
+    parser.add_argument('--resolve-cache-ttl', type=int, default=0,
+                        help='Seconds to reuse environments and auto scaling groups looked up by earlier runs')
+
+
+def add_server_args(parser):
+    """ Add arguments of commands which may run on ``ebi serve`` to :param parser:.
+    """
+    parser.add_argument('--server', metavar='SOCKET', default=os.environ.get('EBI_SERVER'),
+                        help='Run on ebi serve listening on the Unix socket SOCKET ($EBI_SERVER by default)')
+
+
+def add_session_args(parser):
+    """ Add arguments every subcommand needs (see ``core.main``) to :param parser:.
+    """
+    parser.add_argument('--profile', help='AWS account')
+    parser.add_argument('--region', help='AWS region')
+    parser.add_argument('--trace-json', metavar='PATH',
+                        help='Write timing, API calls and bytes of each phase of the run to PATH as JSON')
+    parser.add_argument('--trace-openmetrics', metavar='PATH',
+                        help='Write timing, API calls and bytes of each phase of the run to PATH as OpenMetrics text')
+    parser.add_argument('--trace-statsd', metavar='HOST:PORT',
+                        help='Send timing, API calls and bytes of each phase of the run to a StatsD server')
+    parser.add_argument('--profile-cpu', metavar='DIR',
+                        help='Write a cProfile (pstats) file of each phase of the run to DIR')
+    parser.add_argument('--profile-mem', action='store_true', default=False,
+                        help='Log allocations growing most and peak RSS of each phase of the run')
+
+
 def add_common_args(parser):
-    """ Add arguments common to all subcommands to :param parser:.
+    """ Add arguments common to subcommands deploying versions to :param parser:.
     """
     parser.add_argument('--version', help='Version label you want to specify')
     parser.add_argument('--prefix', help='Version label prefix you want to specify')
     parser.add_argument('--description', help='Description for this version')
-    parser.add_argument('--profile', help='AWS account')
-    parser.add_argument('--region', help='AWS region')
-    parser.add_argument('--timeout', help='The number of minutes before the deploy timeout')
+    add_session_args(parser)
+    parser.add_argument('--timeout', type=int, help='The number of minutes before the deploy timeout')
+    parser.add_argument('--events-jsonl', metavar='PATH',
+                        help='Write events of the environments operated to PATH (- for stdout) as lines of JSON')
+    parser.add_argument('--eb-cli', action='store_true', default=False,
+                        help='Call eb CLI commands instead of calling AWS APIs in process')
     parser.add_argument('--dockerrun', help='Path to file used as Dockerrun.aws.json')
     parser.add_argument('--docker-compose', help='Path to file used as docker-compose.yml')
     parser.add_argument('--ebext', help='Path to directory used as .ebextensions/')
+    parser.add_argument('--bundle-cache-size', type=int, default=cache.DEFAULT_BUNDLE_CACHE_SIZE,
+                        help='Size limit of the local bundle cache in MiB (0 disables it)')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='The number of processes compressing the bundle')
+    parser.add_argument('--upload-concurrency', type=int,
+                        help='The number of parts of the bundle uploaded at once (default: 8)')
+    parser.add_argument('--part-size', type=int,
+                        help='Size of multipart upload parts in MiB (default: 16)')
+    parser.add_argument('--stream', action='store_true', default=False,
+                        help='Upload the bundle while building it, without a local zip file')
+    parser.add_argument('--compression', type=compression_level, metavar='{auto,stored,1-9}',
+                        help='Deflate level of the bundle. auto chooses the fastest for the CPU and upload bandwidth')
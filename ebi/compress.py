@@ -0,0 +1,211 @@
+import collections
+import contextlib
+import itertools
+import logging
+import os
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+# Files having these extensions are already compressed. Deflating them again only burns CPU.
+STORED_EXTENSIONS = frozenset({
+    '.7z', '.apk', '.avif', '.br', '.bz2', '.ear', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg',
+    '.lz4', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.rar', '.tgz', '.war', '.webm', '.webp', '.whl',
+    '.woff', '.woff2', '.xz', '.zip', '.zst',
+})
+# Files are sampled from the head to tell whether these are compressible.
+SAMPLE_SIZE = 64 * 1024
+# Deflating the sample must save at least this ratio, otherwise the file is stored.
+MIN_SAVING = 0.05
+# Members being compressed ahead of the one written, per job, and bytes of these deflated in memory.
+# These bound memory of the main process.
+PENDING_PER_JOB = 4
+PENDING_BYTES_PER_JOB = 16 * 1024 * 1024
+# Files larger than this are deflated to temporary files rather than returned from processes in memory.
+MAX_IN_MEMORY_SIZE = 8 * 1024 * 1024
+# Compressed data is written to the zip file in pieces of this size, e.g. to keep the buffer of
+# ``s3upload.MultipartWriter`` within a part.
+WRITE_CHUNK_SIZE = 1024 * 1024
+
+
+def choose_compress_type(path, size):
+    """ Choosing ZIP_STORED or ZIP_DEFLATED for the file on :param path: by extension and a sample.
+    """
+    if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+        return zipfile.ZIP_STORED
+    if size <= SAMPLE_SIZE // 16:
+        return zipfile.ZIP_DEFLATED
+    with open(path, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    if len(zlib.compress(sample, 1)) > len(sample) * (1 - MIN_SAVING):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def deflate_file(path, level=zlib.Z_DEFAULT_COMPRESSION, chunk_size=1024 * 1024, output=None):
+    """ Deflating the file on :param path: as a raw stream for a zip member.
+
+    :param output: path to write the compressed data to, instead of returning it.
+    :return: (CRC, file size, compressed size, compressed bytes or None with :param output:, seconds spent) tuple.
+    """
+    start = time.perf_counter()
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc = 0
+    size = 0
+    compress_size = 0
+    chunks = []
+    with open(path, 'rb') as f, (open(output, 'wb') if output else contextlib.nullcontext()) as out:
+        for chunk in itertools.chain(iter(lambda: f.read(chunk_size), b''), [None]):
+            if chunk is None:
+                data = compressor.flush()
+            else:
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                data = compressor.compress(chunk)
+            compress_size += len(data)
+            if out:
+                out.write(data)
+            else:
+                chunks.append(data)
+    return crc, size, compress_size, None if output else b''.join(chunks), time.perf_counter() - start
+
+
+def deflated_size(path, level=zlib.Z_DEFAULT_COMPRESSION, chunk_size=1024 * 1024):
+    """ Returning the size of the file on :param path: deflated like ``deflate_file``, without keeping the data.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            size += len(compressor.compress(chunk))
+    return size + len(compressor.flush())
+
+
+def write_raw_member(zf, zinfo, chunks):
+    """ Writing already compressed :param chunks: to :param zf: as :param zinfo:.
+
+    ``zinfo.CRC``, ``zinfo.file_size``, ``zinfo.compress_size`` and ``zinfo.compress_type`` must be set.
+    zipfile has no public API for this, so it follows what ``ZipFile.mkdir`` does.
+    """
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    with zf._lock:
+        if zf._seekable:
+            zf.fp.seek(zf.start_dir)
+        zinfo.header_offset = zf.fp.tell()
+        zf._writecheck(zinfo)
+        zf._didModify = True
+        zf.fp.write(zinfo.FileHeader(zip64))
+        for chunk in chunks:
+            zf.fp.write(chunk)
+        zf.filelist.append(zinfo)
+        zf.NameToInfo[zinfo.filename] = zinfo
+        zf.start_dir = zf.fp.tell()
+
+
+def copy_raw_member(zf, zinfo, src_zf, src_info, buffer_size=1024 * 1024):
+    """ Copying compressed data of :param src_info: in :param src_zf: to :param zf: as :param zinfo:
+    without decompressing it.
+    """
+    zinfo.CRC = src_info.CRC
+    zinfo.file_size = src_info.file_size
+    zinfo.compress_size = src_info.compress_size
+    zinfo.compress_type = src_info.compress_type
+    with open(src_zf.filename, 'rb') as f:
+        f.seek(src_info.header_offset)
+        header = f.read(zipfile.sizeFileHeader)
+        if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f'Bad local file header of {src_info.filename}')
+        fheader = struct.unpack(zipfile.structFileHeader, header)
+        f.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+
+        def chunks():
+            remaining = src_info.compress_size
+            while remaining:
+                chunk = f.read(min(buffer_size, remaining))
+                if not chunk:
+                    raise zipfile.BadZipFile(f'Truncated data of {src_info.filename}')
+                remaining -= len(chunk)
+                yield chunk
+
+        write_raw_member(zf, zinfo, chunks())
+
+
+def write_parallel(zf, entries, jobs, write_member, deflate_kind, level=None):
+    """ Writing :param entries: to :param zf: deflating members on :param jobs: processes.
+
+    :param entries: Iterator of (zinfo, source, kind). Members of :param deflate_kind: to deflate
+                    are compressed by the pool and the rest are written by :param write_member:
+                    in the main process. The order of the entries is kept.
+                    Members deflated ahead of the one written are bounded in number and bytes,
+                    and large ones are deflated to temporary files.
+    :param level: Deflate level, or None for the zlib default.
+    :return: Stats of the deflated members as a dict.
+    """
+    # Imported here, as multiprocessing slows down the start of every command importing this module.
+    from concurrent.futures import ProcessPoolExecutor
+
+    stats = {'members': 0, 'size': 0, 'compress_size': 0, 'cpu_time': 0.0}
+    start = time.perf_counter()
+    pending = collections.deque()
+    pending_bytes = 0
+
+    def write_head():
+        nonlocal pending_bytes
+        zinfo, source, kind, future, output = pending.popleft()
+        if future is None:
+            write_member(zf, zinfo, source, kind)
+            return
+        zinfo.CRC, zinfo.file_size, zinfo.compress_size, data, elapsed = future.result()
+        if output is None:
+            pending_bytes -= zinfo.file_size
+            view = memoryview(data)
+            write_raw_member(zf, zinfo, (view[i:i + WRITE_CHUNK_SIZE] for i in range(0, len(data), WRITE_CHUNK_SIZE)))
+        else:
+            try:
+                with open(output, 'rb') as f:
+                    write_raw_member(zf, zinfo, iter(lambda: f.read(WRITE_CHUNK_SIZE), b''))
+            finally:
+                os.remove(output)
+        stats['members'] += 1
+        stats['size'] += zinfo.file_size
+        stats['compress_size'] += zinfo.compress_size
+        stats['cpu_time'] += elapsed
+        logger.debug('Deflated %s: %d => %d bytes (%.0f%%) in %.3fs', zinfo.filename, zinfo.file_size,
+                     zinfo.compress_size, 100 * zinfo.compress_size / (zinfo.file_size or 1), elapsed)
+
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for zinfo, source, kind in entries:
+                future = output = None
+                if kind == deflate_kind and zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                    if zinfo.file_size > MAX_IN_MEMORY_SIZE:
+                        fd, output = tempfile.mkstemp(prefix='ebi-deflate-')
+                        os.close(fd)
+                    else:
+                        pending_bytes += zinfo.file_size
+                    future = executor.submit(deflate_file, source,
+                                             zlib.Z_DEFAULT_COMPRESSION if level is None else level, output=output)
+                pending.append((zinfo, source, kind, future, output))
+                while (len(pending) > jobs * PENDING_PER_JOB or pending_bytes > jobs * PENDING_BYTES_PER_JOB
+                       or (pending and pending[0][3] is None)):
+                    write_head()
+            while pending:
+                write_head()
+    finally:
+        # Temporary files of members not written, after a failure.
+        for *_, output in pending:
+            if output:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(output)
+
+    stats['wall_time'] = time.perf_counter() - start
+    logger.info('Deflated %d members on %d jobs: %d => %d bytes (%.0f%%), %.1fs CPU in %.1fs (%.1fs saved)',
+                stats['members'], jobs, stats['size'], stats['compress_size'],
+                100 * stats['compress_size'] / (stats['size'] or 1), stats['cpu_time'],
+                stats['wall_time'], max(stats['cpu_time'] - stats['wall_time'], 0))
+    return stats
@@ -1,41 +1,39 @@
 import argparse
+import contextlib
+import importlib
 import logging
-
-import boto3
-from ebcli.lib import aws as ebaws
+import sys
 
 from . import __version__
-from .commands.bgdeploy import apply_args as apply_args_bgdeploy
-from .commands.clonedeploy import apply_args as apply_args_clonedeploy
-from .commands.create import apply_args as apply_args_create
-from .commands.deploy import apply_args as apply_args_deploy
 
+# Subcommands and modules implementing them. Only the module of the selected command is imported,
+# and boto3 and ebcli are imported when a session is needed, so that ``ebi --version`` and
+# ``ebi <command> --help`` start quickly.
+COMMANDS = {
+    'bgdeploy': 'ebi.commands.bgdeploy',
+    'bundle-report': 'ebi.commands.bundlereport',
+    'clonedeploy': 'ebi.commands.clonedeploy',
+    'create': 'ebi.commands.create',
+    'deploy': 'ebi.commands.deploy',
+    'prune': 'ebi.commands.prune',
+    'serve': 'ebi.commands.serve',
+}
 
-def main():
-    """ Main function called from console_scripts
-    """
-    logger = logging.getLogger('ebi')
-    logger.setLevel(logging.INFO)
-    logger.addHandler(logging.StreamHandler())
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
-    subparsers = parser.add_subparsers()
-    parser_bgdeploy = subparsers.add_parser('bgdeploy')
-    parser_clonedeploy = subparsers.add_parser('clonedeploy')
-    parser_create = subparsers.add_parser('create')
-    parser_deploy = subparsers.add_parser('deploy')
+def find_command(argv):
+    """ Finding the subcommand name in :param argv:, or None.
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg if arg in COMMANDS else None
+    return None
 
-    apply_args_bgdeploy(parser_bgdeploy)
-    apply_args_clonedeploy(parser_clonedeploy)
-    apply_args_create(parser_create)
-    apply_args_deploy(parser_deploy)
 
-    parsed = parser.parse_args()
-
-    if not hasattr(parsed, 'func'):
-        parser.print_help()
-        return
+def setup_session(parsed):
+    """ Setting up the default boto3 session and ebcli from parsed arguments.
+    """
+    import boto3
+    from ebcli.lib import aws as ebaws
 
     conf = {}
     if parsed.profile:
@@ -50,4 +48,64 @@ def main():
     profile = session._session.get_config_variable('profile')
     if profile:
         ebaws.set_profile(profile)
-    parsed.func(parsed)
+
+
+def make_parser(*selected):
+    """ Making the argument parser, with arguments of :param selected: commands.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--version', action='version', version=f'%(prog)s {__version__}')
+    subparsers = parser.add_subparsers()
+    for name, module_name in COMMANDS.items():
+        subparser = subparsers.add_parser(name)
+        if name in selected:
+            importlib.import_module(module_name).apply_args(subparser)
+    return parser
+
+
+def _profile_phases(parsed):
+    if not getattr(parsed, 'profile_cpu', None) and not getattr(parsed, 'profile_mem', False):
+        return contextlib.nullcontext()
+
+    from . import profiling
+    return profiling.profile_phases(parsed.profile_cpu, parsed.profile_mem)
+
+
+def _write_events(parsed):
+    if not getattr(parsed, 'events_jsonl', None):
+        return contextlib.nullcontext()
+
+    from . import events
+    return events.write_jsonl(parsed.events_jsonl)
+
+
+def main():
+    """ Main function called from console_scripts
+    """
+    logger = logging.getLogger('ebi')
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    selected = find_command(sys.argv[1:])
+    parser = make_parser(selected)
+    parsed = parser.parse_args()
+
+    if not hasattr(parsed, 'func'):
+        parser.print_help()
+        return
+
+    if getattr(parsed, 'server', None):
+        # Running on ``ebi serve``, without importing boto3 and ebcli here.
+        from . import server
+        sys.exit(server.request(parsed.server, sys.argv[1:]))
+
+    from . import trace
+
+    setup_session(parsed)
+    try:
+        with _profile_phases(parsed), trace.span(selected), _write_events(parsed):
+            parsed.func(parsed)
+    finally:
+        from . import clients
+        clients.log_stats()
+        trace.report(parsed.trace_json, parsed.trace_openmetrics, parsed.trace_statsd)
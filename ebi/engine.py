@@ -0,0 +1,256 @@
+import logging
+import queue
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError, EndpointConnectionError
+from ebcli.core import fileoperations
+from ebcli.objects.exceptions import NotInitializedError
+
+from . import clients, events
+
+logger = logging.getLogger(__name__)
+
+
+# Deploying, creating and cloning environments with boto3 instead of ``eb`` subprocesses.
+# Functions return exit codes same as ``eb`` does.
+EXIT_SUCCESS = 0
+EXIT_CONNECTION_ERROR = 2
+EXIT_FAILURE = 4
+EXIT_INTERRUPTED = 5
+
+# Default timeouts in minutes, same as ``eb deploy`` and what ebi passes to ``eb create``/``eb clone``.
+DEFAULT_DEPLOY_TIMEOUT = 5
+DEFAULT_CREATE_TIMEOUT = 45
+
+# Seconds between checks of the deadline and cancellation while waiting for events.
+CHECK_INTERVAL = 0.5
+
+# Event messages ``eb`` treats as the end of an operation.
+SUCCESS_MESSAGES = (
+    'Environment update completed successfully.',
+    'Successfully deployed new configuration to environment.',
+    'Environment health has been set to GREEN',
+)
+SUCCESS_PREFIXES = (
+    'Successfully launched environment:',
+)
+ERROR_MESSAGES = (
+    'Environment health has been set to RED',
+    'Failed to launch environment.',
+    'Failed to deploy application.',
+    'The environment was reverted to the previous configuration setting.',
+    'Failed to deploy configuration.',
+)
+ERROR_PREFIXES = (
+    'Create environment operation is complete, but with errors',
+    'Update environment operation is complete, but with errors',
+)
+
+
+class OperationFailed(Exception):
+    pass
+
+
+class OperationCancelled(Exception):
+    pass
+
+
+def _is_error_event(message):
+    return message in ERROR_MESSAGES or message.startswith(ERROR_PREFIXES) or (
+        message.startswith('Launched environment') and 'However, there were issues during launch.' in message)
+
+
+def _is_success_event(message):
+    return message in SUCCESS_MESSAGES or message.startswith(SUCCESS_PREFIXES)
+
+
+def wait_for_events(eb, app_name, env_name, request_id, timeout, cancel=None):
+    """ Waiting until events of :param request_id: tell the operation finished.
+
+    Events come from the stream of :param app_name: shared by operations in the process (see ``events``).
+
+    :param timeout: minutes to wait.
+    :param cancel: ``threading.Event`` to stop waiting when it's set.
+    :raise OperationFailed: when the operation failed or timed out.
+    :raise OperationCancelled: when :param cancel: is set. The operation goes on in AWS.
+    """
+    deadline = time.monotonic() + timeout * 60
+    with events.subscribe(app_name, env_name, request_id, region_name=eb.meta.region_name) as subscription:
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise OperationCancelled(f'Stopped waiting for the operation on {env_name}.')
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise OperationFailed(f'The operation on {env_name} timed out after {timeout} minutes.')
+            try:
+                event = subscription.get(timeout=min(remaining, CHECK_INTERVAL))
+            except queue.Empty:
+                continue
+            logger.info('%s %-5s %s: %s', event['EventDate'].strftime('%Y-%m-%d %H:%M:%S'),
+                        event['Severity'], env_name, event['Message'])
+            if _is_error_event(event['Message']):
+                raise OperationFailed(event['Message'])
+            if _is_success_event(event['Message']):
+                return
+
+
+def run(operation, *args, **kwargs):
+    """ Calling :param operation: and converting its result to an exit code same as ``eb``.
+    """
+    try:
+        operation(*args, **kwargs)
+    except OperationFailed as e:
+        logger.error('ERROR: %s', e)
+        return EXIT_FAILURE
+    except OperationCancelled as e:
+        logger.warning('%s', e)
+        return EXIT_INTERRUPTED
+    except EndpointConnectionError as e:
+        logger.error('ERROR: %s', e)
+        return EXIT_CONNECTION_ERROR
+    except (ClientError, BotoCoreError) as e:
+        logger.error('ERROR: %s - %s', e.__class__.__name__, e)
+        return EXIT_FAILURE
+    except KeyboardInterrupt:
+        return EXIT_INTERRUPTED
+    return EXIT_SUCCESS
+
+
+def _deploy(app_name, env_name, version, timeout, cancel, region_name):
+    eb = clients.get_client('elasticbeanstalk', region_name)
+    res = eb.update_environment(ApplicationName=app_name, EnvironmentName=env_name, VersionLabel=version)
+    wait_for_events(eb, app_name, env_name, res['ResponseMetadata']['RequestId'], timeout, cancel=cancel)
+
+
+def deploy(app_name, env_name, version, timeout=None, cancel=None, region_name=None):
+    """ Deploying :param version: to :param env_name: like ``eb deploy --version``.
+
+    :param cancel: ``threading.Event`` to stop waiting for the deployment when it's set.
+    :param region_name: region of :param env_name:, the region of the session by default.
+    :return: exit code.
+    """
+    return run(_deploy, app_name, env_name, version, timeout or DEFAULT_DEPLOY_TIMEOUT, cancel, region_name)
+
+
+def _parse_version(version):
+    return tuple(int(x) if x.isdigit() else 0 for x in version.split('.'))
+
+
+def find_latest_platform_arn(eb, branch_name):
+    """ Finding ARN of the latest ready platform version in :param branch_name:, or None.
+    """
+    latest = None
+    paginator = eb.get_paginator('list_platform_versions')
+    filters = [
+        {'Type': 'PlatformBranchName', 'Operator': '=', 'Values': [branch_name]},
+        {'Type': 'PlatformStatus', 'Operator': '=', 'Values': ['Ready']},
+    ]
+    for page in paginator.paginate(Filters=filters):
+        for summary in page['PlatformSummaryList']:
+            if latest is None or _parse_version(summary['PlatformVersion']) > _parse_version(latest['PlatformVersion']):
+                latest = summary
+    return latest and latest['PlatformArn']
+
+
+def get_default_platform_arn(eb):
+    """ Determining platform ARN from ``default_platform`` of ``.elasticbeanstalk/config.yml``.
+
+    It may be an ARN or a platform branch name (its latest version is used). None for others.
+    """
+    try:
+        platform = fileoperations.get_config_setting('global', 'default_platform')
+    except NotInitializedError:
+        return None
+    if not platform:
+        return None
+    if platform.startswith('arn:'):
+        return platform
+    return find_latest_platform_arn(eb, platform)
+
+
+def _create(app_name, env_name, version, cname, cfg, platform_arn, timeout):
+    eb = clients.get_client('elasticbeanstalk')
+    kwargs = {
+        'ApplicationName': app_name,
+        'EnvironmentName': env_name,
+        'VersionLabel': version,
+        'CNAMEPrefix': cname,
+    }
+    if cfg:
+        kwargs['TemplateName'] = cfg
+    else:
+        kwargs['PlatformArn'] = platform_arn
+    res = eb.create_environment(**kwargs)
+    wait_for_events(eb, app_name, env_name, res['ResponseMetadata']['RequestId'], timeout)
+
+
+def create(app_name, env_name, version, cname, cfg=None, timeout=None):
+    """ Creating :param env_name: running :param version: like ``eb create --version``.
+
+    Without :param cfg:, the platform is the default platform of the project.
+
+    :return: exit code, or None when the platform can't be determined without ``eb``.
+    """
+    platform_arn = None
+    if not cfg:
+        try:
+            platform_arn = get_default_platform_arn(clients.get_client('elasticbeanstalk'))
+        except ClientError as e:
+            logger.debug('Failed to determine the default platform: %s', e)
+        if not platform_arn:
+            return None
+    return run(_create, app_name, env_name, version, cname, cfg, platform_arn,
+               timeout or DEFAULT_CREATE_TIMEOUT)
+
+
+def _clone(app_name, env_name, clone_name, cname, exact, timeout, cancel):
+    eb = clients.get_client('elasticbeanstalk')
+    env = clients.describe_environments(ApplicationName=app_name, EnvironmentNames=[env_name])['Environments'][0]
+
+    # The configuration is taken from the environment by Elastic Beanstalk, like ``eb clone`` does.
+    kwargs = {
+        'ApplicationName': app_name,
+        'EnvironmentName': clone_name,
+        'CNAMEPrefix': cname,
+        'Tier': env['Tier'],
+        'TemplateSpecification': {'TemplateSource': {'EnvironmentName': env_name}},
+    }
+    if env.get('VersionLabel'):
+        kwargs['VersionLabel'] = env['VersionLabel']
+    platform_arn = env.get('PlatformArn')
+    if platform_arn and not exact:
+        branch = eb.describe_platform_version(PlatformArn=platform_arn)['PlatformDescription'].get('PlatformBranchName')
+        latest = branch and find_latest_platform_arn(eb, branch)
+        if latest and latest != platform_arn:
+            kwargs['PlatformArn'] = platform_arn = latest
+
+    logger.info('Cloning %s to %s (%s)', env_name, clone_name, platform_arn or env.get('SolutionStackName'))
+    if cancel is not None and cancel.is_set():
+        raise OperationCancelled(f'Cloning {env_name} to {clone_name} was cancelled.')
+    res = clients.get_ebcli_client().create_environment(**kwargs)
+    wait_for_events(eb, app_name, clone_name, res['ResponseMetadata']['RequestId'], timeout, cancel=cancel)
+
+
+def clone(app_name, env_name, clone_name, cname, exact=False, timeout=None, cancel=None):
+    """ Cloning :param env_name: to :param clone_name: like ``eb clone``.
+
+    The clone runs the same version with the configuration of :param env_name:. Unless :param exact:,
+    it runs the latest version of the platform branch.
+
+    :param cancel: ``threading.Event`` to stop waiting for the clone when it's set.
+    :return: exit code. ``EXIT_INTERRUPTED`` when it was cancelled.
+    """
+    return run(_clone, app_name, env_name, clone_name, cname, exact, timeout or DEFAULT_CREATE_TIMEOUT, cancel)
+
+
+def terminate(env_name):
+    """ Requesting termination of :param env_name: without waiting for it.
+
+    :return: True when it was requested, False when the environment doesn't exist (or can't be terminated).
+    """
+    try:
+        clients.get_client('elasticbeanstalk').terminate_environment(EnvironmentName=env_name)
+    except ClientError as e:
+        logger.debug('Failed to terminate %s: %s', env_name, e)
+        return False
+    return True
@@ -0,0 +1,318 @@
+import contextlib
+import datetime
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from . import clients
+from .waiter import Backoff
+
+logger = logging.getLogger(__name__)
+
+
+# Events of all environments operated in the process are polled by one ``describe_events`` call
+# per application and region, from the date of the last event seen, rather than by a call per
+# waiting operation. Each event is handed to subscriptions of its environment and request, and to
+# listeners of all events. Polling backs off while nothing happens, and speeds up on new events
+# and new subscriptions.
+
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 20
+POLL_BACKOFF = 1.5
+# Seconds before subscribing a stream starts from, allowing for the clock skew with AWS.
+LOOKBACK = 60
+# Seconds each poll reaches back before the last event seen, as events may show up late.
+OVERLAP = 10
+# Seconds of events kept to be replayed to new subscriptions, whose operation may have been
+# polled already.
+REPLAY = 60
+THROTTLING_CODES = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+# Polls in a row failing by server errors or connection errors (retried with the backoff) before
+# subscriptions are failed. Other errors, e.g. access denied, fail them at once.
+MAX_TRANSIENT_FAILURES = 5
+
+_lock = threading.Lock()
+_streams = {}
+_listeners = []
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _event_key(event):
+    return event['EventDate'], event.get('EnvironmentName'), event.get('RequestId'), event['Message']
+
+
+class Subscription:
+    """ Events of a stream for :param env_name: and :param request_id: (any when None).
+
+    Events are passed to :param callback: on the polling thread when it's given, or queued to
+    be taken by ``get`` and iterating the subscription, oldest first. Errors of polling are
+    raised from these too.
+    """
+
+    def __init__(self, stream, env_name=None, request_id=None, callback=None):
+        self.stream = stream
+        self.env_name = env_name
+        self.request_id = request_id
+        self.callback = callback
+        self._queue = queue.Queue()
+
+    def matches(self, event):
+        return ((self.env_name is None or event.get('EnvironmentName') == self.env_name)
+                and (self.request_id is None or event.get('RequestId') == self.request_id))
+
+    def deliver(self, item):
+        if self.callback is None:
+            self._queue.put(item)
+        elif not isinstance(item, Exception):
+            try:
+                self.callback(item)
+            except Exception:
+                logger.exception('Failed to handle the event %s', item['Message'])
+
+    def get(self, timeout=None):
+        """ Returning the next event, waiting :param timeout: seconds at most.
+
+        :raise queue.Empty: when no event came in time.
+        """
+        item = self._queue.get(timeout=timeout)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def close(self):
+        self.stream.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class EventStream:
+    """ Polling events of :param app_name: in :param region_name: while it has subscriptions.
+    """
+
+    def __init__(self, app_name, region_name=None):
+        self.app_name = app_name
+        self.region_name = region_name
+        self.cursor = None
+        self.polls = 0
+        self._recent = {}
+        self._subscriptions = []
+        self._condition = threading.Condition()
+        self._backoff = Backoff(MIN_POLL_INTERVAL, MAX_POLL_INTERVAL, POLL_BACKOFF)
+        self._hurry = False
+        self._thread = None
+        self._failures = 0
+
+    def subscribe(self, env_name=None, request_id=None, callback=None):
+        """ Returning a ``Subscription`` to events of :param env_name: and :param request_id:.
+
+        Events since a while before subscribing are delivered, so the operation can be requested
+        just before.
+        """
+        subscription = Subscription(self, env_name, request_id, callback)
+        with self._condition:
+            for event in sorted(self._recent.values(), key=lambda e: e['EventDate']):
+                if subscription.matches(event):
+                    subscription.deliver(event)
+            self._subscriptions.append(subscription)
+            self._backoff.reset()
+            self._hurry = True
+            if self._thread is None:
+                start = _now() - datetime.timedelta(seconds=LOOKBACK)
+                self.cursor = start if self.cursor is None else max(self.cursor, start)
+                self._thread = threading.Thread(target=self._run, name=f'ebi-events-{self.app_name}', daemon=True)
+                self._thread.start()
+            self._condition.notify_all()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._condition:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+            self._condition.notify_all()
+
+    def poll(self):
+        """ Polling events since the cursor over pages, and delivering new ones.
+
+        :return: the number of new events.
+        """
+        eb = clients.get_client('elasticbeanstalk', self.region_name)
+        paginator = eb.get_paginator('describe_events')
+        try:
+            events = [e for page in paginator.paginate(ApplicationName=self.app_name,
+                                                       StartTime=self.cursor - datetime.timedelta(seconds=OVERLAP))
+                      for e in page['Events']]
+        except ClientError as e:
+            if e.response['Error']['Code'] in THROTTLING_CODES:
+                logger.debug('Polling events of %s was throttled: %s', self.app_name, e)
+            elif e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500:
+                self._retry(e)
+            else:
+                self._fail(e)
+            return 0
+        except BotoCoreError as e:
+            self._retry(e)
+            return 0
+        self._failures = 0
+        self.polls += 1
+
+        with self._condition:
+            new_events = sorted((e for e in events if _event_key(e) not in self._recent),
+                                key=lambda e: e['EventDate'])
+            for event in new_events:
+                self._recent[_event_key(event)] = event
+                self.cursor = max(self.cursor, event['EventDate'])
+            since = self.cursor - datetime.timedelta(seconds=max(OVERLAP, REPLAY))
+            self._recent = {key: e for key, e in self._recent.items() if key[0] >= since}
+            # Subscriptions made from now on get these events by replaying.
+            subscriptions = list(self._subscriptions)
+        with _lock:
+            listeners = list(_listeners)
+        for event in new_events:
+            for subscription in subscriptions:
+                if subscription.matches(event):
+                    subscription.deliver(event)
+            for listener in listeners:
+                try:
+                    listener(event, self.region_name)
+                except Exception:
+                    logger.exception('Failed to handle the event %s', event['Message'])
+        return len(new_events)
+
+    def _retry(self, error):
+        self._failures += 1
+        if self._failures < MAX_TRANSIENT_FAILURES:
+            logger.debug('Polling events of %s failed (%d in a row), retrying: %s', self.app_name, self._failures, error)
+            return
+        self._failures = 0
+        self._fail(error)
+
+    def _fail(self, error):
+        logger.debug('Failed to poll events of %s: %s', self.app_name, error)
+        with self._condition:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.deliver(error)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._subscriptions:
+                    self._thread = None
+                    return
+            new = self.poll()
+            with self._condition:
+                if new:
+                    self._backoff.reset()
+                self._hurry = False
+                deadline = time.monotonic() + self._backoff.next()
+                while self._subscriptions and time.monotonic() < deadline:
+                    self._condition.wait(deadline - time.monotonic())
+                    if self._hurry:
+                        # The operation of a new subscription is likely to report soon.
+                        deadline = min(deadline, time.monotonic() + MIN_POLL_INTERVAL)
+                        self._hurry = False
+
+
+def get_stream(app_name, region_name=None):
+    """ Returning the stream of :param app_name: in :param region_name: shared in the process.
+    """
+    key = (app_name, region_name)
+    with _lock:
+        stream = _streams.get(key)
+        if stream is None:
+            stream = _streams[key] = EventStream(app_name, region_name)
+    return stream
+
+
+def subscribe(app_name, env_name=None, request_id=None, callback=None, region_name=None):
+    """ Subscribing to events of :param env_name: of :param app_name: (all environments when None).
+
+    :param request_id: request ID of the operation to take events of, any when None.
+    :param callback: function called with each event, instead of queueing events.
+    :return: ``Subscription``. It should be closed (or used as a context manager) once done.
+    """
+    return get_stream(app_name, region_name).subscribe(env_name, request_id, callback)
+
+
+def add_listener(listener):
+    """ Calling :param listener: with each new event and its region, of any stream.
+    """
+    with _lock:
+        _listeners.append(listener)
+
+
+def remove_listener(listener):
+    with _lock:
+        if listener in _listeners:
+            _listeners.remove(listener)
+
+
+def to_json(event, region_name=None):
+    """ Converting :param event: of :param region_name: to a line of JSON.
+    """
+    return json.dumps({
+        'date': event['EventDate'].isoformat(),
+        'region': region_name,
+        'application': event.get('ApplicationName'),
+        'environment': event.get('EnvironmentName'),
+        'request_id': event.get('RequestId'),
+        'severity': event.get('Severity'),
+        'message': event['Message'],
+    })
+
+
+@contextlib.contextmanager
+def listen_jsonl(write, environments=None):
+    """ Calling :param write: with each event polled while in the context as a line of JSON.
+
+    :param environments: set of (app_name, env_name) tuples to write events of, all when None.
+    """
+    lock = threading.Lock()
+
+    def listener(event, region_name):
+        if environments is not None and (event.get('ApplicationName'), event.get('EnvironmentName')) not in environments:
+            return
+        with lock:
+            write(to_json(event, region_name))
+
+    add_listener(listener)
+    try:
+        yield
+    finally:
+        remove_listener(listener)
+
+
+@contextlib.contextmanager
+def write_jsonl(path, environments=None):
+    """ Writing events polled while in the context to :param path: (``-`` for stdout) as lines of JSON.
+
+    :param environments: set of (app_name, env_name) tuples to write events of, all when None.
+    """
+    f = sys.stdout if path == '-' else open(path, 'a')
+
+    def write(line):
+        f.write(line + '\n')
+        f.flush()
+
+    try:
+        with listen_jsonl(write, environments):
+            yield
+    finally:
+        if f is not sys.stdout:
+            f.close()
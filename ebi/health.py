@@ -0,0 +1,134 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# describe_instance_status accepts up to 100 instance IDs per call.
+INSTANCE_IDS_PER_CALL = 100
+HEALTHY_EB_STATUSES = ('Ok', 'Info')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_group_instance_ids(autoscale, group_name):
+    as_json = autoscale.describe_auto_scaling_groups(AutoScalingGroupNames=[group_name])
+    return [instance['InstanceId'] for instance in as_json['AutoScalingGroups'][0]['Instances']]
+
+
+def ec2_check(group_name, env_name, number):
+    """ Making a check that all of :param number: instances of :param group_name: have EC2 status ``ok``.
+    """
+    from . import clients
+
+    autoscale = clients.get_client('autoscaling')
+    ec2 = clients.get_client('ec2')
+    paginator = ec2.get_paginator('describe_instance_status')
+
+    def check():
+        instance_ids = get_group_instance_ids(autoscale, group_name)
+        if len(instance_ids) != number:
+            return False
+        # describe_instance_status returns only running instances by default,
+        # so fewer statuses than instances means some are not running yet.
+        healthy = 0
+        for chunk in _chunks(instance_ids, INSTANCE_IDS_PER_CALL):
+            for page in paginator.paginate(InstanceIds=chunk):
+                healthy += sum(1 for status in page['InstanceStatuses']
+                               if status['InstanceStatus']['Status'] == 'ok')
+        logger.debug('%d/%d instances of %s are healthy', healthy, number, group_name)
+        return healthy == number
+    return check
+
+
+def eb_check(group_name, env_name, number):
+    """ Making a check that :param env_name: has :param number: instances and these are healthy
+    on enhanced health reporting, in a single call.
+    """
+    from . import clients
+
+    eb = clients.get_client('elasticbeanstalk')
+
+    def check():
+        statuses = []
+        kwargs = {'EnvironmentName': env_name, 'AttributeNames': ['HealthStatus']}
+        while True:
+            res = eb.describe_instances_health(**kwargs)
+            statuses += [instance.get('HealthStatus') for instance in res['InstanceHealthList']]
+            if not res.get('NextToken'):
+                break
+            kwargs['NextToken'] = res['NextToken']
+        healthy = sum(1 for status in statuses if status in HEALTHY_EB_STATUSES)
+        logger.debug('%d/%d instances of %s are healthy', healthy, number, env_name)
+        return len(statuses) == number and healthy == number
+    return check
+
+
+def _find_load_balancer_targets(elbv2, load_balancers):
+    """ Returning ARNs of target groups of application and network :param load_balancers:, and names of classic ones.
+
+    Elastic Beanstalk names application and network load balancers by ARN or name, classic ones by name.
+    """
+    from botocore.exceptions import ClientError
+
+    target_group_arns = []
+    classic_names = []
+    for load_balancer in load_balancers:
+        arn = load_balancer['Name']
+        if not arn.startswith('arn:'):
+            try:
+                arn = elbv2.describe_load_balancers(Names=[arn])['LoadBalancers'][0]['LoadBalancerArn']
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'LoadBalancerNotFound':
+                    raise
+                classic_names.append(load_balancer['Name'])
+                continue
+        for page in elbv2.get_paginator('describe_target_groups').paginate(LoadBalancerArn=arn):
+            target_group_arns += [group['TargetGroupArn'] for group in page['TargetGroups']]
+    return target_group_arns, classic_names
+
+
+def elb_check(group_name, env_name, number):
+    """ Making a check that the load balancer of :param env_name: has :param number: healthy targets
+    (instances in service for classic load balancers).
+
+    An environment without targets to check is never healthy.
+    """
+    from . import clients
+
+    eb = clients.get_client('elasticbeanstalk')
+    elbv2 = clients.get_client('elbv2')
+    elb = clients.get_client('elb')
+    resources = eb.describe_environment_resources(EnvironmentName=env_name)['EnvironmentResources']
+    target_group_arns, classic_names = _find_load_balancer_targets(elbv2, resources['LoadBalancers'])
+    if not target_group_arns and not classic_names:
+        logger.warning('%s has no load balancer targets to check the health of', env_name)
+
+    def check():
+        if not target_group_arns and not classic_names:
+            return False
+        for arn in target_group_arns:
+            states = [target['TargetHealth']['State']
+                      for target in elbv2.describe_target_health(TargetGroupArn=arn)['TargetHealthDescriptions']]
+            healthy = states.count('healthy')
+            logger.debug('%d/%d targets of %s are healthy', healthy, number, arn)
+            if not states or len(states) != number or healthy != number:
+                return False
+        for name in classic_names:
+            states = [instance['State']
+                      for instance in elb.describe_instance_health(LoadBalancerName=name)['InstanceStates']]
+            healthy = states.count('InService')
+            logger.debug('%d/%d instances of %s are in service', healthy, number, name)
+            if not states or len(states) != number or healthy != number:
+                return False
+        return True
+    return check
+
+
+HEALTH_CHECKS = {
+    'ec2': ec2_check,
+    'eb': eb_check,
+    'elb': elb_check,
+}
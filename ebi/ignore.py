@@ -0,0 +1,315 @@
+import os
+import re
+import stat
+
+# Matching ``.ebignore`` like ``fileoperations.get_ebignore_list`` of ebcli does (gitwildmatch of pathspec),
+# but with patterns compiled once and directories pruned while walking, instead of listing every ignored path.
+
+GLOB_CHARS = frozenset('*?[\\')
+
+
+class IgnorePatternError(ValueError):
+    pass
+
+
+def _translate_segment(seg):
+    """ Translating a path segment glob to a regex, like ``fnmatch.translate`` with ``FNM_PATHNAME``.
+    """
+    regex = ''
+    escape = False
+    i, end = 0, len(seg)
+    while i < end:
+        char = seg[i]
+        i += 1
+        if escape:
+            escape = False
+            regex += re.escape(char)
+        elif char == '\\':
+            escape = True
+        elif char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            j = i
+            if j < end and seg[j] in '!^':
+                j += 1
+            if j < end and seg[j] == ']':
+                j += 1
+            while j < end and seg[j] != ']':
+                j += 1
+            if j < end:
+                j += 1
+                expr = '['
+                if seg[i] in '!^':
+                    expr += '^'
+                    i += 1
+                regex += expr + seg[i:j].replace('\\', '\\\\')
+                i = j
+            else:
+                regex += '\\['
+        else:
+            regex += re.escape(char)
+    if escape:
+        raise IgnorePatternError(f'Escape character found with no next character to escape: {seg!r}')
+    return regex
+
+
+def parse_pattern(line):
+    """ Parsing a line of ``.ebignore``.
+
+    :return: (normalized segments, include) tuple. Segments are None for blank lines and comments.
+             Leading ``**`` means any directories, trailing ``**`` means anything under the directory.
+    """
+    pattern = line.lstrip() if line.endswith('\\ ') else line.strip()
+    if not pattern or pattern.startswith('#') or pattern == '/':
+        return None, None
+    include = not pattern.startswith('!')
+    if not include:
+        pattern = pattern[1:]
+
+    segs = pattern.split('/')
+    for i in range(len(segs) - 1, 0, -1):
+        if segs[i - 1] == '**' and segs[i] == '**':
+            del segs[i]
+    if len(segs) == 2 and segs[0] == '**' and not segs[1]:
+        # '**/' matches everything but files on the root.
+        return ['**/'], include
+    if not segs[0]:
+        # Leading slash anchors the pattern on the root.
+        del segs[0]
+    elif len(segs) == 1 or (len(segs) == 2 and not segs[1]):
+        # A name without slashes matches on any directory.
+        if segs[0] != '**':
+            segs.insert(0, '**')
+    if not segs:
+        raise IgnorePatternError(f'Invalid pattern: {line!r}')
+    if not segs[-1] and len(segs) > 1:
+        segs[-1] = '**'
+    return segs, include
+
+
+def _segments_to_regex(segs):
+    """ Translating normalized segments to (file regex, directory regex).
+
+    The directory regex matches directories whose descendants all match the file regex.
+    """
+    if segs == ['**/']:
+        return '^.+/.*$', '^.+$'
+    output = ['^']
+    need_slash = False
+    end = len(segs) - 1
+    dir_regex = None
+    for i, seg in enumerate(segs):
+        if seg == '**':
+            if i == 0 and i == end:
+                return '^[^/]+(?:/.*)?$', '^[^/]+$'
+            elif i == 0:
+                output.append('(?:.+/)?')
+                need_slash = False
+            elif i == end:
+                dir_regex = ''.join(output) + '$'
+                output.append('/.*')
+            else:
+                output.append('(?:/.+)?')
+                need_slash = True
+        else:
+            if need_slash:
+                output.append('/')
+            output.append('[^/]+' if seg == '*' else _translate_segment(seg))
+            if i == end:
+                dir_regex = ''.join(output) + '$'
+                output.append('(?:/.*)?')
+            need_slash = True
+    output.append('$')
+    return ''.join(output), dir_regex
+
+
+def _is_literal(seg):
+    return seg != '**' and not GLOB_CHARS.intersection(seg)
+
+
+class _Run:
+    """ Consecutive patterns of the same polarity.
+
+    Literal patterns are looked up in sets on path components and prefixes, and the others are
+    combined into one regex. Each kind has a file check and a directory check, see ``_segments_to_regex``.
+    """
+
+    def __init__(self, include):
+        self.include = include
+        self.names = set()          # 'name': any component
+        self.dir_names = set()      # 'name/': any component but the last
+        self.prefixes = set()       # '/a/b': the path or its ancestors
+        self.dir_prefixes = set()   # '/a/b/': ancestors of the path
+        self.regexes = []
+        self.dir_regexes = []
+        self.regex = self.dir_regex = None
+        # Leading literal segments of anchored patterns, None for patterns matching on any directory.
+        self.anchors = []
+
+    def add(self, segs):
+        if segs[0] in ('**', '**/'):
+            self.anchors.append(None)
+        else:
+            anchor = []
+            for seg in segs:
+                if not _is_literal(seg):
+                    break
+                anchor.append(seg)
+            self.anchors.append(anchor)
+
+        if len(segs) == 2 and segs[0] == '**' and _is_literal(segs[1]):
+            self.names.add(segs[1])
+        elif len(segs) == 3 and segs[0] == '**' and segs[2] == '**' and _is_literal(segs[1]):
+            self.dir_names.add(segs[1])
+        elif all(_is_literal(seg) for seg in segs):
+            self.prefixes.add('/'.join(segs))
+        elif len(segs) > 1 and segs[-1] == '**' and all(_is_literal(seg) for seg in segs[:-1]):
+            self.dir_prefixes.add('/'.join(segs[:-1]))
+        else:
+            regex, dir_regex = _segments_to_regex(segs)
+            self.regexes.append(regex)
+            self.dir_regexes.append(dir_regex)
+
+    def compile(self):
+        if self.regexes:
+            self.regex = re.compile('|'.join(f'(?:{r})' for r in self.regexes))
+            self.dir_regex = re.compile('|'.join(f'(?:{r})' for r in self.dir_regexes))
+
+    def matches(self, path, parts):
+        if self.names and not self.names.isdisjoint(parts):
+            return True
+        if self.dir_names and not self.dir_names.isdisjoint(parts[:-1]):
+            return True
+        if self.prefixes or self.dir_prefixes:
+            prefix = ''
+            for i, part in enumerate(parts):
+                prefix = prefix + '/' + part if i else part
+                if prefix in self.prefixes or (i < len(parts) - 1 and prefix in self.dir_prefixes):
+                    return True
+        return self.regex is not None and self.regex.match(path) is not None
+
+    def may_match_under(self, parts):
+        """ Whether a pattern may match something under the directory of :param parts:.
+        """
+        for anchor in self.anchors:
+            if anchor is None or all(a == p for a, p in zip(anchor, parts)):
+                return True
+        return False
+
+    def covers(self, path, parts):
+        """ Whether every descendant of the directory :param path: matches.
+        """
+        if self.names and not self.names.isdisjoint(parts):
+            return True
+        if self.dir_names and not self.dir_names.isdisjoint(parts):
+            return True
+        prefix = ''
+        for i, part in enumerate(parts):
+            prefix = prefix + '/' + part if i else part
+            if prefix in self.prefixes or prefix in self.dir_prefixes:
+                return True
+            if self.dir_regex is not None and self.dir_regex.match(prefix) is not None:
+                return True
+        return False
+
+
+class Matcher:
+    """ Compiled ``.ebignore`` patterns. The last pattern matching a path decides, like gitignore.
+    """
+
+    def __init__(self, lines):
+        self.runs = []
+        for line in lines:
+            if not line:
+                continue
+            segs, include = parse_pattern(line)
+            if segs is None:
+                continue
+            if not self.runs or self.runs[-1].include != include:
+                self.runs.append(_Run(include))
+            self.runs[-1].add(segs)
+        for run in self.runs:
+            run.compile()
+
+    def __call__(self, path):
+        """ Whether the project relative file :param path: is ignored.
+        """
+        parts = path.split('/')
+        for run in reversed(self.runs):
+            if run.matches(path, parts):
+                return run.include
+        return False
+
+    def prunes(self, path):
+        """ Whether everything under the project relative directory :param path: is ignored.
+        """
+        parts = path.split('/')
+        for run in reversed(self.runs):
+            if run.include:
+                if run.covers(path, parts):
+                    return True
+            elif run.may_match_under(parts):
+                # Files under it may be re-included by the negation.
+                return False
+        return False
+
+
+def load(path):
+    """ Loading the ignore file on :param path: as a ``Matcher``.
+    """
+    with open(path, encoding='utf-8') as f:
+        return Matcher(f)
+
+
+def walk(root, matcher, is_excluded=None):
+    """ Yielding (relative path, path, is symlink) of files and directory symlinks in :param root:.
+
+    It visits entries in the same order as ``os.walk`` with sorted names, skipping directories
+    whose contents are all ignored by :param matcher: (or in ``.elasticbeanstalk``) without listing them.
+    Files ignored by :param matcher:, :param is_excluded: or being editor backups or sockets are skipped.
+    The first file of a directory is preceded by the directory, whose relative path ends with ``/``.
+    """
+    is_excluded = is_excluded or (lambda p: False)
+
+    def visit(dirpath, reldir):
+        try:
+            with os.scandir(dirpath) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return
+        dirs = []
+        files = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            (dirs if is_dir else files).append(entry)
+
+        for entry in dirs:
+            relpath = reldir + entry.name
+            if entry.is_symlink() and not (is_excluded(relpath) or matcher(relpath)):
+                yield relpath, entry.path, True
+
+        dir_added = not reldir
+        for entry in files:
+            arcname = reldir + entry.name
+            if (entry.name.endswith('~') or is_excluded(arcname) or matcher(arcname)
+                    or stat.S_ISSOCK(entry.stat().st_mode)):
+                continue
+            if not dir_added:
+                yield reldir, dirpath, False
+                dir_added = True
+            yield arcname, entry.path, entry.is_symlink()
+
+        for entry in dirs:
+            if entry.is_symlink():
+                continue
+            relpath = reldir + entry.name
+            if '.elasticbeanstalk' in relpath or matcher.prunes(relpath):
+                continue
+            yield from visit(entry.path, relpath + '/')
+
+    yield from visit(root, '')
@@ -0,0 +1,239 @@
+import collections
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+
+from . import trace
+
+logger = logging.getLogger(__name__)
+
+
+# ``--profile-cpu`` and ``--profile-mem`` profile each phase of the run, the spans of ``trace``
+# (hashing, bundling, uploading, API calls, deploying and waiting...). Nothing is imported or
+# hooked without these options.
+#
+# cProfile before Python 3.12 profiles a thread, so each thread running in a phase (see
+# ``trace.wrap``) has its own profile of it, merged when written. From 3.12, a profile sees calls
+# of all threads and only one can be enabled at once, so only the thread starting the profiler
+# profiles its phases, and threads working meanwhile are in the file of the phase open on it.
+# A phase opened in another one pauses the profile of the outer one, so each file has the work
+# of its phase only. Memory is traced for the whole process,
+# so allocations of phases running at once are mixed. The traced peak of a phase is the highest
+# peak between boundaries of phases while it was open. Snapshots of each phase take a while with
+# many objects alive, which makes phases slower, but they're left out of profiles and peaks.
+
+# Allocation lines logged for each phase.
+DEFAULT_TOP = 10
+# Frames kept of each allocation, the line allocating it and its callers.
+TRACEBACK_FRAMES = 1
+IGNORED_FILES = (tracemalloc.__file__, '<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>',
+                 '<unknown>')
+PER_THREAD = sys.version_info < (3, 12)
+
+
+def _peak_rss():
+    """ Peak RSS in MiB of this process and its waited children, or None where it's unknown.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in bytes on macOS, in KiB on Linux.
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / unit
+
+
+def _file_name(index, s):
+    name = s.path.replace('/', '.')
+    if 'env' in s.attributes:
+        name += f'-{s.attributes["env"]}'
+    return f'{index:03d}-' + re.sub(r'[^\w.-]', '_', name) + '.pstats'
+
+
+class PhaseProfiler:
+    """ ``trace`` hook profiling phases, CPU into :param cpu_dir: and memory when :param memory:.
+
+    Results are written and logged by ``report``.
+    """
+
+    def __init__(self, cpu_dir=None, memory=False, top=DEFAULT_TOP):
+        self.cpu_dir = cpu_dir
+        self.memory = memory
+        self.top = top
+        self.profiles = collections.defaultdict(list)
+        self.allocations = {}
+        self._peaks = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._owner = None
+
+    @contextlib.contextmanager
+    def __call__(self, s, thread=False):
+        if s is None:
+            yield
+            return
+        with contextlib.ExitStack() as stack:
+            if self.cpu_dir:
+                stack.enter_context(self._profile_cpu(s))
+            if self.memory and not thread:
+                stack.enter_context(self._trace_memory(s))
+            yield
+
+    def _stack(self):
+        return self._local.__dict__.setdefault('stack', [])
+
+    @contextlib.contextmanager
+    def _paused(self):
+        """ Not profiling the work of profiling itself.
+        """
+        stack = self._stack()
+        if stack:
+            stack[-1].disable()
+        try:
+            yield
+        finally:
+            if stack:
+                stack[-1].enable()
+
+    def _update_peaks(self):
+        """ Attributing the traced peak since the last boundary of a phase to phases open.
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        for s in self._peaks:
+            self._peaks[s] = max(self._peaks[s], peak)
+
+    @contextlib.contextmanager
+    def _profile_cpu(self, s):
+        if not PER_THREAD and threading.get_ident() != self._owner:
+            yield
+            return
+        stack = self._stack()
+        profile = cProfile.Profile()
+        if stack:
+            stack[-1].disable()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Another profiler is active, e.g. ``python -m cProfile``.
+            logger.debug('Not profiling CPU of %s: %s', s.path, e)
+            profile = None
+        if profile is None:
+            if stack:
+                stack[-1].enable()
+            yield
+            return
+        with self._lock:
+            self.profiles[s].append(profile)
+        stack.append(profile)
+        try:
+            yield
+        finally:
+            profile.disable()
+            stack.pop()
+            if stack:
+                stack[-1].enable()
+
+    @contextlib.contextmanager
+    def _trace_memory(self, s):
+        with self._paused():
+            before = tracemalloc.take_snapshot()
+            with self._lock:
+                self._update_peaks()
+                start = tracemalloc.get_traced_memory()[0]
+                self._peaks[s] = start
+        try:
+            yield
+        finally:
+            with self._paused():
+                with self._lock:
+                    self._update_peaks()
+                    current = tracemalloc.get_traced_memory()[0]
+                    peak = self._peaks.pop(s)
+                stats = tracemalloc.take_snapshot().compare_to(before, 'lineno')
+                del before
+                with self._lock:
+                    # Dropping the peak of comparing, at the cost of other phases' allocations meanwhile.
+                    tracemalloc.reset_peak()
+                s.set(traced_mib=round((current - start) / 1024 / 1024, 3),
+                      traced_peak_mib=round(peak / 1024 / 1024, 3))
+                rss = _peak_rss()
+                if rss is not None:
+                    s.set(peak_rss_mib=round(rss, 1))
+                self.allocations[s] = [stat for stat in stats if stat.size_diff > 0
+                                       and stat.traceback[0].filename not in IGNORED_FILES][:self.top]
+
+    def start(self):
+        self._owner = threading.get_ident()
+        if self.memory:
+            tracemalloc.start(TRACEBACK_FRAMES)
+        trace.hooks.append(self)
+
+    def stop(self):
+        trace.hooks.remove(self)
+        if self.memory:
+            tracemalloc.stop()
+
+    def write_cpu(self):
+        """ Writing merged profiles of each phase to pstats files in ``cpu_dir``.
+        """
+        os.makedirs(self.cpu_dir, exist_ok=True)
+        for index, s in enumerate(trace.iter_spans()):
+            # Profiles of threads which called nothing have no stats to merge.
+            profiles = [profile for profile in self.profiles.get(s, ()) if profile.getstats()]
+            if not profiles:
+                continue
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            path = os.path.join(self.cpu_dir, _file_name(index, s))
+            stats.dump_stats(path)
+            logger.info('CPU profile of %s (%.2fs): %s', s.path, s.duration or 0.0, path)
+
+    def log_memory(self):
+        for s in trace.iter_spans():
+            if s not in self.allocations:
+                continue
+            logger.info('Memory of %s: %+.1f MiB traced (peak %.1f MiB), peak RSS %s MiB', s.path,
+                        s.attributes['traced_mib'], s.attributes['traced_peak_mib'],
+                        s.attributes.get('peak_rss_mib', 'unknown'))
+            for stat in self.allocations[s]:
+                frame = stat.traceback[0]
+                logger.info('  %+9.1f KiB %6d blocks  %s:%d', stat.size_diff / 1024, stat.count_diff,
+                            frame.filename, frame.lineno)
+
+    def report(self):
+        """ Writing CPU profiles and logging allocations of each phase.
+        Failures are logged without failing the run.
+        """
+        if self.cpu_dir:
+            try:
+                self.write_cpu()
+            except (OSError, TypeError) as e:
+                logger.warning('Failed to write CPU profiles to %s: %s', self.cpu_dir, e)
+        if self.memory:
+            self.log_memory()
+
+
+@contextlib.contextmanager
+def profile_phases(cpu_dir=None, memory=False, top=DEFAULT_TOP):
+    """ Profiling phases of the run in the context, reporting them at the end.
+
+    :param cpu_dir: directory to write a pstats file of each phase to, no CPU profiling when None.
+    :param memory: whether to trace allocations and peak RSS of each phase.
+    :param top: the number of allocation lines logged for each phase.
+    """
+    profiler = PhaseProfiler(cpu_dir, memory, top)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        profiler.report()
@@ -0,0 +1,136 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+import boto3
+
+from . import cache, clients
+
+logger = logging.getLogger(__name__)
+
+
+# Seconds entries on disk are valid. 0 disables the disk cache.
+DEFAULT_TTL = 0
+
+# Kind of the CNAME index on disk. It's changed when the index changes.
+CNAME_INDEX_KIND = 'cname-prefixes'
+
+_cname_indexes = {}
+
+
+def _cache_path(kind, name):
+    session = boto3._get_default_session()
+    scope = f'{session.profile_name}:{session.region_name}:{kind}:{name}'
+    return os.path.join(cache.get_cache_dir('resolver'), hashlib.sha256(scope.encode()).hexdigest()[:16] + '.json')
+
+
+def _load(kind, name, ttl):
+    if not ttl:
+        return None
+    try:
+        with open(_cache_path(kind, name)) as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if time.time() - data['written'] > ttl:
+        return None
+    logger.debug('Using cached %s of %s', kind, name)
+    return data['value']
+
+
+def _store(kind, name, value, ttl):
+    if not ttl:
+        return
+    path = _cache_path(kind, name)
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump({'written': time.time(), 'value': value}, f)
+    os.replace(tmp, path)
+
+
+def iter_environments(app_name):
+    """ Iterating all live environments of :param app_name: over pages.
+    """
+    paginator = clients.get_client('elasticbeanstalk').get_paginator('describe_environments')
+    for page in paginator.paginate(ApplicationName=app_name, IncludeDeleted=False):
+        yield from page['Environments']
+
+
+def build_cname_index(environments):
+    """ Making a dict of CNAME prefix to environment name from :param environments:.
+
+    Every dotted prefix of a CNAME is indexed, e.g. myenv and myenv.ap-northeast-1 of
+    myenv.ap-northeast-1.elasticbeanstalk.com, the same as matching CNAMEs starting with the prefix and a dot.
+    If a prefix is duplicated, the environment having the longer CNAME wins.
+    For example, there are myenv.ap-northeast-1.elasticbeanstalk.com and myenv.elasticbeanstalk.com,
+    the environment of myenv.ap-northeast-1.elasticbeanstalk.com is indexed.
+    """
+    index = {}
+    for env in sorted((e for e in environments if e.get('CNAME')), key=lambda e: len(e['CNAME'])):
+        labels = env['CNAME'].split('.')
+        for i in range(1, len(labels)):
+            index['.'.join(labels[:i])] = env['EnvironmentName']
+    return index
+
+
+def get_cname_index(app_name, ttl=DEFAULT_TTL):
+    """ Returning the CNAME prefix index of :param app_name:, built once per run.
+
+    :param ttl: seconds to reuse the index saved on disk by earlier runs. 0 doesn't use the disk.
+    """
+    index = _cname_indexes.get(app_name)
+    if index is None:
+        index = _load(CNAME_INDEX_KIND, app_name, ttl)
+        if index is None:
+            index = build_cname_index(iter_environments(app_name))
+            _store(CNAME_INDEX_KIND, app_name, index, ttl)
+        _cname_indexes[app_name] = index
+    return index
+
+
+def find_environment_by_cname(app_name, cname, ttl=DEFAULT_TTL):
+    """ Returning the name of the environment of :param app_name: having :param cname: prefix, or None.
+    """
+    return get_cname_index(app_name, ttl).get(cname)
+
+
+def get_auto_scaling_group_names(env_name, ttl=DEFAULT_TTL):
+    """ Returning names of auto scaling groups of :param env_name: from its resources.
+    """
+    names = _load('asgs', env_name, ttl)
+    if names is None:
+        res = clients.get_client('elasticbeanstalk').describe_environment_resources(EnvironmentName=env_name)
+        names = [group['Name'] for group in res['EnvironmentResources']['AutoScalingGroups']]
+        _store('asgs', env_name, names, ttl)
+    return names
+
+
+def get_auto_scaling_group_name(env_name, ttl=DEFAULT_TTL):
+    """ Returning the name of the auto scaling group of :param env_name:.
+
+    :raise LookupError: when the environment has no auto scaling group.
+    """
+    names = get_auto_scaling_group_names(env_name, ttl)
+    if not names:
+        raise LookupError(f'Environment {env_name} has no auto scaling group')
+    return names[0]
+
+
+def reset():
+    """ Forgetting CNAME indexes built in the process, e.g. before each run of ``ebi serve``.
+
+    Indexes saved on disk are still used within their TTL.
+    """
+    _cname_indexes.clear()
+
+
+def invalidate(app_name):
+    """ Forgetting the CNAME index of :param app_name:, e.g. after swapping CNAMEs.
+    """
+    _cname_indexes.pop(app_name, None)
+    try:
+        os.remove(_cache_path(CNAME_INDEX_KIND, app_name))
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,302 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from . import clients, trace
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_CONCURRENCY = 8
+DEFAULT_PART_SIZE = 16  # MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+MAX_PART_ATTEMPTS = 5
+# The largest object ``CopyObject`` copies. Larger ones are copied in parts.
+MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+
+
+class UploadError(Exception):
+    pass
+
+
+def get_part_size(size, part_size):
+    """ Adjusting :param part_size: (bytes) to S3 limits for a :param size: bytes object.
+    """
+    part_size = max(part_size, MIN_PART_SIZE)
+    while size > part_size * MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+def find_upload_id(s3, bucket, key):
+    """ Finding the latest unfinished multipart upload of :param key: to resume it.
+    """
+    latest = None
+    paginator = s3.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket, Prefix=key):
+        for upload in page.get('Uploads', []):
+            if upload['Key'] == key and (latest is None or upload['Initiated'] > latest['Initiated']):
+                latest = upload
+    return latest and latest['UploadId']
+
+
+def list_uploaded_parts(s3, bucket, key, upload_id):
+    parts = {}
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts[part['PartNumber']] = part
+    return parts
+
+
+def _read_part(path, offset, length):
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _report(key, size, elapsed, latencies):
+    logger.info('Uploaded %s: %d bytes in %.1fs (%.1f MiB/s)',
+                key, size, elapsed, size / (elapsed or 1e-9) / 1024 / 1024)
+    if latencies:
+        logger.info('Part latency: min %.2fs, median %.2fs, max %.2fs over %d parts',
+                    min(latencies), statistics.median(latencies), max(latencies), len(latencies))
+
+
+def upload_part(s3, bucket, key, upload_id, number, data):
+    """ Uploading a part retrying it on its own with exponential backoff.
+
+    :return: (ETag, latency of the successful attempt) tuple.
+    """
+    md5 = hashlib.md5(data)
+    for attempt in range(1, MAX_PART_ATTEMPTS + 1):
+        start = time.perf_counter()
+        try:
+            res = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data,
+                                 ContentMD5=base64.b64encode(md5.digest()).decode())
+            return res['ETag'], time.perf_counter() - start
+        except (BotoCoreError, ClientError) as e:
+            if attempt == MAX_PART_ATTEMPTS:
+                raise UploadError(f'Part {number} of {key} failed {attempt} times: {e}') from e
+            logger.warning('Part %d of %s failed (%s). Retrying', number, key, e)
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def upload_file(bucket, key, path, concurrency=DEFAULT_CONCURRENCY, part_size=DEFAULT_PART_SIZE * 1024 * 1024,
+                cancel=None):
+    """ Uploading the file on :param path: to :param bucket: and :param key: in parallel parts.
+
+    Parts are uploaded on :param concurrency: threads and retried individually.
+    An unfinished upload of the same key (interrupted run) is resumed, skipping parts already uploaded.
+    The upload is left unfinished when a part fails or :param cancel: (``threading.Event``) is set,
+    so the next run can resume it.
+
+    :param part_size: part size in bytes.
+    :return: Stats of the upload as a dict.
+    """
+    s3 = clients.get_client('s3')
+    size = os.path.getsize(path)
+    start = time.perf_counter()
+
+    if size <= part_size:
+        with open(path, 'rb') as f:
+            s3.put_object(Bucket=bucket, Key=key, Body=f)
+        elapsed = time.perf_counter() - start
+        _report(key, size, elapsed, [elapsed])
+        return {'bytes': size, 'seconds': elapsed, 'parts': 1}
+
+    part_size = get_part_size(size, part_size)
+    upload_id = find_upload_id(s3, bucket, key)
+    uploaded = {}
+    if upload_id:
+        uploaded = list_uploaded_parts(s3, bucket, key, upload_id)
+        logger.info('Resuming upload %s of %s (%d parts already uploaded)', upload_id, key, len(uploaded))
+    else:
+        upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    latencies = []
+    sent = [0]
+    lock = threading.Lock()
+
+    def send(number):
+        if cancel is not None and cancel.is_set():
+            raise UploadError(f'Upload of {key} was cancelled')
+        offset = (number - 1) * part_size
+        data = _read_part(path, offset, part_size)
+        done = uploaded.get(number)
+        if done and done['Size'] == len(data) and done['ETag'].strip('"') == hashlib.md5(data).hexdigest():
+            return number, done['ETag']
+        etag, latency = upload_part(s3, bucket, key, upload_id, number, data)
+        with lock:
+            latencies.append(latency)
+            sent[0] += len(data)
+        return number, etag
+
+    numbers = range(1, (size + part_size - 1) // part_size + 1)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        parts = sorted(executor.map(trace.wrap(send), numbers))
+
+    s3.complete_multipart_upload(
+        Bucket=bucket, Key=key, UploadId=upload_id,
+        MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in parts]},
+    )
+    elapsed = time.perf_counter() - start
+    _report(key, sent[0], elapsed, latencies)
+    return {'bytes': sent[0], 'seconds': elapsed, 'parts': len(parts)}
+
+
+def copy_object(source_bucket, key, bucket, region_name=None, concurrency=DEFAULT_CONCURRENCY,
+                part_size=DEFAULT_PART_SIZE * 1024 * 1024, cancel=None):
+    """ Copying :param key: of :param source_bucket: (in the region of the session) to :param bucket:
+    in :param region_name: on the S3 side, without the data going through this machine.
+
+    Objects larger than :param part_size: are copied in parts on :param concurrency: threads by
+    ``UploadPartCopy``, others by ``CopyObject``. The copy is aborted when a part fails or
+    :param cancel: (``threading.Event``) is set.
+
+    :param part_size: part size in bytes.
+    :return: Stats of the copy as a dict.
+    """
+    s3 = clients.get_client('s3', region_name)
+    size = clients.get_client('s3').head_object(Bucket=source_bucket, Key=key)['ContentLength']
+    source = {'Bucket': source_bucket, 'Key': key}
+    start = time.perf_counter()
+
+    if size <= min(part_size, MAX_COPY_OBJECT_SIZE):
+        s3.copy_object(Bucket=bucket, Key=key, CopySource=source)
+        elapsed = time.perf_counter() - start
+        logger.info('Copied %s to %s: %d bytes in %.1fs', key, bucket, size, elapsed)
+        return {'bytes': size, 'seconds': elapsed, 'parts': 1}
+
+    part_size = get_part_size(size, part_size)
+    upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+
+    def copy(number):
+        if cancel is not None and cancel.is_set():
+            raise UploadError(f'Copy of {key} was cancelled')
+        first = (number - 1) * part_size
+        last = min(first + part_size, size) - 1
+        res = s3.upload_part_copy(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                                  CopySource=source, CopySourceRange=f'bytes={first}-{last}')
+        return number, res['CopyPartResult']['ETag']
+
+    numbers = range(1, (size + part_size - 1) // part_size + 1)
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            parts = sorted(executor.map(trace.wrap(copy), numbers))
+        s3.complete_multipart_upload(
+            Bucket=bucket, Key=key, UploadId=upload_id,
+            MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in parts]},
+        )
+    except BaseException:
+        # Unlike uploads, copies are cheap to start over, so unfinished ones are not left to resume.
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    elapsed = time.perf_counter() - start
+    logger.info('Copied %s to %s: %d bytes in %d parts in %.1fs', key, bucket, size, len(parts), elapsed)
+    return {'bytes': size, 'seconds': elapsed, 'parts': len(parts)}
+
+
+class MultipartWriter(io.RawIOBase):
+    """ Writable, non-seekable file object uploading what's written to :param bucket: and :param key:.
+
+    Written bytes are cut into :param part_size: parts which are uploaded on :param concurrency:
+    threads while writing goes on. At most :param queue_depth: parts are held in memory: writing
+    blocks until one of them is uploaded. The upload is completed on a successful exit of the
+    ``with`` block and aborted otherwise.
+    """
+
+    def __init__(self, bucket, key, concurrency=DEFAULT_CONCURRENCY, part_size=DEFAULT_PART_SIZE * 1024 * 1024,
+                 queue_depth=None):
+        super().__init__()
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.s3 = clients.get_client('s3')
+        self.upload_id = None
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.slots = threading.BoundedSemaphore(queue_depth or concurrency * 2)
+        self.buffer = bytearray()
+        self.position = 0
+        self.futures = []
+        self.latencies = []
+        self.error = None
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.upload_id = self.s3.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.complete()
+        except BaseException:
+            self.abort()
+            raise
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def write(self, b):
+        self.buffer += b
+        self.position += len(b)
+        while len(self.buffer) >= self.part_size:
+            self._submit(bytes(self.buffer[:self.part_size]))
+            del self.buffer[:self.part_size]
+        return len(b)
+
+    def _submit(self, data):
+        if self.error:
+            raise self.error
+        if len(self.futures) >= MAX_PARTS:
+            raise UploadError(f'{self.key} needs more than {MAX_PARTS} parts. Increase the part size')
+        self.slots.acquire()
+        number = len(self.futures) + 1
+
+        def send():
+            try:
+                etag, latency = upload_part(self.s3, self.bucket, self.key, self.upload_id, number, data)
+                self.latencies.append(latency)
+                return {'PartNumber': number, 'ETag': etag}
+            except BaseException as e:
+                self.error = e
+                raise
+            finally:
+                self.slots.release()
+
+        self.futures.append(self.executor.submit(trace.wrap(send)))
+
+    def complete(self):
+        if self.buffer or not self.futures:
+            self._submit(bytes(self.buffer))
+            self.buffer.clear()
+        parts = [future.result() for future in self.futures]
+        self.s3.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                          MultipartUpload={'Parts': parts})
+        self.executor.shutdown()
+        _report(self.key, self.position, time.perf_counter() - self.start, self.latencies)
+
+    def abort(self):
+        self.executor.shutdown(cancel_futures=True)
+        logger.warning('Aborting upload of %s', self.key)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
@@ -0,0 +1,316 @@
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# ``ebi serve`` is a long-lived process running deploy and bgdeploy for thin ``ebi`` clients
+# (``--server``) over a Unix socket. Imports, the boto3 session, clients and caches stay warm
+# between runs. Messages are lines of JSON: the client sends ``{"argv": [...], "cwd": "..."}``
+# and receives ``{"log": "..."}`` for each record logged for its run, ``{"event": "..."}`` for each
+# event with ``--events-jsonl -``, then ``{"exit": code}``.
+
+COMMANDS = ('deploy', 'bgdeploy')
+SOCKET_NAME = 'serve.sock'
+
+_connection = contextvars.ContextVar('ebi_serve_connection', default=None)
+
+
+def get_default_socket():
+    from . import cache
+
+    return os.path.join(cache.get_cache_dir(), SOCKET_NAME)
+
+
+class Connection:
+    """ Lines of JSON sent to a client, from the threads of its run.
+    """
+
+    def __init__(self, wfile):
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def send(self, **message):
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self._wfile.write(json.dumps(message).encode() + b'\n')
+                self._wfile.flush()
+            except OSError:
+                # The client went away. Its run goes on to the end.
+                self.closed = True
+
+
+class ConnectionHandler(logging.Handler):
+    """ Sending records logged in a run to the client of the run.
+    """
+
+    def emit(self, record):
+        connection = _connection.get()
+        if connection is None:
+            return
+        try:
+            message = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        connection.send(log=message)
+
+
+class _Run:
+    """ A run in ``DeployQueue``, finished with the result of its function or of the run replacing it.
+    """
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.result = None
+        self.replaced_by = None
+
+
+class DeployQueue:
+    """ Running one run at a time on each environment, and runs on different environments at once.
+
+    A run waiting for its environments is replaced by a newer run of the same key, so that
+    a burst of deploys to an environment only deploys the newest version. The replaced run
+    finishes with the result of the newer one.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._busy = set()
+        self._waiting = {}
+
+    def run(self, key, environments, func):
+        """ Calling :param func: once none of :param environments: is used by other runs.
+
+        :param key: runs waiting with the same key are replaced by the newest one.
+        :return: (whether :param func: was called, its result or the result of the run replacing it) tuple.
+        """
+        run = _Run()
+        with self._condition:
+            previous = self._waiting.get(key)
+            if previous is not None:
+                previous.replaced_by = run
+            self._waiting[key] = run
+            self._condition.notify_all()
+            while self._waiting.get(key) is run and self._busy & environments:
+                self._condition.wait()
+            replaced = self._waiting.get(key) is not run
+            if not replaced:
+                del self._waiting[key]
+                self._busy |= environments
+        try:
+            if replaced:
+                run.replaced_by.finished.wait()
+                run.result = run.replaced_by.result
+                return False, run.result
+            run.result = func()
+            return True, run.result
+        finally:
+            run.finished.set()
+            if not replaced:
+                with self._condition:
+                    self._busy -= environments
+                    self._condition.notify_all()
+
+
+def get_environments(command, parsed):
+    """ Returning a frozenset of (app_name, env_name) tuples the run of :param command: deploys to.
+    """
+    if command == 'bgdeploy':
+        return frozenset({(parsed.app_name, parsed.blue_env), (parsed.app_name, parsed.green_env)})
+
+    from .commands import deploy
+
+    try:
+        return frozenset(deploy.get_targets(parsed))
+    except (OSError, ValueError):
+        # deploy reports the manifest error.
+        return frozenset()
+
+
+def _exit_code(e):
+    if e.code is None or isinstance(e.code, int):
+        return e.code or 0
+    logger.error('%s', e.code)
+    return 1
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, profile=None, region=None):
+        from . import core
+
+        self.profile = profile
+        self.region = region
+        self.parser = core.make_parser(*COMMANDS)
+        self.queue = DeployQueue()
+        super().__init__(path, RequestHandler)
+
+    def check_args(self, command, parsed):
+        """ Returning the reason :param parsed: arguments of :param command: can't run here, or None.
+        """
+        if command not in COMMANDS:
+            return f'ebi serve runs {" and ".join(COMMANDS)}, not {command}'
+        if parsed.eb_cli:
+            return '--eb-cli is not supported by ebi serve'
+        if parsed.profile_cpu or parsed.profile_mem:
+            # Profiles would mix runs going on at once.
+            return '--profile-cpu and --profile-mem are not supported by ebi serve'
+        for name in ('profile', 'region'):
+            if getattr(parsed, name) and getattr(parsed, name) != getattr(self, name):
+                return f'ebi serve runs with --{name} {getattr(self, name)}, not {getattr(parsed, name)}'
+        return None
+
+    def write_events(self, connection, parsed, environments):
+        """ Returning the context writing events of :param environments: with ``--events-jsonl``.
+
+        Events of other runs are left out. With ``-``, these are printed by the client.
+        """
+        from . import events
+
+        if not parsed.events_jsonl:
+            return contextlib.nullcontext()
+        if parsed.events_jsonl == '-':
+            return events.listen_jsonl(lambda line: connection.send(event=line), environments)
+        return events.write_jsonl(parsed.events_jsonl, environments)
+
+    def run(self, connection, argv, cwd):
+        """ Running the command of :param argv: in :param cwd: for :param connection:.
+
+        :return: exit code of the run.
+        """
+        from . import appversion, clients, core, resolver, trace
+
+        command = core.find_command(argv)
+        try:
+            parsed = self.parser.parse_args(argv)
+        except SystemExit:
+            logger.error('Invalid arguments: %s', ' '.join(argv))
+            return 2
+        reason = self.check_args(command, parsed)
+        if reason:
+            logger.error(reason)
+            return 1
+        # Paths are relative to the client, but bundles are the only thing made in its directory.
+        for name in ('manifest', 'trace_json', 'trace_openmetrics', 'events_jsonl'):
+            if getattr(parsed, name, None) and getattr(parsed, name) != '-':
+                setattr(parsed, name, os.path.join(cwd, getattr(parsed, name)))
+        appversion.project_dir.set(cwd)
+
+        environments = get_environments(command, parsed)
+
+        def call():
+            # Environments and CNAMEs may have been changed by others since the last run.
+            clients.invalidate()
+            resolver.reset()
+            with trace.span(command) as root, self.write_events(connection, parsed, environments):
+                try:
+                    parsed.func(parsed)
+                    code = 0
+                except SystemExit as e:
+                    code = _exit_code(e)
+                except Exception:
+                    logger.exception('Failed to run %s', ' '.join(argv))
+                    code = 1
+            trace.report(parsed.trace_json, parsed.trace_openmetrics, parsed.trace_statsd, spans=[root])
+            trace.discard(root)
+            return code
+
+        called, code = self.queue.run((command, environments), environments, call)
+        if not called:
+            if code is None:
+                # The newer run failed without an exit code.
+                code = 1
+            logger.info('Skipped, as a newer %s to %s came while waiting. It exited with %d',
+                        command, ', '.join(env_name for _, env_name in sorted(environments)), code)
+        return code
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        connection = Connection(self.wfile)
+        _connection.set(connection)
+        try:
+            message = json.loads(self.rfile.readline())
+            code = self.server.run(connection, message['argv'], message['cwd'])
+        except (ValueError, KeyError, TypeError):
+            logger.error('Invalid request')
+            code = 2
+        connection.send(exit=code)
+
+
+def _is_listening(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return False
+    return True
+
+
+def serve(path, profile=None, region=None):
+    """ Serving runs on the Unix socket :param path: until it's interrupted or terminated.
+
+    The default session has to be set up for :param profile: and :param region: already.
+    """
+    from . import appversion, clients, engine, resolver  # noqa: F401
+
+    if os.path.exists(path):
+        if _is_listening(path):
+            logger.error('ebi serve is already running on %s', path)
+            sys.exit(1)
+        os.remove(path)
+    for service_name in ('elasticbeanstalk', 's3', 'autoscaling', 'ec2'):
+        clients.get_client(service_name)
+
+    handler = ConnectionHandler()
+    logging.getLogger('ebi').addHandler(handler)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server = Server(path, profile, region)
+    os.chmod(path, 0o600)
+    logger.info('Serving %s on %s', ' and '.join(COMMANDS), path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        logging.getLogger('ebi').removeHandler(handler)
+
+
+def request(path, argv):
+    """ Running :param argv: on ``ebi serve`` listening on :param path:, printing logs of the run.
+
+    :return: exit code of the run.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(path)
+            sock.sendall(json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n')
+            for line in sock.makefile('rb'):
+                message = json.loads(line)
+                if 'log' in message:
+                    print(message['log'], file=sys.stderr, flush=True)
+                elif 'event' in message:
+                    print(message['event'], flush=True)
+                elif 'exit' in message:
+                    return message['exit']
+    except OSError as e:
+        logger.error('Failed to run on ebi serve on %s: %s', path, e)
+        return 1
+    logger.error('ebi serve on %s closed the connection before the run ended', path)
+    return 1
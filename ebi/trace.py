@@ -0,0 +1,228 @@
+import contextlib
+import contextvars
+import json
+import logging
+import re
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Nested timing spans of the phases of a run (bundling, uploading, deploying, swapping...).
+# Spans opened in a thread are children of the span open in it. Threads started for a span
+# run functions wrapped by ``wrap`` to be in it. AWS API calls are counted on the open spans
+# by ``clients``.
+
+_current = contextvars.ContextVar('ebi_trace_span', default=None)
+_lock = threading.Lock()
+roots = []
+# Functions called with each span opened, and with the span a function wrapped by ``wrap`` runs in
+# (with ``thread=True``), returning a context manager entered for the time of it. Used to profile
+# phases (see ``profiling``). Nothing is called while it's empty.
+hooks = []
+
+STATSD_PREFIX = 'ebi'
+# Attributes of spans used as OpenMetrics labels. Others (keys, versions...) would make a series per run.
+METRIC_LABELS = ('app', 'env', 'region')
+
+
+class Span:
+
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.children = []
+        self.api_calls = 0
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    @property
+    def path(self):
+        return f'{self.parent.path}/{self.name}' if self.parent else self.name
+
+    def set(self, **attributes):
+        """ Setting attributes, e.g. bytes processed in the span.
+        """
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            'duration': self.duration,
+            'api_calls': self.api_calls,
+            'attributes': self.attributes,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+@contextlib.contextmanager
+def span(name, **attributes):
+    """ Recording the time of the ``with`` block as a span of :param name: in the current span.
+
+    :param attributes: values describing the span, e.g. env or bytes.
+    """
+    parent = _current.get()
+    s = Span(name, parent, attributes)
+    with _lock:
+        (parent.children if parent else roots).append(s)
+    token = _current.set(s)
+    try:
+        if hooks:
+            with _hooked(s):
+                yield s
+        else:
+            yield s
+    except Exception as e:
+        s.set(error=e.__class__.__name__)
+        raise
+    finally:
+        s.finish()
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def _hooked(s, thread=False):
+    with contextlib.ExitStack() as stack:
+        for hook in list(hooks):
+            stack.enter_context(hook(s, thread=thread))
+        yield
+
+
+def _call_hooked(func, *args, **kwargs):
+    with _hooked(_current.get(), thread=True):
+        return func(*args, **kwargs)
+
+
+def wrap(func):
+    """ Making :param func: run in the current span when it's called on another thread.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        if hooks:
+            return context.copy().run(_call_hooked, func, *args, **kwargs)
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+
+def count_api_call():
+    """ Counting an AWS API call on the open spans of the calling thread.
+    """
+    s = _current.get()
+    if s is None:
+        return
+    with _lock:
+        while s is not None:
+            s.api_calls += 1
+            s = s.parent
+
+
+def iter_spans(spans=None):
+    for s in roots if spans is None else spans:
+        yield s
+        yield from iter_spans(s.children)
+
+
+def reset():
+    with _lock:
+        roots.clear()
+
+
+def discard(s):
+    """ Forgetting the root span :param s:, e.g. after reporting a request of ``ebi serve``.
+    """
+    with _lock:
+        roots.remove(s)
+
+
+def write_json(path, spans=None):
+    """ Writing :param spans: (all root spans by default) to :param path: as a JSON tree.
+    """
+    with open(path, 'w') as f:
+        json.dump({'spans': [s.to_dict() for s in (roots if spans is None else spans)]}, f, indent=2, default=str)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(s):
+    labels = {'phase': s.path}
+    labels.update((name, s.attributes[name]) for name in METRIC_LABELS if name in s.attributes)
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in sorted(labels.items())) + '}'
+
+
+def to_openmetrics(spans=None):
+    """ Returning the spans as OpenMetrics text, a sample per span labelled by its path, app, env and region.
+    """
+    spans = [s for s in iter_spans(spans) if s.duration is not None]
+    lines = [
+        '# TYPE ebi_phase_duration_seconds gauge',
+        '# UNIT ebi_phase_duration_seconds seconds',
+        '# HELP ebi_phase_duration_seconds Wall time of the phase.',
+    ]
+    lines += [f'ebi_phase_duration_seconds{_labels(s)} {s.duration:.6f}' for s in spans]
+    lines += [
+        '# TYPE ebi_phase_api_calls gauge',
+        '# HELP ebi_phase_api_calls AWS API calls made in the phase.',
+    ]
+    lines += [f'ebi_phase_api_calls{_labels(s)} {s.api_calls}' for s in spans]
+    lines += [
+        '# TYPE ebi_phase_bytes gauge',
+        '# UNIT ebi_phase_bytes bytes',
+        '# HELP ebi_phase_bytes Bytes processed in the phase.',
+    ]
+    lines += [f'ebi_phase_bytes{_labels(s)} {s.attributes["bytes"]}' for s in spans if 'bytes' in s.attributes]
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def write_openmetrics(path, spans=None):
+    with open(path, 'w') as f:
+        f.write(to_openmetrics(spans))
+
+
+def to_statsd_lines(prefix=STATSD_PREFIX, spans=None):
+    """ Returning the spans as StatsD lines: timers of durations, and gauges of API calls and bytes.
+    """
+    lines = []
+    for s in iter_spans(spans):
+        if s.duration is None:
+            continue
+        name = prefix + '.' + re.sub('[^a-zA-Z0-9_/-]', '_', s.path).replace('/', '.')
+        lines.append(f'{name}.duration:{s.duration * 1000:.3f}|ms')
+        lines.append(f'{name}.api_calls:{s.api_calls}|g')
+        if 'bytes' in s.attributes:
+            lines.append(f'{name}.bytes:{s.attributes["bytes"]}|g')
+    return lines
+
+
+def send_statsd(address, spans=None, prefix=STATSD_PREFIX):
+    """ Sending the spans to the StatsD server on :param address: (host:port) over UDP.
+    """
+    host, _, port = address.rpartition(':')
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for line in to_statsd_lines(prefix, spans):
+            sock.sendto(line.encode(), (host or 'localhost', int(port)))
+
+
+def report(json_path=None, openmetrics_path=None, statsd_address=None, spans=None):
+    """ Writing :param spans: (all root spans by default) to the given outputs.
+    Failures are logged without failing the run.
+    """
+    outputs = ((write_json, json_path), (write_openmetrics, openmetrics_path), (send_statsd, statsd_address))
+    for output, target in outputs:
+        if not target:
+            continue
+        try:
+            output(target, spans)
+        except (OSError, ValueError) as e:
+            logger.warning('Failed to write the trace to %s: %s', target, e)
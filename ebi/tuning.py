@@ -0,0 +1,195 @@
+import json
+import logging
+import os
+import time
+import zipfile
+import zlib
+
+from . import bundle, cache, compress
+
+logger = logging.getLogger(__name__)
+
+
+# ``--compression auto`` picks the deflate level minimizing the time to compress the bundle and
+# upload it. Compress throughputs and ratios of levels are sampled from the bundle, and upload
+# throughputs are measured on uploads. Both are kept in the cache directory as moving averages,
+# so that later runs start from the level picked before and only sample levels around it.
+
+# Levels to choose from. 0 stores members without compressing these.
+LEVELS = (0, 1, 3, 6, 9)
+STORED = 0
+# Level used when nothing in the bundle is compressible.
+DEFAULT_LEVEL = 6
+# Slices of files spread over the bundle are sampled, up to these sizes.
+SAMPLE_BYTES = 2 * 1024 * 1024
+SAMPLE_FILE_BYTES = 256 * 1024
+MAX_SAMPLE_FILES = 256
+# Upload throughput assumed until an upload is measured, in bytes per second.
+DEFAULT_UPLOAD_THROUGHPUT = 8 * 1024 * 1024
+# Uploads smaller than this are dominated by latency rather than bandwidth, so these are not measured.
+MIN_MEASURED_UPLOAD = 4 * 1024 * 1024
+# Weight of a new measurement in the moving averages.
+SMOOTHING = 0.5
+TUNING_NAME = 'compression.json'
+
+
+def _tuning_path():
+    return os.path.join(cache.get_cache_dir(), TUNING_NAME)
+
+
+def load():
+    """ Returning measurements saved by earlier runs, or an empty dict.
+    """
+    try:
+        with open(_tuning_path()) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(tuning):
+    path = _tuning_path()
+    tmp = f'{path}.{os.getpid()}'
+    with open(tmp, 'w') as f:
+        json.dump(dict(tuning, written=time.time()), f, indent=2)
+    os.replace(tmp, path)
+
+
+def _average(previous, value):
+    return value if previous is None else previous * (1 - SMOOTHING) + value * SMOOTHING
+
+
+def record_upload(size, seconds):
+    """ Saving the throughput of uploading :param size: bytes in :param seconds:.
+    """
+    if size < MIN_MEASURED_UPLOAD or seconds <= 0:
+        return
+    tuning = load()
+    tuning['upload_throughput'] = _average(tuning.get('upload_throughput'), size / seconds)
+    try:
+        save(tuning)
+    except OSError as e:
+        logger.debug('Failed to save the upload throughput: %s', e)
+
+
+def _split_files(members):
+    """ Returning (path, size) of files in :param members: deflated unless they're stored by extension,
+    and the total size of files stored by extension.
+    """
+    files = []
+    stored_size = 0
+    for _, path, kind in members:
+        if kind != bundle.MEMBER_FILE:
+            continue
+        if os.path.splitext(path)[1].lower() in compress.STORED_EXTENSIONS:
+            stored_size += os.path.getsize(path)
+        else:
+            files.append((path, os.path.getsize(path)))
+    return files, stored_size
+
+
+def read_samples(files):
+    """ Reading slices of :param files: spread over them, skipping ones stored as incompressible.
+
+    :return: (samples, ratio of bytes of the files looked at which are stored as incompressible) tuple.
+    """
+    samples = []
+    total = 0
+    checked_size = 0
+    stored_size = 0
+    for path, size in files[::max(len(files) // MAX_SAMPLE_FILES, 1)]:
+        if not size:
+            continue
+        checked_size += size
+        if compress.choose_compress_type(path, size) == zipfile.ZIP_STORED:
+            stored_size += size
+            continue
+        with open(path, 'rb') as f:
+            sample = f.read(SAMPLE_FILE_BYTES)
+        samples.append(sample)
+        total += len(sample)
+        if total >= SAMPLE_BYTES:
+            break
+    return samples, stored_size / checked_size if checked_size else 0.0
+
+
+def measure(samples, level):
+    """ Deflating :param samples: at :param level: like members are.
+
+    :return: dict of the compress ratio and throughput (bytes per second, None when not compressing).
+    """
+    size = sum(len(sample) for sample in samples)
+    if level == STORED:
+        return {'ratio': 1.0, 'throughput': None}
+    start = time.perf_counter()
+    compressed = 0
+    for sample in samples:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed += len(compressor.compress(sample)) + len(compressor.flush())
+    elapsed = time.perf_counter() - start
+    return {'ratio': compressed / size, 'throughput': size / max(elapsed, 1e-9)}
+
+
+def estimate_seconds(size, measurement, upload_throughput, jobs=1, overlap=False, stored_size=0):
+    """ Estimating seconds to compress :param size: bytes and upload the result,
+    with :param stored_size: bytes stored at any level.
+
+    :param overlap: whether compression and upload overlap, like with ``--stream``.
+    """
+    compress_seconds = size / (measurement['throughput'] * jobs) if measurement['throughput'] else 0.0
+    upload_seconds = (size * measurement['ratio'] + stored_size) / upload_throughput
+    return max(compress_seconds, upload_seconds) if overlap else compress_seconds + upload_seconds
+
+
+def _levels_to_sample(previous):
+    if previous not in LEVELS:
+        return LEVELS
+    i = LEVELS.index(previous)
+    return LEVELS[max(i - 1, 0):i + 2]
+
+
+def choose_level(members, jobs=1, overlap=False):
+    """ Choosing the deflate level (0 to store) making and uploading the bundle of :param members: fastest.
+
+    Levels around the one chosen before are sampled from the bundle, and averaged with earlier
+    measurements. The choice and the measurements are saved for later runs.
+
+    :param jobs: the number of processes compressing files.
+    :param overlap: whether compression and upload overlap, like with ``--stream``.
+    """
+    files, stored_size = _split_files(members)
+    samples, stored_ratio = read_samples(files)
+    tuning = load()
+    if not samples:
+        logger.info('Nothing in the bundle is compressible. Using compression level %d', DEFAULT_LEVEL)
+        return DEFAULT_LEVEL
+
+    measurements = tuning.setdefault('levels', {})
+    for level in _levels_to_sample(tuning.get('level')):
+        measured = measure(samples, level)
+        previous = measurements.get(str(level))
+        if previous and measured['throughput']:
+            measured = {name: _average(previous[name], value) for name, value in measured.items()}
+        measurements[str(level)] = measured
+
+    upload_throughput = tuning.get('upload_throughput') or DEFAULT_UPLOAD_THROUGHPUT
+    # Files sampled as incompressible are stored at every level, so these are only uploaded.
+    files_size = sum(size for _, size in files)
+    size = files_size * (1 - stored_ratio)
+    stored_size += files_size - size
+    estimates = {int(level): estimate_seconds(size, m, upload_throughput, jobs=jobs, overlap=overlap,
+                                              stored_size=stored_size)
+                 for level, m in measurements.items()}
+    for level, seconds in sorted(estimates.items()):
+        logger.debug('Compression level %d: ratio %.2f, estimated %.2fs', level, measurements[str(level)]['ratio'],
+                     seconds)
+    chosen = min(estimates, key=estimates.get)
+    logger.info('Compression level %d chosen for %.1f MiB (%.1f MiB stored) at %.1f MiB/s upload (estimated %.1fs)',
+                chosen, size / 1024 / 1024, stored_size / 1024 / 1024, upload_throughput / 1024 / 1024,
+                estimates[chosen])
+    tuning['level'] = chosen
+    try:
+        save(tuning)
+    except OSError as e:
+        logger.debug('Failed to save compression measurements: %s', e)
+    return chosen
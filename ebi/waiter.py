@@ -0,0 +1,54 @@
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff:
+    """ Intervals growing exponentially from :param initial: up to :param maximum: seconds.
+
+    Each interval is randomized by :param jitter: (ratio) so that many waiters don't poll in step.
+    """
+
+    def __init__(self, initial=2, maximum=30, factor=2, jitter=0.2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.current = initial
+
+    def reset(self):
+        self.current = self.initial
+
+    def next(self):
+        interval = self.current * random.uniform(1 - self.jitter, 1 + self.jitter)
+        self.current = min(self.current * self.factor, self.maximum)
+        return interval
+
+
+def wait_until(check, timeout, backoff=None, description='the condition', cancel=None):
+    """ Calling :param check: until it returns True, sleeping with :param backoff: between calls.
+
+    :param timeout: seconds to wait.
+    :param cancel: ``threading.Event`` to stop waiting when it's set.
+    :return: True when :param check: passed, False when it timed out or was cancelled.
+    """
+    backoff = backoff or Backoff()
+    start = time.monotonic()
+    deadline = start + timeout
+    attempts = 0
+    while True:
+        attempts += 1
+        if check():
+            logger.info('%s after %.0fs (%d checks)', description, time.monotonic() - start, attempts)
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        interval = min(backoff.next(), remaining)
+        logger.debug('Waiting %.1fs for %s', interval, description)
+        if cancel is None:
+            time.sleep(interval)
+        elif cancel.wait(interval):
+            return False